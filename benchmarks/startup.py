@@ -0,0 +1,107 @@
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+""" startup.py
+
+Startup-time budget of the fittedismip-gris entry point.
+
+Times commands that return before any stage runs (--help and options that fail
+validation) in fresh interpreters, and fails if the median time of any of them exceeds
+the budget, or if they import any of the heavy dependencies of the stages. The import
+check does not depend on the speed of the machine, the timing catches everything else.
+
+Usage:
+python benchmarks/startup.py [--budget SECONDS] [--repeat N]
+
+"""
+
+# Default budget of each command, in seconds
+DEFAULT_BUDGET = 0.5
+
+# Commands that must return quickly, with their expected exit status
+COMMANDS = (
+    (["--help"], 0),
+    (["run", "--help"], 0),
+    (["serve", "--help"], 0),
+    (["run", "--nsamps", "many"], 2),
+    (["run", "--location-shard", "3/2"], 2),
+    (["run", "--tlim", "1.5"], 2),
+    (["run", "--dask-workers", "2"], 2),
+)
+
+# Modules the commands must not import
+HEAVY_MODULES = ("xarray", "dask", "scipy", "netCDF4", "h5py", "numpy", "pandas")
+
+# Runs the entry point with the arguments, and prints the heavy modules it imported
+ENTRY_POINT = """
+import sys
+from fittedismip_gris.cli import main
+try:
+    main(sys.argv[1:], prog_name="fittedismip-gris")
+finally:
+    imported = {{x.split(".")[0] for x in sys.modules}} & set({heavy!r})
+    print("imports:" + ",".join(sorted(imported)), file=sys.stderr)
+"""
+
+
+def RunCommand(args, status):
+    """Runs fittedismip-gris with args in a fresh interpreter and returns the time it
+    took and the heavy modules it imported. Raises a RuntimeError if it exits with
+    another status."""
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-c", ENTRY_POINT.format(heavy=HEAVY_MODULES), *args],
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    elapsed = time.perf_counter() - start
+    if result.returncode != status:
+        raise RuntimeError(
+            f"fittedismip-gris {' '.join(args)} exited with status {result.returncode}, expected {status}:\n{result.stderr}"
+        )
+    imports = result.stderr.rpartition("imports:")[2].strip()
+    return (elapsed, [x for x in imports.split(",") if x])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check the startup time of the fittedismip-gris entry point"
+    )
+    parser.add_argument(
+        "--budget",
+        help=f"Median time allowed for each command, in seconds [default={DEFAULT_BUDGET}]",
+        type=float,
+        default=DEFAULT_BUDGET,
+    )
+    parser.add_argument(
+        "--repeat",
+        help="Number of runs of each command [default=5]",
+        type=int,
+        default=5,
+    )
+    args = parser.parse_args()
+
+    # Time the commands, after a run to warm up the file system cache
+    RunCommand(["--help"], 0)
+    failed = False
+    for command_args, status in COMMANDS:
+        runs = [RunCommand(command_args, status) for _ in range(args.repeat)]
+        median = statistics.median(x[0] for x in runs)
+        heavy = runs[0][1]
+        over = median > args.budget
+        failed = failed or over or bool(heavy)
+        print(
+            f"{'FAIL' if over or heavy else 'ok':4}  {median * 1000:7.1f} ms  fittedismip-gris {' '.join(command_args)}"
+            + (f"  (imports {', '.join(heavy)})" if heavy else "")
+        )
+
+    print(f"Budget: {args.budget * 1000:.0f} ms per command")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
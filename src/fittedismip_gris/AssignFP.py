@@ -1,6 +1,5 @@
-import numpy as np
-from fittedismip_gris.ReadFingerprint import ReadFingerprint as readfp
-from scipy import interpolate as interp
+from fittedismip_gris.fp_weights import ApplyWeights, LoadBilinearWeights, WeightCells
+from fittedismip_gris.ReadFingerprint import ReadFingerprintCells, ReadFingerprintGrid
 
 """ AssignFP.py
 
@@ -11,6 +10,8 @@ Parameters:
 fp_filename = Fingerprint file passed to ReadFingerprint
 qlats = Vector of latitudes of sites of interest [-90, 90]
 qlons = Vector of longitudes of sites of interest [-180, 180]
+cache_dir = Directory in which to keep the interpolation weights of the fingerprint
+            grid for these sites [default = no cache]
 
 Return:
 fp_sites = Vector of fingerprint coefficients for the sites of interest
@@ -19,19 +20,22 @@ fp_sites = Vector of fingerprint coefficients for the sites of interest
 """
 
 
-def AssignFP(fp_filename, qlats, qlons):
-    ## Read in the fitted parameters from parfile
+def AssignFP(fp_filename, qlats, qlons, cache_dir=None):
+    ## Read in the fingerprint grid from fp_filename
     # Open the file
     try:
-        (fp, fp_lats, fp_lons) = readfp(fp_filename)
+        (fp_lats, fp_lons) = ReadFingerprintGrid(fp_filename)
     except IOError:
         print("Cannot open fingerprint file\n")
 
+    # Interpolation weights of these locations (bilinear, see fp_weights.py)
+    weights = LoadBilinearWeights(fp_lats, fp_lons, qlats, qlons, cache_dir=cache_dir)
+
+    # Read the fingerprint at the grid cells around the locations only
+    cells = WeightCells(weights)
+    fp_cells = ReadFingerprintCells(fp_filename, cells, (fp_lats.size, fp_lons.size))
+
     # Interpolate the fingerprint to these locations
-    lat_sort = np.argsort(fp_lats)
-    fp_interp = interp.RectBivariateSpline(
-        fp_lats[lat_sort], fp_lons, fp[lat_sort, :], kx=1, ky=1
-    )
-    fp_sites = fp_interp.ev(qlats, np.mod(qlons, 360)) * 1000
+    fp_sites = ApplyWeights(weights, fp_cells, cells=cells) * 1000
 
     return fp_sites
@@ -1,6 +1,7 @@
 import argparse
 import sys
 import numpy as np
+from fittedismip_gris.parameter_store import ICE_SOURCES, ParameterStore
 
 """ FittedISMIP_fit_icesheet.py
 
@@ -9,72 +10,67 @@ Fitting process for the FittedISMIP icesheet module.
 Fitting is done external to this FACTS workflow.  Parameters from this fitting process
 are read in and stored here for the next stage.
 
+The parameters are held in a ParameterStore, which reads the parameters of an ice source
+only when they are first used. If a parameter bundle is given, the parameter files are
+optional. If a cache directory is given, the parameter files are compiled into a bundle
+there on the first run and later runs read the bundle instead of parsing the files.
+
 Note: 'pipeline_id' is a unique identifier that distinguishes it among other instances
 of this module within the same workflow.
 
 """
 
+# Define the linear trend terms to be added to the samples
+# TREND_MEAN = {"EAIS": -0.02, "WAIS": 0.28, "PEN": 0.06, "GIS": 0.46}	# SOD
+# TREND_SD = {"EAIS": 0.05, "WAIS": 0.03, "PEN": 0.01, "GIS": 0.04}		# SOD
+TREND_MEAN = {"EAIS": 0.09, "WAIS": 0.18, "PEN": 0.06, "GIS": 0.19}
+TREND_SD = {"EAIS": 0.04, "WAIS": 0.09, "PEN": 0.03, "GIS": 0.1}
+
 
 def FittedISMIP_fit_icesheet(
     pipeline_id: str,
-    gris_parm_file: str,
-    wais_parm_file: str,
-    eais_parm_file: str,
-    pen_parm_file: str,
+    gris_parm_file: str | None = None,
+    wais_parm_file: str | None = None,
+    eais_parm_file: str | None = None,
+    pen_parm_file: str | None = None,
+    parm_bundle: str | None = None,
+    cache_dir: str | None = None,
 ) -> dict:
-    # Initialize dictionaries to hold model parameters
-    groups_dict = {}
-    models_dict = {}
-    betas_dict = {}
-    sigmas_dict = {}
-
-    # Load the Greenland ice sheet model fits
+    # The model fits for each ice sheet component
     # parmfile = os.path.join(os.path.dirname(__file__), "FittedParms_GrIS_ALL.csv")
-    groups, models, betas, sigmas = ReadParameterFile(gris_parm_file)
-    groups_dict["GIS"] = groups
-    models_dict["GIS"] = models
-    betas_dict["GIS"] = betas
-    sigmas_dict["GIS"] = sigmas
-
-    # Load the West Antarctic ice sheet model fits
     # parmfile = os.path.join(os.path.dirname(__file__), "FittedParms_AIS_WAIS.csv")
-    groups, models, betas, sigmas = ReadParameterFile(wais_parm_file)
-    groups_dict["WAIS"] = groups
-    models_dict["WAIS"] = models
-    betas_dict["WAIS"] = betas
-    sigmas_dict["WAIS"] = sigmas
-
-    # Load the East Antarctic ice sheet model fits
     # parmfile = os.path.join(os.path.dirname(__file__), "FittedParms_AIS_EAIS.csv")
-    groups, models, betas, sigmas = ReadParameterFile(eais_parm_file)
-    groups_dict["EAIS"] = groups
-    models_dict["EAIS"] = models
-    betas_dict["EAIS"] = betas
-    sigmas_dict["EAIS"] = sigmas
-
-    # Load the Antarctic Peninsula ice sheet model fits
     # parmfile = os.path.join(os.path.dirname(__file__), "FittedParms_AIS_PEN.csv")
-    groups, models, betas, sigmas = ReadParameterFile(pen_parm_file)
-    groups_dict["PEN"] = groups
-    models_dict["PEN"] = models
-    betas_dict["PEN"] = betas
-    sigmas_dict["PEN"] = sigmas
-
-    # Define the linear trend terms to be added to the samples
-    # trend_mean = {"EAIS": -0.02, "WAIS": 0.28, "PEN": 0.06, "GIS": 0.46}	# SOD
-    # trend_sd = {"EAIS": 0.05, "WAIS": 0.03, "PEN": 0.01, "GIS": 0.04}		# SOD
-    trend_mean = {"EAIS": 0.09, "WAIS": 0.18, "PEN": 0.06, "GIS": 0.19}
-    trend_sd = {"EAIS": 0.04, "WAIS": 0.09, "PEN": 0.03, "GIS": 0.1}
+    parm_files = {
+        "GIS": gris_parm_file,
+        "WAIS": wais_parm_file,
+        "EAIS": eais_parm_file,
+        "PEN": pen_parm_file,
+    }
+    if not any(parm_files.values()):
+        parm_files = None
+    elif not all(parm_files.values()):
+        missing = [x for x in ICE_SOURCES if not parm_files[x]]
+        raise ValueError(f"Missing parameter files for {', '.join(missing)}")
+
+    # Load the model parameters on first use
+    store = ParameterStore(
+        parm_files,
+        trend_mean=TREND_MEAN,
+        trend_sd=TREND_SD,
+        bundle=parm_bundle,
+        cache_dir=cache_dir,
+    )
 
     ###################################################
     # Store the data in a pickle
     output = {
-        "groups_dict": groups_dict,
-        "models_dict": models_dict,
-        "betas_dict": betas_dict,
-        "sigmas_dict": sigmas_dict,
-        "trend_mean": trend_mean,
-        "trend_sd": trend_sd,
+        "groups_dict": store.Field("groups"),
+        "models_dict": store.Field("models"),
+        "betas_dict": store.Field("betas"),
+        "sigmas_dict": store.Field("sigmas"),
+        "trend_mean": store.trend_mean,
+        "trend_sd": store.trend_sd,
     }
 
     return output
@@ -4,9 +4,21 @@ import time
 import argparse
 from fittedismip_gris.read_locationfile import ReadLocationFile
 from fittedismip_gris.AssignFP import AssignFP
+from fittedismip_gris.encoding import (
+    INT16_FILL,
+    CheckPackedRange,
+    ParseEncodingProfile,
+    ProfileString,
+)
+from fittedismip_gris.local_output import (
+    LOCAL_FORMATS,
+    WriteFactorizedLocal,
+    WriteLocalQuantiles,
+)
+from fittedismip_gris.location_shards import ShardAttributes, ShardSlice
+from fittedismip_gris.output_store import WriteDataset
 
 import xarray as xr
-import dask.array as da
 
 """ FittedISMIP_postprocess_icesheet.py
 
@@ -19,22 +31,84 @@ to local sea-level rise
 Parameters:
 locationfile = File that contains points for localization
 pipeline_id = Unique identifer for the pipeline running this code
+site_dict = Optional site locations and fingerprints from LoadSiteFingerprints(). When
+            provided, locationfile and fpdir are not read again. With a location shard,
+            they hold the locations of the shard (see location_shards.py).
+local_encoding = Encoding profile of the local output file (see encoding.py)
+local_format = "dense" writes the local samples. "factorized" writes the global samples
+               and the site fingerprints, from which OpenLocalOutput() computes the local
+               samples on access (see local_output.py).
+gris_local_out_file = Local output file. Names ending in .zarr are written as Zarr stores
+                      (see output_store.py).
+quantiles = List of quantiles to write instead of the local samples. They equal
+            np.quantile over the samples of the dense local output, but are computed
+            without the local samples (see local_quantiles.py).
 
 Output: NetCDF file containing local contributions from ice sheets
 
 """
 
 
+def LoadSiteFingerprints(locationfile, fpdir, cache_dir=None, location_shard=None):
+    # Load the site locations
+    (_, site_ids, site_lats, site_lons) = ReadLocationFile(
+        locationfile, cache_dir=cache_dir
+    )
+
+    # Keep the locations of this shard only
+    shard_attrs = {}
+    if location_shard is not None:
+        shard_attrs = ShardAttributes(site_ids.size, location_shard)
+        locations = ShardSlice(site_ids.size, location_shard)
+        site_ids = site_ids[locations]
+        site_lats = site_lats[locations]
+        site_lons = site_lons[locations]
+
+    # Get the fingerprints for all sites from all ice sheets
+    gisfp = AssignFP(
+        os.path.join(fpdir, "fprint_gis.nc"), site_lats, site_lons, cache_dir=cache_dir
+    )
+
+    return {
+        "site_ids": site_ids,
+        "site_lats": site_lats,
+        "site_lons": site_lons,
+        "gisfp": gisfp,
+        "shard_attrs": shard_attrs,
+    }
+
+
 def FittedISMIP_postprocess_icesheet(
-    projection_dict, locationfile, chunksize, pipeline_id, fpdir, gris_local_out_file
+    projection_dict,
+    locationfile,
+    chunksize,
+    pipeline_id,
+    fpdir,
+    gris_local_out_file,
+    site_dict=None,
+    local_encoding="f4-zlib",
+    local_format="dense",
+    quantiles=None,
 ):
+    if local_format not in LOCAL_FORMATS:
+        raise ValueError(f"Unknown local output format: {local_format}")
+    if quantiles is not None and local_format != "dense":
+        raise ValueError(
+            "Quantile output cannot be combined with a local output format"
+        )
+    profile = ParseEncodingProfile(local_encoding)
+
     samps_dict = projection_dict["samps_dict"]
     targyears = projection_dict["targyears"]
     scenario = projection_dict["scenario"]
     baseyear = projection_dict["baseyear"]
 
-    # Load the site locations
-    (_, site_ids, site_lats, site_lons) = ReadLocationFile(locationfile)
+    # Load the site locations and fingerprints if they were not provided
+    if site_dict is None:
+        site_dict = LoadSiteFingerprints(locationfile, fpdir)
+    site_ids = site_dict["site_ids"]
+    site_lats = site_dict["site_lats"]
+    site_lons = site_dict["site_lons"]
 
     # Get the samples from the samps dictionary
     # waissamps = samps_dict["WAIS"] + samps_dict["PEN"]
@@ -45,14 +119,90 @@ def FittedISMIP_postprocess_icesheet(
     nsamps = gissamps.shape[0]
 
     # Get the fingerprints for all sites from all ice sheets
-    gisfp = da.array(
-        AssignFP(os.path.join(fpdir, "fprint_gis.nc"), site_lats, site_lons)
-    )
+    gisfp = site_dict["gisfp"]
     # waisfp = da.array(AssignFP(os.path.join(fpdir,"fprint_wais.nc"), site_lats, site_lons))
     # eaisfp = da.array(AssignFP(os.path.join(fpdir,"fprint_eais.nc"), site_lats, site_lons))
 
-    # Rechunk the fingerprints for memory
-    gisfp = gisfp.rechunk(chunksize)
+    # Define the missing value for the netCDF files
+    nc_missing_value = INT16_FILL if profile["dtype"] == "i2" else np.nan
+
+    # Attributes of the local output
+    ncvar_attributes = {
+        "description": "Local SLR contributions from icesheet according to Fitted ISMIP workflow",
+        "history": "Created " + time.ctime(time.time()),
+        "source": "SLR Framework: Fitted ISMIP workflow",
+        "scenario": scenario,
+        "baseyear": baseyear,
+        "encoding_profile": ProfileString(profile),
+        **site_dict.get("shard_attrs", {}),
+    }
+
+    # wais_out = xr.Dataset({"sea_level_change": (("samples", "years", "locations"), waissl, {"units":"mm", "missing_value":nc_missing_value}),
+    # "lat": (("locations"), site_lats),
+    # "lon": (("locations"), site_lons)},
+    # coords={"years": targyears, "locations": site_ids, "samples": np.arange(nsamps)}, attrs=ncvar_attributes)
+
+    # eais_out = xr.Dataset({"sea_level_change": (("samples", "years", "locations"), eaissl, {"units":"mm", "missing_value":nc_missing_value}),
+    # "lat": (("locations"), site_lats),
+    # "lon": (("locations"), site_lons)},
+    # coords={"years": targyears, "locations": site_ids, "samples": np.arange(nsamps)}, attrs=ncvar_attributes)
+
+    # ais_out = xr.Dataset({"sea_level_change": (("samples", "years", "locations"), aissl, {"units":"mm", "missing_value":nc_missing_value}),
+    # "lat": (("locations"), site_lats),
+    # "lon": (("locations"), site_lons)},
+    # coords={"years": targyears, "locations": site_ids, "samples": np.arange(nsamps)}, attrs=ncvar_attributes)
+
+    # Packed output must fit the range of the local samples, which is the range of the
+    # global samples scaled by the fingerprints
+    if profile["dtype"] == "i2":
+        fp_range = np.array(
+            [np.nanmin(site_dict["gisfp"]), np.nanmax(site_dict["gisfp"])]
+        )
+        ends = np.multiply.outer(
+            np.array([np.nanmin(gissamps), np.nanmax(gissamps)]), fp_range
+        )
+        CheckPackedRange(profile, ends.min(), ends.max())
+
+    # Write the quantiles of the local samples, without computing the samples
+    if quantiles is not None:
+        WriteLocalQuantiles(
+            gris_local_out_file,
+            np.asarray(gissamps),
+            site_dict["gisfp"],
+            quantiles,
+            targyears,
+            site_ids,
+            site_lats,
+            site_lons,
+            ncvar_attributes,
+            profile,
+        )
+        return
+
+    # Write the factors of the local samples
+    if local_format == "factorized":
+        WriteFactorizedLocal(
+            gris_local_out_file,
+            gissamps,
+            site_dict["gisfp"],
+            targyears,
+            site_ids,
+            site_lats,
+            site_lons,
+            ncvar_attributes,
+            profile,
+        )
+        return
+
+    # Rechunk the fingerprints for memory. Only the dense output localizes the
+    # samples. Samples in memory with the locations in a single chunk are localized
+    # with numpy, without building a dask graph.
+    if hasattr(gissamps, "chunks") or np.size(gisfp) > chunksize:
+        import dask.array as da
+
+        gisfp = da.array(gisfp).rechunk(chunksize)
+    else:
+        gissamps = np.asarray(gissamps)
     # waisfp = waisfp.rechunk(chunksize)
     # eaisfp = eaisfp.rechunk(chunksize)
 
@@ -64,18 +214,7 @@ def FittedISMIP_postprocess_icesheet(
     # Add up the east and west components for AIS total
     # aissl = waissl + eaissl
 
-    # Define the missing value for the netCDF files
-    nc_missing_value = np.nan  # np.iinfo(np.int16).min
-
     # Create the xarray data structures for the localized projections
-    ncvar_attributes = {
-        "description": "Local SLR contributions from icesheet according to Fitted ISMIP workflow",
-        "history": "Created " + time.ctime(time.time()),
-        "source": "SLR Framework: Fitted ISMIP workflow",
-        "scenario": scenario,
-        "baseyear": baseyear,
-    }
-
     gis_out = xr.Dataset(
         {
             "sea_level_change": (
@@ -94,33 +233,8 @@ def FittedISMIP_postprocess_icesheet(
         attrs=ncvar_attributes,
     )
 
-    # wais_out = xr.Dataset({"sea_level_change": (("samples", "years", "locations"), waissl, {"units":"mm", "missing_value":nc_missing_value}),
-    # "lat": (("locations"), site_lats),
-    # "lon": (("locations"), site_lons)},
-    # coords={"years": targyears, "locations": site_ids, "samples": np.arange(nsamps)}, attrs=ncvar_attributes)
-
-    # eais_out = xr.Dataset({"sea_level_change": (("samples", "years", "locations"), eaissl, {"units":"mm", "missing_value":nc_missing_value}),
-    # "lat": (("locations"), site_lats),
-    # "lon": (("locations"), site_lons)},
-    # coords={"years": targyears, "locations": site_ids, "samples": np.arange(nsamps)}, attrs=ncvar_attributes)
-
-    # ais_out = xr.Dataset({"sea_level_change": (("samples", "years", "locations"), aissl, {"units":"mm", "missing_value":nc_missing_value}),
-    # "lat": (("locations"), site_lats),
-    # "lon": (("locations"), site_lons)},
-    # coords={"years": targyears, "locations": site_ids, "samples": np.arange(nsamps)}, attrs=ncvar_attributes)
-
     # Write the netcdf output files
-    gis_out.to_netcdf(
-        gris_local_out_file,
-        encoding={
-            "sea_level_change": {
-                "dtype": "f4",
-                "zlib": True,
-                "complevel": 4,
-                "_FillValue": nc_missing_value,
-            }
-        },
-    )
+    WriteDataset(gis_out, gris_local_out_file, {"sea_level_change": profile})
     # wais_out.to_netcdf("{0}_{1}_localsl.nc".format(pipeline_id, "WAIS"), encoding={"sea_level_change": {"dtype": "f4", "zlib": True, "complevel":4, "_FillValue": nc_missing_value}})
     # eais_out.to_netcdf("{0}_{1}_localsl.nc".format(pipeline_id, "EAIS"), encoding={"sea_level_change": {"dtype": "f4", "zlib": True, "complevel":4, "_FillValue": nc_missing_value}})
     # ais_out.to_netcdf("{0}_{1}_localsl.nc".format(pipeline_id, "AIS"), encoding={"sea_level_change": {"dtype": "f4", "zlib": True, "complevel":4, "_FillValue": nc_missing_value}})
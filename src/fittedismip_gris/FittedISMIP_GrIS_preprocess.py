@@ -2,6 +2,8 @@ import argparse
 from fittedismip_gris.import_temp_data import import_temp_data
 from fittedismip_gris.filter_temp_data import filter_temp_data
 from fittedismip_gris.Import2lmData import Import2lmData
+from fittedismip_gris.metadata_table import MetadataTable
+from fittedismip_gris.temperature_cache import CachedImport2lmData, DEFAULT_CACHE_SIZE
 
 """ FittedISMIP_preprocess_icesheet.py
 
@@ -9,6 +11,15 @@ Preprocess data for use in the FittedISMIP icesheet module.
 
 Parameters:
 scenario - Emissions scenario of interest
+years - Years needed by the projection stage [default = all years]
+nsamps - Number of temperature trajectories needed [default = all trajectories]
+baseyear - Base year to zero cached temperature data to
+cache_dir - Directory of the preprocessed temperature cache [default = no cache]
+cache_size - Size limit of the temperature cache in MB
+tlim_index - Index of temperature target samples (see tlim_index.py) [default = build it]
+forcing_file - Climate forcing CSV file, used when tlm_flag = 0
+forcing_table - MetadataTable of the climate forcing, to reuse across scenarios
+                [default = read forcing_file]
 
 Note: 'pipeline_id' is a unique identifier that distinguishes it among other instances
 of this module within the same workflow.
@@ -16,16 +27,52 @@ of this module within the same workflow.
 """
 
 
-def FittedISMIP_preprocess_icesheet(scenario, tlm_flag, pipeline_id, climate_file):
-    """This function only works with tlm_flag = 1 currently. In this case, it loads FAIR output (climate.nc) instead of the 2 layer ssp h5 file."""
+def FittedISMIP_preprocess_icesheet(
+    scenario,
+    tlm_flag,
+    pipeline_id,
+    climate_file,
+    years=None,
+    nsamps=None,
+    baseyear=None,
+    cache_dir=None,
+    cache_size=DEFAULT_CACHE_SIZE,
+    tlim_index=None,
+    forcing_file="./data/input/20201009_CLIMATE_FORCING.csv",
+    forcing_table=None,
+):
+    """This function only works with tlm_flag = 1 currently. In this case, it loads FAIR output (climate.nc) instead of the 2 layer ssp h5 file.
+
+    climate_file may be a file name or an open h5py.File, which is left open so it can be
+    reused for other scenarios. When given, only the years and the first nsamps
+    trajectories needed by the projection are read from climate_file.
+
+    With cache_dir, the two-layer model data are kept in a memory-mapped cache (see
+    temperature_cache.py), re-zeroed to baseyear if given."""
     # Load the two-layer model data?
     if tlm_flag != 0:
         # Load the data
-        tlm_dict = Import2lmData(
-            variable="surface_temperature",
-            scenario=scenario,
-            climate_file=climate_file,
-        )
+        if cache_dir is not None:
+            tlm_dict = CachedImport2lmData(
+                cache_dir,
+                climate_file,
+                variable="surface_temperature",
+                scenario=scenario,
+                years=years,
+                nsamps=nsamps,
+                baseyear=baseyear,
+                max_size=cache_size,
+                tlim_index=tlim_index,
+            )
+        else:
+            tlm_dict = Import2lmData(
+                variable="surface_temperature",
+                scenario=scenario,
+                climate_file=climate_file,
+                years=years,
+                nsamps=nsamps,
+                tlim_index=tlim_index,
+            )
         # Filter the data if necessary
 
         # Extract the pertinent fields to pass on to other stages
@@ -33,13 +80,13 @@ def FittedISMIP_preprocess_icesheet(scenario, tlm_flag, pipeline_id, climate_fil
         temp_data = tlm_dict["samples"]
 
     else:
-        # Temperature file name. Keeping commmented out line bc not sure how the program accesses that file.
-        # tempfile = os.path.join(os.path.dirname(__file__), "20201009_CLIMATE_FORCING.csv")
-        tempfile = "./data/input/20201009_CLIMATE_FORCING.csv"
         # Load and filter the temperature data for this scenario
-        temp_dict = import_temp_data(tempfile)
+        if forcing_table is None:
+            forcing_table = MetadataTable(
+                import_temp_data(forcing_file, cache_dir=cache_dir)
+            )
         filtered_temp_data = filter_temp_data(
-            temp_dict, years=temp_dict["years"], scenario=scenario.upper()
+            forcing_table, years=forcing_table.years, scenario=scenario.upper()
         )
 
         # Extract the pertinent fields
@@ -49,6 +96,10 @@ def FittedISMIP_preprocess_icesheet(scenario, tlm_flag, pipeline_id, climate_fil
     # Put preprocess data in dictionary
     output = {"years": years, "temp_data": temp_data, "scenario": scenario}
 
+    # Record that the temperature data are already zeroed to the base year
+    if tlm_flag != 0 and "baseyear" in tlm_dict:
+        output["baseyear"] = tlm_dict["baseyear"]
+
     return output
 
 
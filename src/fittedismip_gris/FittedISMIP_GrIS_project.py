@@ -4,8 +4,34 @@ import sys
 import os
 from netCDF4 import Dataset
 import time
+import functools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import xarray as xr
 from scipy.stats import truncnorm
+from fittedismip_gris.sampling import (
+    ADAPTIVE_ATTRIBUTES,
+    QMC_METHODS,
+    SAMPLING_METHODS,
+    AdaptiveAttributes,
+    AdaptiveSampleBlocks,
+    AdaptiveYearIndices,
+    DrawSampleParameters,
+    ModelStrata,
+    ShardSize,
+)
+from fittedismip_gris.encoding import (
+    CheckPackedRange,
+    NetCDF4VariableArgs,
+    ParseEncodingProfile,
+    ProfileString,
+)
+from fittedismip_gris.output_store import (
+    AppendZarr,
+    ConsolidateZarr,
+    IsZarrPath,
+    WriteDataset,
+)
 
 """ FittedISMIP_project_icesheet.py
 
@@ -18,15 +44,44 @@ pyear_end			Projection end year
 pyear_step			Stepping from projection year start to end
 rngseed             Seed for the random number generator
 pipeline_id         Unique identifier to attach to this pipeline
+engine              Sample generation engine. "batch" evaluates all samples at once,
+                    "scalar" loops over samples with my_model() (reference mode)
+workers             Number of processes for sharded sampling. None draws all samples
+                    from a single random stream in this process.
+shard_size          Number of samples per shard. Each shard gets its own random stream
+                    spawned from rngseed, so results do not depend on workers. The
+                    parameters of lhs and sobol sampling are drawn once for all shards.
+                    [default = 10000, or 8192 with sobol sampling]
+block_size          Number of samples to generate at a time. When set, each block is
+                    appended to the global output file as it is generated and the
+                    postprocess stage reads the samples back lazily. With workers, the
+                    blocks are the shards.
+global_encoding     Encoding profile of the global output file (see encoding.py)
+gris_global_out_file  Global output file. Names ending in .zarr are written as Zarr
+                    stores (see output_store.py).
+sampling            Sampling strategy: random, lhs, sobol or stratified (see sampling.py)
+adaptive            Generate samples in batches of adaptive_batch (or shards, with
+                    workers) and stop once the adaptive_quantiles of the samples at
+                    adaptive_years [default = 2100, or the last year] change by less than
+                    adaptive_tol mm from one batch to the next. nsamps is the cap. The
+                    batches do not depend on block_size. The sample count and convergence
+                    trace are written to the output attributes.
 
 Note: 'pipeline_id' is a unique identifier that distinguishes it among other instances
 of this module within the same workflow.
 
 """
 
+# Ice sources that are projected. Only their parameters are read from the fit output.
+PROJECTED_ICE_SOURCES = ("GIS",)
+
 
 def make_projection_ds(icesamps, icetype, data_years, scenario, pipeline_id, baseyear):
-    data = np.asarray(icesamps)[:, :, np.newaxis]
+    # Dask-backed samples stay lazy, so that they are written block by block
+    if hasattr(icesamps, "chunks"):
+        data = icesamps[:, :, np.newaxis]
+    else:
+        data = np.asarray(icesamps)[:, :, np.newaxis]
     ds = xr.Dataset(
         data_vars={
             "sea_level_change": (
@@ -79,11 +134,39 @@ def FittedISMIP_project_icesheet(
     pipeline_id,
     rngseed,
     gris_global_out_file,
+    engine="batch",
+    workers=None,
+    shard_size=None,
+    block_size=None,
+    global_encoding="f8",
+    sampling="random",
+    adaptive=False,
+    adaptive_batch=1000,
+    adaptive_quantiles=(0.05, 0.5, 0.95),
+    adaptive_years=None,
+    adaptive_tol=1.0,
 ):
+    if engine not in ("batch", "scalar"):
+        raise ValueError(f"Unknown projection engine: {engine}")
+    if workers is not None and engine != "batch":
+        raise ValueError("Sharded sampling requires the batch projection engine")
+    if block_size is not None and engine != "batch":
+        raise ValueError("Streaming samples requires the batch projection engine")
+    if sampling not in SAMPLING_METHODS:
+        raise ValueError(f"Unknown sampling method: {sampling}")
+    if sampling != "random" and engine != "batch":
+        raise ValueError("Sampling methods other than random require the batch engine")
+    if adaptive and engine != "batch":
+        raise ValueError("Adaptive sampling requires the batch projection engine")
+    profile = ParseEncodingProfile(global_encoding)
+    shard_size = ShardSize(shard_size, sampling)
+
     years = preprocess_dict["years"]
     temp_data = preprocess_dict["temp_data"]
     scenario = preprocess_dict["scenario"]
 
+    groups_dict = fit_dict["groups_dict"]
+    models_dict = fit_dict["models_dict"]
     betas_dict = fit_dict["betas_dict"]
     sigmas_dict = fit_dict["sigmas_dict"]
     trend_mean = fit_dict["trend_mean"]
@@ -103,7 +186,8 @@ def FittedISMIP_project_icesheet(
         raise ValueError(
             "baseyear is not found in temperature data. baseyear = {}".format(baseyear)
         )
-    temp_data = temp_data - temp_data[:, baseyear_idx]
+    if preprocess_dict.get("baseyear") != baseyear:
+        temp_data = temp_data - temp_data[:, baseyear_idx]
 
     # Set the seed for the
 
@@ -112,77 +196,166 @@ def FittedISMIP_project_icesheet(
     # Initialize the samples dictionary to pass to the post-processing stage
     samps_dict = {}
 
+    # Convergence of the adaptive sample count
+    adaptive_trace = []
+
     # Generate the indices for the temperature samples
+    if temp_data.shape[0] < nsamps:
+        raise ValueError(
+            f"Requested {nsamps} samples but only {temp_data.shape[0]} temperature samples are available"
+        )
     temp_sample_idx = np.arange(nsamps)
 
-    # Generate a list of quantiles for the trend samples
-    trend_q = rng.random(nsamps)
-
     # Loop over the ice sources
-    for icesource in ["GIS"]:
-        # Calculate the trend contributions over time for this ice sheet component
-        ice_trend = (
-            truncnorm.ppf(
-                trend_q,
-                a=0.0,
-                b=99999.9,
-                loc=trend_mean[icesource],
-                scale=trend_sd[icesource],
-            )[:, np.newaxis]
-            * (targyears - baseyear)[np.newaxis, :]
-        )
-
+    for icesource in PROJECTED_ICE_SOURCES:
         # Which model parameters do we need
         betas = betas_dict[icesource]
         sigmas = sigmas_dict[icesource]
 
-        # Generate the indices for the model samples
-        model_sample_idx = rng.choice(np.arange(betas.shape[0]), nsamps)
-
-        # Loop over the number of samples we need
-        samps = []
+        if engine == "scalar":
+            # Generate a list of quantiles for the trend samples
+            trend_q = rng.random(nsamps)
+
+            # Calculate the trend contributions over time for this ice sheet component
+            ice_trend = (
+                truncnorm.ppf(
+                    trend_q,
+                    a=0.0,
+                    b=99999.9,
+                    loc=trend_mean[icesource],
+                    scale=trend_sd[icesource],
+                )[:, np.newaxis]
+                * (targyears - baseyear)[np.newaxis, :]
+            )
 
-        for tidx, midx in zip(temp_sample_idx, model_sample_idx):
-            # Generate a sample
-            (this_sample, _, _, _) = my_model(
-                temp_data[tidx, datayr_idx],
-                betas[midx, :],
-                sigmas[midx],
-                targyears - baseyear,
+            # Generate the indices for the model samples
+            model_sample_idx = rng.choice(np.arange(betas.shape[0]), nsamps)
+
+            # Loop over the number of samples we need
+            samps = []
+
+            for tidx, midx in zip(temp_sample_idx, model_sample_idx):
+                # Generate a sample
+                (this_sample, _, _, _) = my_model(
+                    temp_data[tidx, datayr_idx],
+                    betas[midx, :],
+                    sigmas[midx],
+                    targyears - baseyear,
+                    pyear_step,
+                    rng,
+                )
+                samps.append(this_sample)
+
+            # Convert the sample array into a numpy array
+            samps = np.array(samps)
+
+            # Add the trend to the samples
+            samps = samps + ice_trend
+
+            # If the user wants to extrapolate projections based on rates, do so here
+            if cyear_start or cyear_end:
+                for i in np.arange(nsamps):
+                    samps[i, :] = ExtrapolateRate(
+                        samps[i, :], targyears, cyear_start, cyear_end
+                    )
+
+        else:
+            # Arguments shared by every block of samples
+            project_args = (
+                betas,
+                trend_mean[icesource],
+                trend_sd[icesource],
+                targyears,
+                baseyear,
                 pyear_step,
-                rng,
+                cyear_start,
+                cyear_end,
             )
-            samps.append(this_sample)
 
-        # Convert the sample array into a numpy array
-        samps = np.array(samps)
+            # How to draw the random parameters of the samples
+            strata = None
+            if sampling == "stratified":
+                strata = ModelStrata(groups_dict[icesource], models_dict[icesource])
+            draw_args = (sigmas, sampling, strata)
+
+            # Number of samples in each generated block. Adaptive sampling checks for
+            # convergence every adaptive_batch samples, whatever the block size.
+            gen_block_size = block_size
+            if adaptive and workers is None:
+                gen_block_size = block_size or adaptive_batch
+            chunk_samples = gen_block_size if workers is None else shard_size
+
+            # Generate the samples block by block
+            sample_blocks = IterSampleBlocks(
+                temp_data[:nsamps],
+                datayr_idx,
+                draw_args,
+                project_args,
+                rng,
+                rngseed=rngseed,
+                workers=workers,
+                shard_size=shard_size,
+                block_size=gen_block_size,
+            )
 
-        # Add the trend to the samples
-        samps = samps + ice_trend
+            # Stop generating samples once the requested quantiles converge
+            if adaptive:
+                sample_blocks = AdaptiveSampleBlocks(
+                    sample_blocks,
+                    AdaptiveYearIndices(targyears, adaptive_years),
+                    adaptive_quantiles,
+                    adaptive_tol,
+                    adaptive_trace,
+                    batch_size=adaptive_batch if workers is None else None,
+                )
 
-        # If the user wants to extrapolate projections based on rates, do so here
-        if cyear_start or cyear_end:
-            for i in np.arange(nsamps):
-                samps[i, :] = ExtrapolateRate(
-                    samps[i, :], targyears, cyear_start, cyear_end
+            if block_size is not None:
+                # Stream the blocks into the global output file and read them back lazily
+                stream_global = (
+                    StreamGlobalZarr
+                    if IsZarrPath(gris_global_out_file)
+                    else StreamGlobalNetCDF
                 )
+                stream_global(
+                    sample_blocks,
+                    gris_global_out_file,
+                    icesource,
+                    targyears[targyear_idx],
+                    scenario,
+                    pipeline_id,
+                    baseyear,
+                    chunk_samples,
+                    profile,
+                    functools.partial(AdaptiveAttributes, adaptive_trace),
+                )
+                samps_dict[icesource] = OpenGlobalSamples(
+                    gris_global_out_file, chunk_samples
+                )
+                continue
+
+            samps = np.concatenate(list(sample_blocks), axis=0)
 
         # Add the total samples to the samples dictionary
         samps_dict[icesource] = samps
 
-        make_projection_ds(
-            samps, icesource, targyears[targyear_idx], scenario, pipeline_id, baseyear
-        )
         # Write the global projections to output netCDF files
-        gris_ds = make_projection_ds(
-            samps,
-            icesource,
-            targyears[targyear_idx],
-            scenario,
-            pipeline_id,
-            baseyear,
-        )
-        gris_ds.to_netcdf(gris_global_out_file)
+        if gris_global_out_file is not None:
+            gris_ds = make_projection_ds(
+                samps,
+                icesource,
+                targyears[targyear_idx],
+                scenario,
+                pipeline_id,
+                baseyear,
+            )
+            gris_ds.attrs["encoding_profile"] = ProfileString(profile)
+            gris_ds.attrs.update(AdaptiveAttributes(adaptive_trace))
+            CheckPackedRange(profile, np.nanmin(samps), np.nanmax(samps))
+            WriteDataset(gris_ds, gris_global_out_file, {"sea_level_change": profile})
+
+    # Number of samples actually generated
+    if adaptive_trace:
+        nsamps = adaptive_trace[-1]["nsamps"]
 
     # Store the variables in a pickle
     output = {
@@ -190,11 +363,328 @@ def FittedISMIP_project_icesheet(
         "scenario": scenario,
         "targyears": targyears[targyear_idx],
         "baseyear": baseyear,
+        "nsamps": nsamps,
+        "attrs": AdaptiveAttributes(adaptive_trace),
     }
 
     return output
 
 
+def ProjectSamples(
+    temp,
+    params,
+    betas,
+    trend_mean,
+    trend_sd,
+    targyears,
+    baseyear,
+    pyear_step,
+    cyear_start,
+    cyear_end,
+):
+    """Generates projections for the [samples, years] temperature array temp with the
+    batch engine, given the sample parameters from DrawSampleParameters()."""
+    (trend_q, model_sample_idx, pct_error) = params
+
+    # Calculate the trend contributions over time
+    ice_trend = (
+        truncnorm.ppf(trend_q, a=0.0, b=99999.9, loc=trend_mean, scale=trend_sd)[
+            :, np.newaxis
+        ]
+        * (targyears - baseyear)[np.newaxis, :]
+    )
+
+    # Generate the samples
+    (samps, _, _, _) = my_model_batch(
+        temp,
+        betas[model_sample_idx, :],
+        pct_error,
+        targyears - baseyear,
+        pyear_step,
+    )
+
+    # Add the trend to the samples
+    samps += ice_trend
+
+    # If the user wants to extrapolate projections based on rates, do so here
+    if cyear_start or cyear_end:
+        samps = ExtrapolateRateBatch(samps, targyears, cyear_start, cyear_end)
+
+    return samps
+
+
+def ProjectShard(temp, draw_args, project_args, seed, params=None):
+    # Generate the samples for one shard from its own random stream, unless its
+    # parameters are given
+    if params is None:
+        rng = np.random.default_rng(seed)
+        params = DrawSampleParameters(temp.shape[0], draw_args[0], rng, *draw_args[1:])
+    return ProjectSamples(temp, params, *project_args)
+
+
+def IterSampleBlocks(
+    temp,
+    datayr_idx,
+    draw_args,
+    project_args,
+    rng,
+    rngseed=None,
+    workers=None,
+    shard_size=None,
+    block_size=None,
+):
+    """Yields the projection samples in consecutive blocks of rows. draw_args holds
+    the model sigmas, the sampling method and the model strata (see sampling.py).
+
+    Without workers, the parameters of all samples are drawn from rng up front (a few
+    numbers per sample) and the projections are computed block_size samples at a time,
+    so the result does not depend on block_size.
+
+    With workers, the samples are split into shards of shard_size. Each shard gets an
+    independent random stream spawned from rngseed and the shards are computed in a
+    process pool. The shards are fixed by shard_size alone, so the result is the same
+    for any number of workers. At most two shards per worker are held in memory. The
+    quasi-random parameters of the lhs and sobol methods are drawn from rng for all
+    samples instead, as without workers, and each shard gets its slice of them.
+    """
+    nsamps = temp.shape[0]
+
+    if workers is None:
+        params = DrawSampleParameters(nsamps, draw_args[0], rng, *draw_args[1:])
+        block_size = block_size or max(nsamps, 1)
+        for i in range(0, nsamps, block_size):
+            block = slice(i, i + block_size)
+            yield ProjectSamples(
+                temp[block][:, datayr_idx],
+                tuple(x[block] for x in params),
+                *project_args,
+            )
+        return
+
+    shard_size = ShardSize(shard_size, draw_args[1])
+    shard_starts = range(0, nsamps, shard_size)
+    shard_seeds = np.random.SeedSequence(rngseed).spawn(len(shard_starts))
+
+    # Quasi-random parameters are drawn once and sliced, so the shards together keep the
+    # balance of the quasi-random set
+    shard_params = [None] * len(shard_starts)
+    if draw_args[1] in QMC_METHODS:
+        params = DrawSampleParameters(nsamps, draw_args[0], rng, *draw_args[1:])
+        shard_params = [
+            tuple(x[i : i + shard_size] for x in params) for i in shard_starts
+        ]
+
+    # Run the shards in this process if only one worker is requested
+    if workers <= 1:
+        for i, seed, these_params in zip(shard_starts, shard_seeds, shard_params):
+            yield ProjectShard(
+                temp[i : i + shard_size][:, datayr_idx],
+                draw_args,
+                project_args,
+                seed,
+                these_params,
+            )
+        return
+
+    # Otherwise keep a bounded number of shards in flight in a process pool
+    executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        pending = deque()
+        for i, seed, these_params in zip(shard_starts, shard_seeds, shard_params):
+            pending.append(
+                executor.submit(
+                    ProjectShard,
+                    temp[i : i + shard_size][:, datayr_idx],
+                    draw_args,
+                    project_args,
+                    seed,
+                    these_params,
+                )
+            )
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def StreamGlobalNetCDF(
+    sample_blocks,
+    nc_filename,
+    icetype,
+    data_years,
+    scenario,
+    pipeline_id,
+    baseyear,
+    chunk_samples,
+    profile,
+    final_attrs=None,
+):
+    """Writes blocks of global samples to a netCDF file with the encoding profile,
+    appending each block along the unlimited samples dimension. final_attrs is an
+    optional function returning attributes to write after the last block, for attributes
+    that depend on the samples. Returns the number of samples written."""
+    if nc_filename is None:
+        raise ValueError("Streaming samples requires a global output file")
+
+    rootgrp = Dataset(nc_filename, "w", format="NETCDF4")
+    try:
+        # Define Dimensions
+        rootgrp.createDimension("samples", None)
+        rootgrp.createDimension("years", len(data_years))
+        rootgrp.createDimension("locations", 1)
+
+        # Populate dimension variables
+        year_var = rootgrp.createVariable("years", "i8", ("years",))
+        samp_var = rootgrp.createVariable("samples", "i8", ("samples",))
+        loc_var = rootgrp.createVariable("locations", "i8", ("locations",))
+        lat_var = rootgrp.createVariable(
+            "lat", "f4", ("locations",), fill_value=np.float32(np.nan)
+        )
+        lon_var = rootgrp.createVariable(
+            "lon", "f4", ("locations",), fill_value=np.float32(np.nan)
+        )
+
+        # Create a data variable, chunked by block along the samples dimension unless
+        # the profile says otherwise
+        (var_kwargs, var_attrs) = NetCDF4VariableArgs(
+            profile,
+            (chunk_samples, len(data_years), 1),
+            default_chunks=(max(1, chunk_samples), len(data_years), 1),
+        )
+        samps = rootgrp.createVariable(
+            "sea_level_change",
+            dimensions=("samples", "years", "locations"),
+            **var_kwargs,
+        )
+        samps.setncatts(var_attrs)
+
+        # Assign attributes
+        rootgrp.description = f"Global SLR contribution from {icetype} according to FittedISMIP-gris module workflow"
+        rootgrp.history = "Created " + time.ctime(time.time())
+        rootgrp.scenario = scenario
+        rootgrp.baseyear = baseyear
+        rootgrp.encoding_profile = ProfileString(profile)
+        samps.units = "mm"
+
+        # Put the data into the netcdf variables
+        year_var[:] = data_years
+        lat_var[:] = np.inf
+        lon_var[:] = np.inf
+        loc_var[:] = -1
+
+        # Append the sample blocks as they are generated
+        nsamps = 0
+        for block in sample_blocks:
+            CheckPackedRange(profile, np.nanmin(block), np.nanmax(block))
+            samps[nsamps : nsamps + block.shape[0], :, :] = block[:, :, np.newaxis]
+            samp_var[nsamps : nsamps + block.shape[0]] = np.arange(
+                nsamps, nsamps + block.shape[0]
+            )
+            nsamps += block.shape[0]
+
+        # Attributes that depend on the samples
+        if final_attrs is not None:
+            rootgrp.setncatts(final_attrs())
+    finally:
+        rootgrp.close()
+
+    return nsamps
+
+
+def StreamGlobalZarr(
+    sample_blocks,
+    zarr_filename,
+    icetype,
+    data_years,
+    scenario,
+    pipeline_id,
+    baseyear,
+    chunk_samples,
+    profile,
+    final_attrs=None,
+):
+    """Writes blocks of global samples to a Zarr store like StreamGlobalNetCDF(),
+    appending each block along the samples dimension, and consolidates the metadata
+    after the last block. Returns the number of samples written."""
+    nsamps = 0
+    for block in sample_blocks:
+        CheckPackedRange(profile, np.nanmin(block), np.nanmax(block))
+        block_ds = make_projection_ds(
+            block, icetype, data_years, scenario, pipeline_id, baseyear
+        )
+        block_ds = block_ds.assign_coords(
+            samples=np.arange(nsamps, nsamps + block.shape[0])
+        )
+        block_ds.attrs["encoding_profile"] = ProfileString(profile)
+
+        # The first block creates the store, chunked by block along the samples
+        # dimension unless the profile says otherwise
+        profiles = None
+        if nsamps == 0:
+            chunks = profile["chunks"] or (max(1, chunk_samples), -1, -1)
+            profiles = {"sea_level_change": dict(profile, chunks=chunks)}
+        AppendZarr(block_ds, zarr_filename, profiles, "samples")
+        nsamps += block.shape[0]
+
+    # Attributes that depend on the samples
+    ConsolidateZarr(zarr_filename, None if final_attrs is None else final_attrs())
+
+    return nsamps
+
+
+def OpenGlobalSamples(nc_filename, block_size=None):
+    """Lazily opens the global samples [samples, years] in nc_filename as a dask array
+    with one chunk per block_size samples."""
+    ds = xr.open_dataset(
+        nc_filename, chunks={"samples": block_size or -1, "years": -1, "locations": -1}
+    )
+    return ds["sea_level_change"].isel(locations=0).data
+
+
+def LoadProjection(global_file, block_size=None):
+    """Returns the output dictionary of FittedISMIP_project_icesheet() for the samples
+    in the global output file global_file, read lazily with one chunk per block_size
+    samples."""
+    with xr.open_dataset(global_file) as ds:
+        scenario = ds.attrs["scenario"]
+        baseyear = ds.attrs["baseyear"]
+        targyears = ds["years"].values
+        attrs = {x: ds.attrs[x] for x in ADAPTIVE_ATTRIBUTES if x in ds.attrs}
+    samps = OpenGlobalSamples(global_file, block_size)
+
+    return {
+        "samps_dict": {"GIS": samps},
+        "scenario": scenario,
+        "targyears": targyears,
+        "baseyear": baseyear,
+        "nsamps": samps.shape[0],
+        "attrs": attrs,
+    }
+
+
+def WriteProjection(project_dict, global_file, pipeline_id, global_encoding="f8"):
+    """Writes the global samples of an output dictionary of
+    FittedISMIP_project_icesheet() or LoadProjection() to global_file with the encoding
+    profile global_encoding."""
+    profile = ParseEncodingProfile(global_encoding)
+    samps = project_dict["samps_dict"]["GIS"]
+    gris_ds = make_projection_ds(
+        samps,
+        "GIS",
+        project_dict["targyears"],
+        project_dict["scenario"],
+        pipeline_id,
+        project_dict["baseyear"],
+    )
+    gris_ds.attrs["encoding_profile"] = ProfileString(profile)
+    gris_ds.attrs.update(project_dict["attrs"])
+    if profile["dtype"] == "i2":
+        CheckPackedRange(profile, float(np.nanmin(samps)), float(np.nanmax(samps)))
+    WriteDataset(gris_ds, global_file, {"sea_level_change": profile})
+
+
 def ExtrapolateRate(sample, targyears, cyear_start, cyear_end):
     # If only one of the constant rate years is provided, imply the other
     if cyear_start and not cyear_end:
@@ -248,6 +738,94 @@ def my_model(temp, beta, sigma, dyears, delta_time, rng):
     return (sle_hat, sle_hat_temp, sle_hat_time, sle_hat_const)
 
 
+def ExtrapolateRateBatch(samps, targyears, cyear_start, cyear_end):
+    """Vectorized ExtrapolateRate() over a [samples, years] array. Results are
+    identical to calling ExtrapolateRate() on each row. The array is modified in place."""
+    # If only one of the constant rate years is provided, imply the other
+    if cyear_start and not cyear_end:
+        cyear_end = cyear_start + 20
+    if cyear_end and not cyear_start:
+        cyear_start = cyear_end - 20
+
+    # Find the start and end projection values for the rate calculation
+    proj_start = InterpColumns(cyear_start, targyears, samps)
+    proj_end = InterpColumns(cyear_end, targyears, samps)
+
+    # Calculate the rate
+    rate = (proj_end - proj_start) / (cyear_end - cyear_start)
+
+    # Make the new projections
+    ext_idx = targyears >= cyear_end
+    samps[:, ext_idx] = proj_end[:, np.newaxis] + (
+        rate[:, np.newaxis] * (targyears[ext_idx] - cyear_end)[np.newaxis, :]
+    )
+
+    return samps
+
+
+def InterpColumns(x, xp, fp):
+    """Evaluate np.interp(x, xp, fp[i, :]) for every row i of fp at a single point x.
+
+    Follows the same arithmetic as numpy's interp so the results are bit-identical.
+    """
+    xp = np.asarray(xp, dtype=np.float64)
+    x = np.float64(x)
+
+    # Points outside the range take the end values
+    if x <= xp[0]:
+        return fp[:, 0].copy()
+    if x >= xp[-1]:
+        return fp[:, -1].copy()
+
+    # Index of the interval that contains x
+    j = np.searchsorted(xp, x, side="right") - 1
+    if xp[j] == x:
+        return fp[:, j].copy()
+
+    # Linear interpolation, retrying from the other end of the interval if we get nan
+    slope = (fp[:, j + 1] - fp[:, j]) / (xp[j + 1] - xp[j])
+    out = slope * (x - xp[j]) + fp[:, j]
+    bad = np.isnan(out)
+    if np.any(bad):
+        out[bad] = slope[bad] * (x - xp[j + 1]) + fp[bad, j + 1]
+        flat = bad & np.isnan(out) & (fp[:, j] == fp[:, j + 1])
+        out[flat] = fp[flat, j]
+
+    return out
+
+
+def my_model_batch(temp, betas, pct_error, dyears, delta_time):
+    """Vectorized my_model() over a [samples, years] temperature array, with one row of
+    betas and one fit error (drawn as in my_model()) per sample. The results are
+    bit-identical to calling my_model() on each row. temp is modified in place."""
+    # If the last temperature value is nan, replace it with a linear extrapolation
+    nan_idx = np.isnan(temp[:, -1])
+    temp[nan_idx, -1] = temp[nan_idx, -2] + (temp[nan_idx, -2] - temp[nan_idx, -3])
+
+    # Produce projections for these temperature trajectories
+    # NOTE - The fitted rates are per year, so multiply by delta_time (pyear_step)
+    # to produce the sample.
+    dsle_hat_const = np.broadcast_to(betas[:, [0]] * delta_time, temp.shape)
+    dsle_hat_temp = (
+        betas[:, [1]] * temp + betas[:, [2]] * temp**2 + betas[:, [3]] * temp**3
+    ) * delta_time
+    dsle_hat_time = (
+        betas[:, [4]] * dyears[np.newaxis, :]
+        + betas[:, [5]] * dyears[np.newaxis, :] ** 2
+    ) * delta_time
+
+    # Sum up the individual changes over time
+    sle_hat_const = np.cumsum(dsle_hat_const, axis=1)
+    sle_hat_temp = np.cumsum(dsle_hat_temp, axis=1)
+    sle_hat_time = np.cumsum(dsle_hat_time, axis=1)
+    sle_hat = sle_hat_temp + sle_hat_time + sle_hat_const
+
+    # Apply the error from the fit to these projections
+    sle_hat *= 1 + pct_error[:, np.newaxis]
+
+    return (sle_hat, sle_hat_temp, sle_hat_time, sle_hat_const)
+
+
 def WriteNetCDF(icesamps, icetype, data_years, scenario, pipeline_id, baseyear):
     # Write the total global projections to a netcdf file
     nc_filename = os.path.join(
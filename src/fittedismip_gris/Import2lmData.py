@@ -63,97 +63,205 @@ def Import2lmData(
     twinyear_start=2020,
     twinyear_end=2100,
     climate_file="twolayer_SSPs.h5",
+    years=None,
+    nsamps=None,
+    tlim_index=None,
 ):
-    # Open the SSP hdf5 file
+    """years and nsamps limit what is read from the file: only the reference period and
+    the requested years of the first nsamps (matching) samples are read. The returned
+    years are then the requested years found in the file. By default, every year and
+    sample is returned.
+
+    tlim_index is the index of window maxima from BuildTlimIndex() for this file and
+    temperature window. It is built on the fly for temperature target scenarios if not
+    given."""
+    # Open the SSP hdf5 file, unless we were handed an already open file
     # sspfile = os.path.join(directory, climate_file)
     # hf = h5py.File(sspfile, "r")
-    hf = h5py.File(climate_file, "r")
-
-    # Do we have a temperature target scenario?
-    scenario_test = re.search("^tlim(\d*\.?\d+)win(\d*\.?\d+)$", scenario)
-    if scenario_test:
-        # Initialize samps array
-        samps = []
-        temp_samps = []
-
-        # Loop through all available scenarios
-        for this_scenario in hf.keys():
-            # Skip "year" in this_scenario
-            if this_scenario == "year":
-                continue
-
-            # Extract the samples
-            try:
-                these_samps = hf[this_scenario][variable][()]
-                these_temp_samps = hf[this_scenario]["surface_temperature"][()]
-            except ValueError:
-                raise Exception(
-                    "Cannot extract data for this combination: {} - {}".format(
-                        scenario, variable
-                    )
-                )
-
-            # Append these samples to the main samps array
-            samps.extend(these_samps.T)
-            temp_samps.extend(these_temp_samps.T)
-
-        # Make samps a numpy array
-        samps = np.array(samps).T
-        temp_samps = np.array(temp_samps).T
-
-        # Get the years from the shape of the samps array
-        years = np.arange(1750, 1750 + samps.shape[0])
-
-    # We have a standard SSP scenario
-    else:
+    close_file = not isinstance(climate_file, h5py.File)
+    hf = h5py.File(climate_file, "r") if close_file else climate_file
+
+    try:
+        # Do we have a temperature target scenario?
+        scenario_test = re.search("^tlim(\d*\.?\d+)win(\d*\.?\d+)$", scenario)
+        if scenario_test:
+            # Build the index of window maxima over all scenarios, unless we have one
+            if tlim_index is None:
+                tlim_index = BuildTlimIndex(hf, twinyear_start, twinyear_end)
+            elif (tlim_index["twinyear_start"], tlim_index["twinyear_end"]) != (
+                twinyear_start,
+                twinyear_end,
+            ):
+                raise ValueError("The tlim index was built for another window")
+            scenarios = list(tlim_index["scenarios"])
+        else:
+            scenarios = [scenario]
+
+        # Find the datasets to read from
         try:
-            samps = hf[scenario][variable][()]
-        except ValueError:
+            datasets = [hf[x][variable] for x in scenarios]
+        except (KeyError, ValueError):
             raise Exception(
                 "Cannot extract data for this combination: {} - {}".format(
                     scenario, variable
                 )
             )
-        years = np.arange(1750, 1750 + samps.shape[0])
 
-    # Calculate the reference period values (mean between refyear_start and refyear_end inclusive)
-    year_idx = np.flatnonzero(
-        np.logical_and(years >= refyear_start, years <= refyear_end)
-    )
-    ref_vals = np.mean(samps[year_idx, :], axis=0)[None, :]
-    samps = samps - ref_vals
+        # Get the years from the shape of the samps array
+        data_years = np.arange(1750, 1750 + datasets[0].shape[0])
+
+        # Columns of each scenario in the combined samples
+        widths = [x.shape[1] for x in datasets]
+        col_offsets = np.concatenate(([0], np.cumsum(widths)))
+
+        # If this is a temperature target scenario, filter for the samples within the
+        # target window over the years 2020 - 2100
+        if scenario_test:
+            # Extract the limit from the scenario string
+            temp_target = float(scenario_test.group(1))
+            temp_target_window = float(scenario_test.group(2))
+
+            # Get the sample indices that match the filter
+            match_idx = TlimMatches(
+                tlim_index,
+                temp_target - temp_target_window,
+                temp_target + temp_target_window,
+            )
+        else:
+            match_idx = np.arange(widths[0])
 
-    # If this is a temperature target scenario, filter for the samples within the target window
-    # over the years 2020 - 2100
-    if scenario_test:
-        # Extract the limit from the scenario string
-        temp_target = float(scenario_test.group(1))
-        temp_target_window = float(scenario_test.group(2))
+        # Only the first nsamps samples are needed
+        if nsamps is not None:
+            match_idx = match_idx[:nsamps]
 
-        # Get the year indices for years 2020 - 2100
-        window_years_idx = np.flatnonzero(
-            np.logical_and(years >= twinyear_start, years <= twinyear_end)
-        )
+        # Which years to return
+        year_idx = np.arange(data_years.size)
+        if years is not None:
+            year_idx = np.flatnonzero(np.isin(data_years, years))
 
-        # Get the sample indices that match the filter
-        samps_max = np.nanmax(temp_samps[window_years_idx, :], axis=0)
-        match_idx = np.logical_and(
-            samps_max >= temp_target - temp_target_window,
-            samps_max <= temp_target + temp_target_window,
+        # Reference period years (mean between refyear_start and refyear_end inclusive)
+        ref_idx = np.flatnonzero(
+            np.logical_and(data_years >= refyear_start, data_years <= refyear_end)
         )
 
-        # Subset samps for the samples that match the filter
-        samps = samps[:, match_idx]
-
-    # Close the input file
-    hf.close()
+        # Read the slabs of each scenario into preallocated arrays
+        samps = np.empty((year_idx.size, match_idx.size), dtype=datasets[0].dtype)
+        ref_vals = np.empty((1, match_idx.size), dtype=datasets[0].dtype)
+        for i, dataset in enumerate(datasets):
+            in_scenario = np.logical_and(
+                match_idx >= col_offsets[i], match_idx < col_offsets[i + 1]
+            )
+            if not np.any(in_scenario):
+                continue
+            cols = match_idx[in_scenario] - col_offsets[i]
+            if cols.size == cols[-1] + 1:
+                cols = slice(0, cols.size)
+            samps[:, in_scenario] = ReadSlab(dataset, year_idx, cols)
+            ref_vals[:, in_scenario] = np.mean(ReadSlab(dataset, ref_idx, cols), axis=0)
+
+    finally:
+        # Close the input file if we opened it
+        if close_file:
+            hf.close()
+
+    # Calculate the reference period values
+    samps = samps - ref_vals
 
     # Create the 2lm dictionary
-    out_dict = {"samples": samps.T, "years": years}
+    out_dict = {"samples": samps.T, "years": data_years[year_idx]}
 
     return out_dict
 
 
+"""
+BuildTlimIndex()
+
+Builds the index of temperature target samples for an open two-layer model file. Samples of
+all scenarios are numbered in file order. For each sample, the index holds the maximum
+surface temperature over the years twinyear_start - twinyear_end, and the samples are
+sorted by this maximum so that TlimMatches() is a range lookup.
+
+Returns a dictionary with the scenarios, the first sample number of each scenario
+("col_offsets", with the total number of samples last), the sorted window maxima
+("window_max"), the sample numbers in that order ("sample_idx") and the window years.
+
+"""
+
+
+def BuildTlimIndex(hf, twinyear_start=2020, twinyear_end=2100):
+    # Loop through all available scenarios. Skip "year" in this_scenario
+    scenarios = [x for x in hf.keys() if x != "year"]
+    temp_datasets = [hf[x]["surface_temperature"] for x in scenarios]
+
+    # Get the year indices for years 2020 - 2100
+    data_years = np.arange(1750, 1750 + temp_datasets[0].shape[0])
+    window_years_idx = np.flatnonzero(
+        np.logical_and(data_years >= twinyear_start, data_years <= twinyear_end)
+    )
+
+    # Maximum of each sample over the window, reading the window years only
+    samps_max = np.concatenate(
+        [
+            np.nanmax(ReadSlab(x, window_years_idx, slice(None)), axis=0)
+            for x in temp_datasets
+        ]
+    )
+
+    # Sort the samples by their maximum (NaN last)
+    order = np.argsort(samps_max, kind="stable")
+
+    return {
+        "scenarios": np.array(scenarios, dtype=str),
+        "col_offsets": np.concatenate(
+            ([0], np.cumsum([x.shape[1] for x in temp_datasets]))
+        ),
+        "window_max": samps_max[order],
+        "sample_idx": order,
+        "twinyear_start": twinyear_start,
+        "twinyear_end": twinyear_end,
+    }
+
+
+"""
+TlimMatches()
+
+Returns the sample numbers, in file order, of the samples in a BuildTlimIndex() index whose
+window maximum lies between tmin and tmax inclusive.
+
+"""
+
+
+def TlimMatches(tlim_index, tmin, tmax):
+    window_max = tlim_index["window_max"]
+    start = np.searchsorted(window_max, tmin, side="left")
+    stop = np.searchsorted(window_max, tmax, side="right")
+    return np.sort(tlim_index["sample_idx"][start:stop])
+
+
+"""
+ReadSlab()
+
+Reads the rows (year indices, increasing) and cols (a slice or increasing sample indices)
+of a [years, samples] HDF5 dataset. Contiguous rows are read as a single hyperslab.
+
+"""
+
+
+def ReadSlab(dataset, rows, cols):
+    if rows.size == 0:
+        return dataset[0:0, cols]
+    if rows[-1] - rows[0] + 1 == rows.size:
+        return dataset[rows[0] : rows[-1] + 1, cols]
+    if isinstance(cols, slice):
+        return dataset[rows, cols]
+
+    # h5py allows a single list index, so read one year at a time
+    out = np.empty((rows.size, cols.size), dtype=dataset.dtype)
+    for i, row in enumerate(rows):
+        out[i, :] = dataset[row, cols]
+    return out
+
+
 """
 Filter2lmData()
 
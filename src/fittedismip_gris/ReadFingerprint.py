@@ -1,3 +1,4 @@
+import numpy as np
 from netCDF4 import Dataset
 
 """ ReadFingerprint.py
@@ -13,20 +14,98 @@ f = The fingerprint coefficient along a lat/lon grid [nlat x nlon]
 lat = Vector of latitudes
 lon = Vector of longitudes
 
+ReadFingerprintGrid() reads the lat/lon vectors only, and ReadFingerprintCells() reads
+the fingerprint at a set of grid cells. The cells are read in bounding-box hyperslabs
+around groups of nearby cells, or in one read when the boxes would cover most of the
+grid.
+
 """
 
+# Cells between two needed rows (or columns) that are read rather than split into
+# another hyperslab
+WINDOW_GAP = 8
 
-def ReadFingerprint(fname):
+# Read the whole fingerprint when the hyperslabs cover more than this fraction of the
+# grid, or when there are more than this many of them
+FULL_READ_FRACTION = 0.5
+MAX_WINDOWS = 1000
+
+
+def OpenFingerprint(fname):
     # Open the fingerprint file
     try:
-        nc_fid = Dataset(fname, "r")
+        return Dataset(fname, "r")
     except:
         print("Cannot open fingerprint file: {0}\n".format(fname))
         raise
 
+
+def ReadFingerprint(fname):
+    nc_fid = OpenFingerprint(fname)
+
     # Read in the fingerprint data
-    fp = nc_fid.variables["fp"][:, :]
-    fp_lats = nc_fid.variables["lat"][:]
-    fp_lons = nc_fid.variables["lon"][:]
+    with nc_fid:
+        fp = nc_fid.variables["fp"][:, :]
+        fp_lats = nc_fid.variables["lat"][:]
+        fp_lons = nc_fid.variables["lon"][:]
 
     return (fp, fp_lats, fp_lons)
+
+
+def ReadFingerprintGrid(fname):
+    """Returns the lat and lon vectors of a fingerprint file."""
+    with OpenFingerprint(fname) as nc_fid:
+        return (nc_fid.variables["lat"][:], nc_fid.variables["lon"][:])
+
+
+def IndexRuns(idx, max_gap=WINDOW_GAP):
+    """Returns the (start, stop) ranges covering the sorted unique indices idx, splitting
+    where two indices are more than max_gap apart."""
+    splits = np.flatnonzero(np.diff(idx) > max_gap + 1) + 1
+    starts = idx[np.concatenate(([0], splits))]
+    stops = idx[np.concatenate((splits - 1, [idx.size - 1]))] + 1
+    return list(zip(starts.tolist(), stops.tolist()))
+
+
+def FingerprintWindows(cells, shape, max_gap=WINDOW_GAP):
+    """Returns the hyperslabs (row start, row stop, column start, column stop) covering
+    the sorted cells of the flattened [nlat, nlon] grid, and the cells in each."""
+    (rows, cols) = np.divmod(cells, shape[1])
+    windows = []
+    for row_start, row_stop in IndexRuns(np.unique(rows), max_gap):
+        in_rows = np.flatnonzero((rows >= row_start) & (rows < row_stop))
+        for col_start, col_stop in IndexRuns(np.unique(cols[in_rows]), max_gap):
+            in_window = in_rows[
+                (cols[in_rows] >= col_start) & (cols[in_rows] < col_stop)
+            ]
+            windows.append(((row_start, row_stop, col_start, col_stop), in_window))
+    return windows
+
+
+def ReadFingerprintCells(fname, cells, shape):
+    """Returns the fingerprint at the sorted cells of the flattened [nlat, nlon] grid of
+    shape."""
+    cells = np.asarray(cells)
+    windows = FingerprintWindows(cells, shape)
+    window_size = sum((x[1] - x[0]) * (x[3] - x[2]) for x, _ in windows)
+
+    with OpenFingerprint(fname) as nc_fid:
+        fp_var = nc_fid.variables["fp"]
+
+        # Fall back to one read when the windows cover most of the grid
+        if (
+            window_size > FULL_READ_FRACTION * shape[0] * shape[1]
+            or len(windows) > MAX_WINDOWS
+        ):
+            return np.asarray(fp_var[:, :], dtype=np.float64).ravel()[cells]
+
+        # Read each window and pick the cells in it
+        fp_cells = np.empty(cells.size, dtype=np.float64)
+        for (row_start, row_stop, col_start, col_stop), in_window in windows:
+            block = np.asarray(
+                fp_var[row_start:row_stop, col_start:col_stop], dtype=np.float64
+            )
+            (rows, cols) = np.divmod(cells[in_window], shape[1])
+            fp_cells[in_window] = block[rows - row_start, cols - col_start]
+
+    return fp_cells
@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+
+import numpy as np
+
+""" cache.py
+
+Helpers shared by the on-disk caches of this module.
+
+Cache entries live in sub-directories of a cache directory, one sub-directory per kind of
+entry, and are named after a hash of their inputs. Entries are written to a temporary file
+first and moved into place, so concurrent runs never see a partially written entry.
+
+"""
+
+
+def HashFiles(*filenames):
+    """Returns the sha256 hex digest of the contents of the files, in order."""
+    h = hashlib.sha256()
+    for filename in filenames:
+        with open(filename, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+    return h.hexdigest()
+
+
+def HashValues(*values):
+    """Returns the sha256 hex digest of JSON-serializable values."""
+    text = json.dumps(values, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def CachePath(cache_dir, kind, key, suffix=""):
+    """Returns the path of the cache entry named key of this kind, creating the
+    sub-directory if needed."""
+    entry_dir = os.path.join(cache_dir, kind)
+    os.makedirs(entry_dir, exist_ok=True)
+    return os.path.join(entry_dir, f"{key}{suffix}")
+
+
+@contextmanager
+def AtomicOutput(filename):
+    """Yields a temporary file name next to filename. The temporary file is moved to
+    filename if the block succeeds and removed otherwise."""
+    (fd, tmp_filename) = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(filename)),
+        prefix=".tmp-",
+        suffix=os.path.splitext(filename)[1],
+    )
+    os.close(fd)
+    try:
+        yield tmp_filename
+        os.replace(tmp_filename, filename)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+
+def CachedFileHash(cache_dir, filename):
+    """Returns HashFiles(filename), reusing the hash computed by an earlier run if the
+    file has the same size and modification time."""
+    st = os.stat(filename)
+    key = HashValues(os.path.abspath(filename), st.st_size, st.st_mtime_ns)
+    hash_file = CachePath(cache_dir, "hashes", key)
+    if os.path.exists(hash_file):
+        with open(hash_file) as f:
+            return f.read().strip()
+
+    file_hash = HashFiles(filename)
+    with AtomicOutput(hash_file) as tmp_hash_file, open(tmp_hash_file, "w") as f:
+        f.write(file_hash)
+    return file_hash
+
+
+def TouchEntry(*filenames):
+    """Marks cache entry files as recently used."""
+    for filename in filenames:
+        os.utime(filename)
+
+
+def EvictCache(cache_dir, kind, max_bytes, keep=None):
+    """Removes the least recently used entries of this kind until they take at most
+    max_bytes. Files whose names start with the same key before the first "." belong to
+    one entry. The entry named keep is never removed."""
+    entry_dir = os.path.join(cache_dir, kind)
+    if not os.path.isdir(entry_dir):
+        return
+
+    # Size and last use of each entry
+    entries = {}
+    for name in os.listdir(entry_dir):
+        if name.startswith(".tmp-"):
+            continue
+        # Files removed by a concurrent run are gone already
+        try:
+            st = os.stat(os.path.join(entry_dir, name))
+        except FileNotFoundError:
+            continue
+        (size, used, names) = entries.get(name.split(".")[0], (0, 0, []))
+        entries[name.split(".")[0]] = (
+            size + st.st_size,
+            max(used, st.st_mtime),
+            names + [name],
+        )
+
+    # Remove the least recently used entries first
+    total = sum(x[0] for x in entries.values())
+    for key, (size, _, names) in sorted(entries.items(), key=lambda x: x[1][1]):
+        if total <= max_bytes:
+            break
+        if key == keep:
+            continue
+        for name in names:
+            # Entries in use stay readable until they are closed
+            try:
+                os.remove(os.path.join(entry_dir, name))
+            except FileNotFoundError:
+                pass
+        total -= size
+
+
+def HashArrays(*arrays):
+    """Returns the sha256 hex digest of the dtypes, shapes and contents of arrays."""
+    h = hashlib.sha256()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        h.update(f"{array.dtype.str}{array.shape}".encode())
+        h.update(array.tobytes())
+    return h.hexdigest()
@@ -1,30 +1,60 @@
-from fittedismip_gris.FittedISMIP_GrIS_preprocess import (
-    FittedISMIP_preprocess_icesheet,
-)
-from fittedismip_gris.FittedISMIP_GrIS_fit import (
-    FittedISMIP_fit_icesheet,
-)
-from fittedismip_gris.FittedISMIP_GrIS_project import (
-    FittedISMIP_project_icesheet,
-)
-from fittedismip_gris.FittedISMIP_GrIS_postprocess import (
-    FittedISMIP_postprocess_icesheet,
+from fittedismip_gris.location_shards import ParseLocationShard
+from fittedismip_gris.dask_scheduler import CheckDaskScheduler, DaskScheduler
+from fittedismip_gris.resident_inputs import (
+    DEFAULT_MAX_ENTRIES,
+    DEFAULT_MAX_SIZE,
+    ResidentInputs,
 )
 
 import click
+import functools
+import json
 import logging
+from contextlib import ExitStack
+
+# The stages and their dependencies (numpy, xarray, dask, scipy, netCDF4 and h5py) are
+# imported by the commands that use them, after their options are checked, so --help
+# and invalid options return quickly (see benchmarks/startup.py).
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 
-@click.command()
+class DefaultGroup(click.Group):
+    """Command group that runs default_command when no subcommand is given, so the
+    options of the default command can be passed directly."""
+
+    def __init__(self, *args, default_command=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.default_command = default_command
+
+    def parse_args(self, ctx, args):
+        if not args or (args[0] not in self.commands and args[0] != "--help"):
+            args = [self.default_command] + list(args)
+        return super().parse_args(ctx, args)
+
+
+@click.group(cls=DefaultGroup, default_command="run")
+def main():
+    """FittedISMIP-GrIS ice sheet sea-level projections. Without a command, runs the
+    pipeline (see run --help)."""
+
+
+@main.command("run")
 @click.option(
     "--scenario",
     envvar="FITTEDISMIP_GRIS_SCENARIO",
-    default="ssp585",
-    help="Emissions scenario of interest.",
+    default=["ssp585"],
+    help="Emissions scenario of interest. Repeat the option or separate scenarios with commas to run several scenarios with shared inputs.",
     show_default=True,
+    multiple=True,
+    type=str,
+)
+@click.option(
+    "--tlim",
+    envvar="FITTEDISMIP_GRIS_TLIM",
+    help="Temperature target LIMIT:WINDOW, run as the scenario tlimLIMITwinWINDOW. Repeat the option or separate targets with commas to run several targets. Replaces the default --scenario.",
+    multiple=True,
     type=str,
 )
 @click.option(
@@ -38,8 +68,15 @@ logging.basicConfig(level=logging.INFO)
 @click.option(
     "--climate-data-file",
     envvar="FITTEDISMIP_GRIS_CLIMATE_DATA_FILE",
-    required=True,  # true for now and must be a fair climate.nc
-    help="NetCDF4/HDF5 file containing surface temperature data",
+    help="NetCDF4/HDF5 file containing surface temperature data. Required unless --global-in-file is given.",
+    type=str,
+)
+@click.option(
+    "--climate-forcing-file",
+    envvar="FITTEDISMIP_GRIS_CLIMATE_FORCING_FILE",
+    default="./data/input/20201009_CLIMATE_FORCING.csv",
+    show_default=True,
+    help="CSV file of climate forcing temperatures, used when --tlm-flag is 0. With --cache-dir, the parsed file is cached.",
     type=str,
 )
 @click.option(
@@ -51,30 +88,66 @@ logging.basicConfig(level=logging.INFO)
 @click.option(
     "--gris-parm-file",
     type=str,
-    help="File containing Greenland ice sheet model parameters",
+    help="File containing Greenland ice sheet model parameters. Required unless --parm-bundle is an existing bundle.",
     envvar="FITTEDISMIP_GRIS_GRIS_PARMS",
-    required=True,
 )
 @click.option(
     "--wais-parm-file",
     type=str,
-    help="File containing West Antarctic ice sheet model parameters",
+    help="File containing West Antarctic ice sheet model parameters. Required unless --parm-bundle is an existing bundle.",
     envvar="FITTEDISMIP_GRIS_WAIS_PARMS",
-    required=True,
 )
 @click.option(
     "--eais-parm-file",
     type=str,
-    help="File containing East Antarctic ice sheet model parameters",
+    help="File containing East Antarctic ice sheet model parameters. Required unless --parm-bundle is an existing bundle.",
     envvar="FITTEDISMIP_GRIS_EAIS_PARMS",
-    required=True,
 )
 @click.option(
     "--pen-parm-file",
     type=str,
-    help="File containing Antarctic Peninsula ice sheet model parameters",
+    help="File containing Antarctic Peninsula ice sheet model parameters. Required unless --parm-bundle is an existing bundle.",
     envvar="FITTEDISMIP_GRIS_PEN_PARMS",
-    required=True,
+)
+@click.option(
+    "--parm-bundle",
+    type=str,
+    help="Binary bundle of the model parameters. Read as it is if it exists, even if parameter files are given, otherwise compiled from the parameter files.",
+    envvar="FITTEDISMIP_GRIS_PARM_BUNDLE",
+)
+@click.option(
+    "--cache-dir",
+    type=str,
+    help="Directory for cached intermediate data, such as compiled parameter bundles, preprocessed temperature ensembles and checkpoints of the preprocess, fit and project stages",
+    envvar="FITTEDISMIP_GRIS_CACHE_DIR",
+)
+@click.option(
+    "--temp-cache-size",
+    type=click.IntRange(min=0),
+    default=4096,
+    show_default=True,
+    help="Size limit in MB of the preprocessed temperature ensembles kept in --cache-dir. The least recently used ensembles are removed first.",
+    envvar="FITTEDISMIP_GRIS_TEMP_CACHE_SIZE",
+)
+@click.option(
+    "--checkpoint-cache-size",
+    type=click.IntRange(min=0),
+    default=4096,
+    show_default=True,
+    help="Size limit in MB of the checkpoints of each stage kept in --cache-dir. The least recently used checkpoints are removed first.",
+    envvar="FITTEDISMIP_GRIS_CHECKPOINT_CACHE_SIZE",
+)
+@click.option(
+    "--from-stage",
+    help="Start at this stage. The earlier stages are loaded from their checkpoints in --cache-dir, and this stage and the later ones are run again. For example, postprocess localizes an existing projection for a new location file.",
+    type=click.Choice(["preprocess", "fit", "project", "postprocess"]),
+    envvar="FITTEDISMIP_GRIS_FROM_STAGE",
+)
+@click.option(
+    "--until-stage",
+    help="Stop after this stage, leaving its checkpoint in --cache-dir",
+    type=click.Choice(["preprocess", "fit", "project", "postprocess"]),
+    envvar="FITTEDISMIP_GRIS_UNTIL_STAGE",
 )
 @click.option(
     "--nsamps",
@@ -139,12 +212,89 @@ logging.basicConfig(level=logging.INFO)
     show_default=True,
     type=int,
 )
+@click.option(
+    "--engine",
+    envvar="FITTEDISMIP_GRIS_ENGINE",
+    help="Projection engine. 'batch' evaluates all samples at once, 'scalar' loops over samples (reference mode)",
+    default="batch",
+    show_default=True,
+    type=click.Choice(["batch", "scalar"]),
+)
+@click.option(
+    "--sampling",
+    envvar="FITTEDISMIP_GRIS_SAMPLING",
+    help="Sampling strategy. 'lhs' uses a Latin hypercube for the trend quantiles, 'sobol' a scrambled Sobol' sequence for the joint draws, and 'stratified' stratifies model rows by group and model.",
+    default="random",
+    show_default=True,
+    type=click.Choice(["random", "lhs", "sobol", "stratified"]),
+)
+@click.option(
+    "--workers",
+    envvar="FITTEDISMIP_GRIS_WORKERS",
+    help="Number of processes for sharded sampling. Shards use independent random streams spawned from --rngseed, so results do not depend on the number of workers. The lhs and sobol parameters are drawn once for all shards. By default all samples are drawn from a single random stream.",
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--shard-size",
+    envvar="FITTEDISMIP_GRIS_SHARD_SIZE",
+    help="Number of samples per shard when --workers is set [default: 10000, or 8192 with --sampling sobol]",
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--block-size",
+    envvar="FITTEDISMIP_GRIS_BLOCK_SIZE",
+    help="Generate samples this many at a time and append each block to the global output file, so memory use does not grow with --nsamps. With --workers, the blocks are the shards.",
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--adaptive/--no-adaptive",
+    envvar="FITTEDISMIP_GRIS_ADAPTIVE",
+    help="Generate samples in batches and stop once the tracked quantiles converge. --nsamps is then the maximum number of samples.",
+    default=False,
+    show_default=True,
+)
+@click.option(
+    "--adaptive-batch",
+    envvar="FITTEDISMIP_GRIS_ADAPTIVE_BATCH",
+    help="Number of samples per adaptive batch. Convergence is checked every batch whatever --block-size is. With --workers, the batches are the shards.",
+    default=1000,
+    show_default=True,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--adaptive-quantiles",
+    envvar="FITTEDISMIP_GRIS_ADAPTIVE_QUANTILES",
+    help="Comma separated quantiles tracked for convergence",
+    default="0.05,0.5,0.95",
+    show_default=True,
+    type=str,
+)
+@click.option(
+    "--adaptive-years",
+    envvar="FITTEDISMIP_GRIS_ADAPTIVE_YEARS",
+    help="Comma separated projection years tracked for convergence [default: 2100, or the last projection year]",
+    type=str,
+)
+@click.option(
+    "--adaptive-tol",
+    envvar="FITTEDISMIP_GRIS_ADAPTIVE_TOL",
+    help="Stop when no tracked quantile changes by more than this many mm between batches",
+    default=1.0,
+    show_default=True,
+    type=click.FloatRange(min=0, min_open=True),
+)
 @click.option(
     "--location-file",
     type=str,
-    help="File that contains name, id, lat, and lon of points for localization",
+    help="File that contains name, id, lat, and lon of points for localization (tab-separated, .csv or .nc), or a regular grid 'grid:STEP[:SOUTH,NORTH,WEST,EAST]'",
     envvar="FITTEDISMIP_GRIS_LOCATIONFILE",
 )
+@click.option(
+    "--location-shard",
+    envvar="FITTEDISMIP_GRIS_LOCATION_SHARD",
+    help="Localize only the i-th of N contiguous slices of the locations, given as i/N with 0 <= i < N. The local output file name may contain '{shard}'. Combine the shard files with the merge command.",
+    type=str,
+)
 @click.option(
     "--chunksize",
     type=int,
@@ -162,29 +312,113 @@ logging.basicConfig(level=logging.INFO)
 @click.option(
     "--gris-global-out-file",
     envvar="FITTEDISMIP_GRIS_GLOBAL_OUT_FILE",
-    help="File name for global Greenland ice sheet projections",
+    help="File name for global Greenland ice sheet projections. May contain '{scenario}', or be repeated once per scenario. Names ending in .zarr are written as Zarr stores.",
+    multiple=True,
+    type=str,
+)
+@click.option(
+    "--global-in-file",
+    envvar="FITTEDISMIP_GRIS_GLOBAL_IN_FILE",
+    help="Global output file of an earlier run to localize instead of running the preprocess, fit and project stages. May contain '{scenario}', or be repeated once per scenario.",
+    multiple=True,
     type=str,
 )
 @click.option(
     "--gris-local-out-file",
     envvar="FITTEDISMIP_GRIS_LOCAL_OUT_FILE",
-    help="File name for local Greenland ice sheet projections",
+    help="File name for local Greenland ice sheet projections. May contain '{scenario}', or be repeated once per scenario. Names ending in .zarr are written as Zarr stores.",
+    multiple=True,
+    type=str,
+)
+@click.option(
+    "--global-encoding",
+    envvar="FITTEDISMIP_GRIS_GLOBAL_ENCODING",
+    help="Encoding profile of the global output file: an optional preset (f8, f4, f4-zlib, i2-zlib) followed by comma separated key=value overrides of dtype (f8, f4, i2), precision (mm, for i2), offset, compression (none, zlib, zstd, bzip2), level, shuffle and chunks (samples/years/locations, e.g. 1000/-1/1)",
+    default="f8",
+    show_default=True,
+    type=str,
+)
+@click.option(
+    "--local-encoding",
+    envvar="FITTEDISMIP_GRIS_LOCAL_ENCODING",
+    help="Encoding profile of the local output file, in the same format as --global-encoding",
+    default="f4-zlib",
+    show_default=True,
+    type=str,
+)
+@click.option(
+    "--local-format",
+    envvar="FITTEDISMIP_GRIS_LOCAL_FORMAT",
+    help="Format of the local output file. 'factorized' stores the global samples and the site fingerprints instead of their product; read it with fittedismip_gris.local_output.OpenLocalOutput() or convert it with the export command.",
+    default="dense",
+    show_default=True,
+    type=click.Choice(["dense", "factorized"]),
+)
+@click.option(
+    "--quantiles",
+    envvar="FITTEDISMIP_GRIS_QUANTILES",
+    help="Comma separated quantiles (between 0 and 1). When given, the local output file holds these quantiles of the local samples over the samples instead of the samples. They are computed from the global samples without building the local samples.",
+    type=str,
+)
+@click.option(
+    "--dask-scheduler",
+    envvar="FITTEDISMIP_GRIS_DASK_SCHEDULER",
+    help="Dask scheduler of the postprocess stage: synchronous, a pool of threads or processes, or a local distributed cluster [default: dask's configured scheduler]",
+    type=click.Choice(["synchronous", "threads", "processes", "distributed"]),
+)
+@click.option(
+    "--dask-workers",
+    envvar="FITTEDISMIP_GRIS_DASK_WORKERS",
+    help="Number of threads, processes or distributed workers [default: the number of cores]",
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--dask-memory-limit",
+    envvar="FITTEDISMIP_GRIS_DASK_MEMORY_LIMIT",
+    help="Memory limit per distributed worker, e.g. 4GB [default: the system memory shared by the workers]",
     type=str,
 )
+@click.option(
+    "--dask-performance-report",
+    envvar="FITTEDISMIP_GRIS_DASK_PERFORMANCE_REPORT",
+    help="Write a dask performance report (HTML) of the run to this file. Needs --dask-scheduler distributed.",
+    type=click.Path(dir_okay=False),
+)
 @click.option(
     "--debug/--no-debug",
     default=False,
     envvar="FITTEDISMIP_GRIS_DEBUG",
 )
-def main(
+def run(debug, **options):
+    """Run the preprocess, fit, project and postprocess stages."""
+    click.echo("Hello from FittedISMIP-GrIS!")
+    if debug:
+        logging.root.setLevel(logging.DEBUG)
+    else:
+        logging.root.setLevel(logging.INFO)
+
+    RunOptions(click.get_current_context().find_object(ResidentInputs), **options)
+
+
+def RunOptions(
+    resident,
+    *,
     scenario,
+    tlim,
     tlm_flag,
     climate_data_file,
+    climate_forcing_file,
     pipeline_id,
     gris_parm_file,
     wais_parm_file,
     eais_parm_file,
     pen_parm_file,
+    parm_bundle,
+    cache_dir,
+    temp_cache_size,
+    checkpoint_cache_size,
+    from_stage,
+    until_stage,
     nsamps,
     pyear_start,
     pyear_end,
@@ -193,66 +427,483 @@ def main(
     cyear_end,
     baseyear,
     rngseed,
+    engine,
+    sampling,
+    workers,
+    shard_size,
+    block_size,
+    adaptive,
+    adaptive_batch,
+    adaptive_quantiles,
+    adaptive_years,
+    adaptive_tol,
     location_file,
+    location_shard,
     chunksize,
     fingerprint_dir,
     gris_global_out_file,
+    global_in_file,
     gris_local_out_file,
-    debug,
+    global_encoding,
+    local_encoding,
+    local_format,
+    quantiles,
+    dask_scheduler,
+    dask_workers,
+    dask_memory_limit,
+    dask_performance_report,
 ):
-    click.echo("Hello from FittedISMIP-GrIS!")
-    if debug:
-        logging.root.setLevel(logging.DEBUG)
-    else:
-        logging.root.setLevel(logging.INFO)
+    """Checks the options of the run command and runs the pipeline with them, with the
+    resident inputs if not None. Must be called in the context of the run command."""
+    # Split comma separated scenario lists
+    scenarios = [x for this_scenario in scenario for x in this_scenario.split(",") if x]
 
-    # Preprocess
-    logger.info("Starting preprocessing step...")
-    preprocess_dict = FittedISMIP_preprocess_icesheet(
-        scenario=scenario,
-        tlm_flag=tlm_flag,
-        pipeline_id=pipeline_id,
-        climate_file=climate_data_file,
-    )
-    logger.info("Finished preprocessing step")
-
-    # Fit
-    logger.info("Starting fitting step...")
-    fit_dict = FittedISMIP_fit_icesheet(
-        pipeline_id=pipeline_id,
-        gris_parm_file=gris_parm_file,
-        wais_parm_file=wais_parm_file,
-        eais_parm_file=eais_parm_file,
-        pen_parm_file=pen_parm_file,
-    )
-    logger.info("Finished fitting step")
-
-    # Project
-    logger.info("Starting projection step...")
-    project_dict = FittedISMIP_project_icesheet(
-        preprocess_dict=preprocess_dict,
-        fit_dict=fit_dict,
-        nsamps=nsamps,
-        pyear_start=pyear_start,
-        pyear_end=pyear_end,
-        pyear_step=pyear_step,
-        cyear_start=cyear_start,
-        cyear_end=cyear_end,
-        baseyear=baseyear,
-        rngseed=rngseed,
-        pipeline_id=pipeline_id,
-        gris_global_out_file=gris_global_out_file,
+    # Add the temperature target scenarios
+    targets = [x for this_tlim in tlim for x in this_tlim.split(",") if x]
+    if targets:
+        source = click.get_current_context().get_parameter_source("scenario")
+        if source == click.core.ParameterSource.DEFAULT:
+            scenarios = []
+    for target in targets:
+        (limit, _, window) = target.partition(":")
+        if not window:
+            raise click.BadParameter(
+                f"Expected LIMIT:WINDOW, got '{target}'", param_hint="--tlim"
+            )
+        scenarios.append(f"tlim{limit.strip()}win{window.strip()}")
+    try:
+        adaptive_quantiles = [float(x) for x in adaptive_quantiles.split(",") if x]
+        if adaptive_years:
+            adaptive_years = [int(x) for x in adaptive_years.split(",") if x]
+        if quantiles:
+            quantiles = [float(x) for x in quantiles.split(",") if x]
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    if location_shard is not None:
+        try:
+            location_shard = ParseLocationShard(location_shard)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint="--location-shard")
+    try:
+        CheckDaskScheduler(
+            dask_scheduler, dask_workers, dask_memory_limit, dask_performance_report
+        )
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+    from fittedismip_gris.pipeline import run_pipeline
+
+    try:
+        run_pipeline(
+            scenarios=scenarios,
+            tlm_flag=tlm_flag,
+            climate_data_file=climate_data_file,
+            climate_forcing_file=climate_forcing_file,
+            pipeline_id=pipeline_id,
+            gris_parm_file=gris_parm_file,
+            wais_parm_file=wais_parm_file,
+            eais_parm_file=eais_parm_file,
+            pen_parm_file=pen_parm_file,
+            parm_bundle=parm_bundle,
+            cache_dir=cache_dir,
+            temp_cache_size=temp_cache_size,
+            nsamps=nsamps,
+            pyear_start=pyear_start,
+            pyear_end=pyear_end,
+            pyear_step=pyear_step,
+            cyear_start=cyear_start,
+            cyear_end=cyear_end,
+            baseyear=baseyear,
+            rngseed=rngseed,
+            engine=engine,
+            sampling=sampling,
+            workers=workers,
+            shard_size=shard_size,
+            block_size=block_size,
+            adaptive=adaptive,
+            adaptive_batch=adaptive_batch,
+            adaptive_quantiles=adaptive_quantiles,
+            adaptive_years=adaptive_years,
+            adaptive_tol=adaptive_tol,
+            location_file=location_file,
+            chunksize=chunksize,
+            fingerprint_dir=fingerprint_dir,
+            gris_global_out_file=gris_global_out_file,
+            gris_local_out_file=gris_local_out_file,
+            global_encoding=global_encoding,
+            local_encoding=local_encoding,
+            local_format=local_format,
+            quantiles=quantiles,
+            location_shard=location_shard,
+            global_in_file=global_in_file,
+            dask_scheduler=dask_scheduler,
+            dask_workers=dask_workers,
+            dask_memory_limit=dask_memory_limit,
+            dask_performance_report=dask_performance_report,
+            from_stage=from_stage,
+            until_stage=until_stage,
+            checkpoint_size=checkpoint_cache_size,
+            resident=resident,
+        )
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+
+@main.command("export")
+@click.argument("in_file", type=click.Path(exists=True))
+@click.argument("out_file", type=click.Path())
+@click.option(
+    "--local-encoding",
+    help="Encoding profile of the exported file [default: the profile recorded in IN_FILE]",
+    type=str,
+)
+def export(in_file, out_file, local_encoding):
+    """Write the local samples of a factorized (or dense) local output file IN_FILE to
+    the dense local output file OUT_FILE. Either may be a Zarr store (.zarr)."""
+    from fittedismip_gris.local_output import ExportLocalOutput
+
+    try:
+        ExportLocalOutput(in_file, out_file, local_encoding=local_encoding)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+
+@main.command("merge")
+@click.argument("manifest_file", type=click.Path(dir_okay=False))
+@click.argument("shard_files", nargs=-1, required=True, type=click.Path(exists=True))
+@click.option(
+    "--concatenate",
+    "out_file",
+    help="Also write the shards to this single local output file",
+    type=click.Path(),
+)
+@click.option(
+    "--local-encoding",
+    help="Encoding profile of the concatenated file [default: the profile recorded in the shards]",
+    type=str,
+)
+def merge(manifest_file, shard_files, out_file, local_encoding):
+    """Write the manifest MANIFEST_FILE (.json) over the local output files SHARD_FILES
+    of the location shards of a run. The manifest opens as one local output file with
+    fittedismip_gris.local_output.OpenLocalOutput() and export, without copying the
+    shards."""
+    from fittedismip_gris.local_output import MergeLocalShards
+
+    try:
+        MergeLocalShards(
+            manifest_file, shard_files, out_file=out_file, local_encoding=local_encoding
+        )
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+
+@main.command("query")
+@click.argument("global_file", type=click.Path(exists=True))
+@click.option(
+    "--fingerprint-dir",
+    required=True,
+    help="Directory containing the fingerprint files",
+    envvar="FITTEDISMIP_GRIS_FINGERPRINT_DIR",
+)
+@click.option(
+    "--point",
+    multiple=True,
+    help="LAT,LON of a point. Repeat the option for several points.",
+    type=str,
+)
+@click.option(
+    "--location-file",
+    help="Query the locations of a location file, in any format of run --location-file",
+    type=str,
+)
+@click.option(
+    "--quantiles",
+    default="0.05,0.5,0.95",
+    show_default=True,
+    help="Comma separated quantiles (between 0 and 1) of the local samples",
+    type=str,
+)
+@click.option(
+    "--samples/--no-samples",
+    default=False,
+    help="Return the local samples instead of quantiles",
+)
+def query(global_file, fingerprint_dir, point, location_file, quantiles, samples):
+    """Print the fingerprint and the local quantiles (or samples) of the global output
+    file GLOBAL_FILE at points, as JSON, without writing output files."""
+    try:
+        quantiles = [float(x) for x in quantiles.split(",") if x]
+        points = [
+            tuple(float(x) for x in this_point.split(",")) for this_point in point
+        ]
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    if any(len(x) != 2 for x in points):
+        raise click.BadParameter("Expected LAT,LON", param_hint="--point")
+    ids = [None] * len(points)
+    if location_file is not None:
+        from fittedismip_gris.read_locationfile import ReadLocationFile
+
+        (_, site_ids, site_lats, site_lons) = ReadLocationFile(location_file)
+        points += list(zip(site_lats.tolist(), site_lons.tolist()))
+        ids += site_ids.tolist()
+    if not points:
+        raise click.UsageError("Give points with --point or --location-file")
+
+    import numpy as np
+
+    from fittedismip_gris.point_query import PointQuery
+
+    try:
+        point_query = PointQuery.FromFingerprintDir(global_file, fingerprint_dir)
+        (lats, lons) = (np.array(x) for x in zip(*points))
+        fingerprints = point_query.Fingerprints(lats, lons)
+        if samples:
+            values = point_query.Samples(lats, lons)
+        else:
+            values = point_query.Quantiles(lats, lons, quantiles)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+    # One entry per point
+    results = []
+    for i, (lat, lon) in enumerate(points):
+        result = {"lat": lat, "lon": lon, "fingerprint": float(fingerprints[i])}
+        if ids[i] is not None:
+            result["id"] = ids[i]
+        if samples:
+            result["samples"] = values[:, :, i].tolist()
+        else:
+            result["quantiles"] = {
+                str(q): values[j, :, i].tolist() for j, q in enumerate(quantiles)
+            }
+        results.append(result)
+
+    click.echo(
+        json.dumps(
+            {
+                "scenario": point_query.scenario,
+                "baseyear": int(point_query.baseyear),
+                "years": point_query.years.tolist(),
+                "points": results,
+            }
+        )
     )
-    logger.info("Finished projection step")
-
-    # Postprocess
-    logger.info("Starting postprocessing step...")
-    FittedISMIP_postprocess_icesheet(
-        projection_dict=project_dict,
-        locationfile=location_file,
-        chunksize=chunksize,
-        pipeline_id=pipeline_id,
-        fpdir=fingerprint_dir,
-        gris_local_out_file=gris_local_out_file,
+
+
+# Options of the run command set for the serve command as a whole
+SERVE_OPTIONS = (
+    "dask_scheduler",
+    "dask_workers",
+    "dask_memory_limit",
+    "dask_performance_report",
+)
+
+# Options of the run command that jobs cannot set
+JOB_EXCLUDED_OPTIONS = SERVE_OPTIONS + ("debug", "help")
+
+# State of a job worker process of the serve command (see InitJobWorker())
+JOB_WORKER = {}
+
+
+def PrepareJob(spec, resident):
+    """Checks the run options of a job specification (see job_server.py) and returns a
+    function that runs the job with the resident inputs. The job does not print or
+    change the logging level of the server."""
+    from fittedismip_gris.job_server import JobArguments
+
+    args = JobArguments(spec)
+    for name in JOB_EXCLUDED_OPTIONS:
+        if any(x.lstrip("-").replace("-", "_") == name for x in spec):
+            raise ValueError(f"Jobs cannot set --{name.replace('_', '-')}")
+    try:
+        ctx = run.make_context("run", args, obj=resident)
+    except click.ClickException as e:
+        raise ValueError(e.format_message()) from None
+
+    # The dask scheduler of the server runs the jobs
+    options = dict(ctx.params)
+    del options["debug"]
+    for name in SERVE_OPTIONS:
+        options[name] = None
+
+    def run_job():
+        with ctx:
+            try:
+                RunOptions(resident, **options)
+            except click.ClickException as e:
+                raise ValueError(e.format_message()) from None
+            finally:
+                if resident is not None:
+                    resident.CloseRetired()
+
+    return run_job
+
+
+def InitJobWorker(resident_entries, resident_size, dask_options):
+    """Sets up a job worker process of the serve command: its resident inputs and the
+    dask scheduler of the server."""
+    from fittedismip_gris.dask_scheduler import JoinDaskScheduler
+
+    JOB_WORKER["resident"] = ResidentInputs(
+        max_entries=resident_entries, max_size=resident_size
     )
-    logger.info("Finished postprocessing step")
+    JOB_WORKER["client"] = JoinDaskScheduler(**dask_options)
+
+    # Import the stages before the first job
+    import fittedismip_gris.pipeline  # noqa: F401
+
+
+def RunWorkerJob(spec):
+    """Runs a job in a job worker process."""
+    PrepareJob(spec, JOB_WORKER["resident"])()
+
+
+@main.command("serve")
+@click.option(
+    "--host",
+    default="127.0.0.1",
+    show_default=True,
+    help="Address to listen on",
+    envvar="FITTEDISMIP_GRIS_SERVE_HOST",
+)
+@click.option(
+    "--port",
+    default=8765,
+    show_default=True,
+    help="TCP port to listen on (0 picks a free port)",
+    type=click.IntRange(min=0, max=65535),
+    envvar="FITTEDISMIP_GRIS_SERVE_PORT",
+)
+@click.option(
+    "--socket",
+    "socket_path",
+    help="Listen on this Unix socket instead of a TCP port",
+    type=click.Path(dir_okay=False),
+    envvar="FITTEDISMIP_GRIS_SERVE_SOCKET",
+)
+@click.option(
+    "--concurrency",
+    default=1,
+    show_default=True,
+    help="Number of jobs run at a time",
+    type=click.IntRange(min=1),
+    envvar="FITTEDISMIP_GRIS_SERVE_CONCURRENCY",
+)
+@click.option(
+    "--queue-size",
+    default=100,
+    show_default=True,
+    help="Number of jobs that may wait to run. Jobs submitted to a full queue are rejected.",
+    type=click.IntRange(min=1),
+    envvar="FITTEDISMIP_GRIS_SERVE_QUEUE_SIZE",
+)
+@click.option(
+    "--resident-entries",
+    default=DEFAULT_MAX_ENTRIES,
+    show_default=True,
+    help="Number of parsed inputs (climate files, parameters, site fingerprints and temperature ensembles) kept in memory",
+    type=click.IntRange(min=1),
+    envvar="FITTEDISMIP_GRIS_SERVE_RESIDENT_ENTRIES",
+)
+@click.option(
+    "--resident-size",
+    default=DEFAULT_MAX_SIZE,
+    show_default=True,
+    help="Size limit in MB of the arrays of the parsed inputs kept in memory (of each worker process, with --concurrency above 1). Memory-mapped temperature ensembles are not counted.",
+    type=click.IntRange(min=0),
+    envvar="FITTEDISMIP_GRIS_SERVE_RESIDENT_SIZE",
+)
+@click.option(
+    "--dask-scheduler",
+    envvar="FITTEDISMIP_GRIS_DASK_SCHEDULER",
+    help="Dask scheduler of the postprocess stage of every job [default: dask's configured scheduler]",
+    type=click.Choice(["synchronous", "threads", "processes", "distributed"]),
+)
+@click.option(
+    "--dask-workers",
+    envvar="FITTEDISMIP_GRIS_DASK_WORKERS",
+    help="Number of threads, processes or distributed workers [default: the number of cores]",
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--dask-memory-limit",
+    envvar="FITTEDISMIP_GRIS_DASK_MEMORY_LIMIT",
+    help="Memory limit per distributed worker, e.g. 4GB [default: the system memory shared by the workers]",
+    type=str,
+)
+@click.option(
+    "--dask-performance-report",
+    envvar="FITTEDISMIP_GRIS_DASK_PERFORMANCE_REPORT",
+    help="Write a dask performance report (HTML) of the jobs to this file when the server stops. Needs --dask-scheduler distributed.",
+    type=click.Path(dir_okay=False),
+)
+def serve(
+    host,
+    port,
+    socket_path,
+    concurrency,
+    queue_size,
+    resident_entries,
+    resident_size,
+    dask_scheduler,
+    dask_workers,
+    dask_memory_limit,
+    dask_performance_report,
+):
+    """Serve pipeline jobs over HTTP on a local port or Unix socket, keeping the parsed
+    inputs in memory across jobs. POST a JSON object of run options to /jobs to queue a
+    job (?wait=1 to wait for it), and GET /jobs/ID for its status. Options a job does not
+    set take their defaults or FITTEDISMIP_GRIS_* environment variables."""
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    from fittedismip_gris.dask_scheduler import SchedulerAddress
+    from fittedismip_gris.job_server import JobServer, Serve
+
+    with ExitStack() as stack:
+        try:
+            stack.enter_context(
+                DaskScheduler(
+                    dask_scheduler,
+                    workers=dask_workers,
+                    memory_limit=dask_memory_limit,
+                    performance_report=dask_performance_report,
+                )
+            )
+        except ValueError as e:
+            raise click.UsageError(str(e))
+
+        # HDF5 and netCDF are not thread-safe, so concurrent jobs run in worker
+        # processes, each with its own resident inputs. A single job at a time runs in
+        # this process.
+        if concurrency == 1:
+            resident = ResidentInputs(
+                max_entries=resident_entries, max_size=resident_size
+            )
+            prepare_job = functools.partial(PrepareJob, resident=resident)
+        else:
+            resident = None
+            pool = stack.enter_context(
+                ProcessPoolExecutor(
+                    concurrency,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=InitJobWorker,
+                    initargs=(
+                        resident_entries,
+                        resident_size,
+                        {
+                            "scheduler": dask_scheduler,
+                            "workers": dask_workers,
+                            "address": SchedulerAddress(dask_scheduler),
+                        },
+                    ),
+                )
+            )
+
+            def prepare_job(spec):
+                PrepareJob(spec, None)
+                return lambda: pool.submit(RunWorkerJob, spec).result()
+
+        jobs = JobServer(prepare_job, concurrency=concurrency, queue_size=queue_size)
+        Serve(jobs, resident, host=host, port=port, socket_path=socket_path)
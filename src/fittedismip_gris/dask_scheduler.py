@@ -0,0 +1,120 @@
+from contextlib import ExitStack, contextmanager
+
+""" dask_scheduler.py
+
+Selects the dask scheduler of the postprocess stage, which computes and writes the
+local samples as a dask graph.
+
+Schedulers:
+synchronous  Single-threaded, in this process (for debugging and profiling)
+threads      Pool of workers threads
+processes    Pool of workers processes
+distributed  Local dask.distributed cluster of workers single-threaded processes, each
+             with a memory limit of memory_limit, for example "4GB"
+             [default = the system memory shared by the workers]
+
+Without a scheduler, dask's configured default is used, and dask is not imported. A performance report needs the
+distributed scheduler, which is an optional dependency:
+pip install "fittedismip-gris[distributed]".
+
+"""
+
+SCHEDULERS = ("synchronous", "threads", "processes", "distributed")
+
+
+def ImportDistributed():
+    """Imports dask.distributed, with a hint to install it when it is missing."""
+    try:
+        import dask.distributed
+    except ImportError:
+        raise ImportError(
+            'The distributed scheduler requires the distributed package. Install it with pip install "fittedismip-gris[distributed]"'
+        ) from None
+    return dask.distributed
+
+
+def CheckDaskScheduler(
+    scheduler=None, workers=None, memory_limit=None, performance_report=None
+):
+    """Raises a ValueError for scheduler options that do not go together."""
+    if scheduler is not None and scheduler not in SCHEDULERS:
+        raise ValueError(f"Unknown dask scheduler: {scheduler}")
+    if workers is not None and workers < 1:
+        raise ValueError("The number of dask workers must be positive")
+    if workers is not None and scheduler in (None, "synchronous"):
+        raise ValueError(
+            "The number of dask workers needs the threads, processes or distributed scheduler"
+        )
+    if memory_limit is not None and scheduler != "distributed":
+        raise ValueError("A dask memory limit needs the distributed scheduler")
+    if performance_report is not None and scheduler != "distributed":
+        raise ValueError("A dask performance report needs the distributed scheduler")
+
+
+def LocalSchedulerConfig(scheduler, workers=None):
+    """Returns the dask configuration of a local scheduler."""
+    config = {"scheduler": scheduler}
+    if workers is not None:
+        config["num_workers"] = workers
+    return config
+
+
+@contextmanager
+def DaskScheduler(
+    scheduler=None, workers=None, memory_limit=None, performance_report=None
+):
+    """Context in which dask computations use the scheduler. With the distributed
+    scheduler, a local cluster runs for the duration of the context and the performance
+    report, if any, is written when it ends."""
+    CheckDaskScheduler(scheduler, workers, memory_limit, performance_report)
+
+    # Use dask's configured default
+    if scheduler is None:
+        yield
+        return
+
+    # Local schedulers
+    if scheduler != "distributed":
+        import dask
+
+        with dask.config.set(LocalSchedulerConfig(scheduler, workers)):
+            yield
+        return
+
+    # A local cluster, used by every dask computation while the client is open
+    distributed = ImportDistributed()
+    with ExitStack() as stack:
+        cluster = stack.enter_context(
+            distributed.LocalCluster(
+                n_workers=workers,
+                threads_per_worker=1,
+                memory_limit=memory_limit or "auto",
+            )
+        )
+        stack.enter_context(distributed.Client(cluster))
+        if performance_report is not None:
+            stack.enter_context(distributed.performance_report(performance_report))
+        yield
+
+
+def SchedulerAddress(scheduler=None):
+    """Returns the address of the scheduler of the distributed client of this process,
+    as set up by DaskScheduler(), or None for the other schedulers."""
+    if scheduler != "distributed":
+        return None
+    return ImportDistributed().get_client().scheduler.address
+
+
+def JoinDaskScheduler(scheduler=None, workers=None, address=None):
+    """Makes the dask computations of this process (such as a job worker process of the
+    serve command) use the scheduler of DaskScheduler() in another process: the same
+    local scheduler, or the distributed scheduler at address. Returns the distributed
+    client, which must be kept open, or None."""
+    if scheduler is None:
+        return None
+    if scheduler != "distributed":
+        import dask
+
+        dask.config.set(LocalSchedulerConfig(scheduler, workers))
+        return None
+    return ImportDistributed().Client(address, set_as_default=True)
@@ -0,0 +1,204 @@
+import numpy as np
+
+""" encoding.py
+
+Encoding profiles for the sea_level_change variable of the output files.
+
+A profile is given as a string: an optional preset name followed by comma separated
+key=value overrides, for example "f4-zlib,level=6" or
+"i2-zlib,precision=0.5,chunks=1000/-1/50".
+
+Keys:
+dtype        f8, f4, or i2 (16-bit integers packed with scale_factor/add_offset)
+precision    Precision of packed i2 values in mm (the scale_factor) [default = 0.1]
+offset       add_offset of packed i2 values in mm [default = 0]
+compression  none, zlib, zstd or bzip2
+level        Compression level
+shuffle      Apply the shuffle filter before compressing (true/false)
+chunks       Chunk shape along samples/years/locations, separated by "/". -1 is the full
+             dimension and 0 leaves the choice to the library.
+
+Presets:
+f8       Uncompressed float64
+f4       Uncompressed float32
+f4-zlib  float32, zlib level 4 with shuffle
+i2-zlib  int16 packed at 0.1 mm, zlib level 4 with shuffle
+
+"""
+
+PRESETS = {
+    "f8": {"dtype": "f8", "compression": "none"},
+    "f4": {"dtype": "f4", "compression": "none"},
+    "f4-zlib": {"dtype": "f4", "compression": "zlib", "level": 4, "shuffle": True},
+    "i2-zlib": {
+        "dtype": "i2",
+        "precision": 0.1,
+        "compression": "zlib",
+        "level": 4,
+        "shuffle": True,
+    },
+}
+
+DTYPES = ("f8", "f4", "i2")
+COMPRESSIONS = ("none", "zlib", "zstd", "bzip2")
+
+# Fill value of packed integer data
+INT16_FILL = np.iinfo(np.int16).min
+
+
+def ParseEncodingProfile(spec):
+    """Parses an encoding profile string into a dictionary."""
+    profile = {
+        "dtype": "f8",
+        "precision": None,
+        "offset": None,
+        "compression": "none",
+        "level": None,
+        "shuffle": None,
+        "chunks": None,
+    }
+    for i, item in enumerate(x.strip() for x in spec.split(",") if x.strip()):
+        # A preset may only come first
+        if "=" not in item:
+            if i > 0 or item not in PRESETS:
+                raise ValueError(
+                    f"Unknown encoding preset '{item}'. Choose from {', '.join(PRESETS)}"
+                )
+            profile.update(PRESETS[item])
+            continue
+
+        (key, value) = (x.strip() for x in item.split("=", 1))
+        if key == "dtype":
+            if value not in DTYPES:
+                raise ValueError(f"Unknown encoding dtype '{value}'")
+            profile["dtype"] = value
+        elif key in ("precision", "offset"):
+            profile[key] = float(value)
+        elif key == "compression":
+            if value not in COMPRESSIONS:
+                raise ValueError(f"Unknown encoding compression '{value}'")
+            profile["compression"] = value
+        elif key == "level":
+            profile["level"] = int(value)
+        elif key == "shuffle":
+            if value.lower() not in ("true", "false"):
+                raise ValueError(
+                    f"Encoding shuffle must be true or false, not '{value}'"
+                )
+            profile["shuffle"] = value.lower() == "true"
+        elif key == "chunks":
+            chunks = tuple(int(x) for x in value.split("/"))
+            if len(chunks) != 3:
+                raise ValueError("Encoding chunks need one size per dimension")
+            profile["chunks"] = chunks
+        else:
+            raise ValueError(f"Unknown encoding key '{key}'")
+
+    # Packed integers need a precision
+    if profile["dtype"] == "i2":
+        if profile["precision"] is None:
+            profile["precision"] = 0.1
+        if profile["offset"] is None:
+            profile["offset"] = 0.0
+        if profile["precision"] <= 0:
+            raise ValueError("Encoding precision must be positive")
+    else:
+        profile["precision"] = None
+        profile["offset"] = None
+
+    return profile
+
+
+def ProfileString(profile):
+    """Returns the canonical string of a profile, to record in the file attributes.
+    The numbers are written in full, so parsing the string gives back the profile."""
+    items = [f"dtype={profile['dtype']}"]
+    if profile["dtype"] == "i2":
+        items.append(f"precision={float(profile['precision'])!r}")
+        items.append(f"offset={float(profile['offset'])!r}")
+    items.append(f"compression={profile['compression']}")
+    if profile["level"] is not None:
+        items.append(f"level={profile['level']}")
+    if profile["shuffle"] is not None:
+        items.append(f"shuffle={str(profile['shuffle']).lower()}")
+    if profile["chunks"] is not None:
+        items.append("chunks=" + "/".join(str(x) for x in profile["chunks"]))
+    return ",".join(items)
+
+
+def ChunkSizes(profile, shape):
+    """Returns the chunk shape of the profile for a variable of this shape, or None."""
+    if profile["chunks"] is None:
+        return None
+    chunks = []
+    for chunk, size in zip(profile["chunks"], shape):
+        if chunk == 0:
+            return None
+        chunks.append(size if chunk < 0 else min(chunk, size))
+    return tuple(max(x, 1) for x in chunks)
+
+
+def NetCDFEncoding(profile, shape):
+    """Returns the xarray netCDF4 encoding of sea_level_change for this profile."""
+    encoding = {"dtype": profile["dtype"]}
+    if profile["dtype"] == "i2":
+        encoding["scale_factor"] = profile["precision"]
+        encoding["add_offset"] = profile["offset"]
+        encoding["_FillValue"] = INT16_FILL
+    else:
+        encoding["_FillValue"] = np.nan
+
+    if profile["compression"] == "zlib":
+        encoding["zlib"] = True
+    elif profile["compression"] != "none":
+        encoding["compression"] = profile["compression"]
+    if profile["compression"] != "none":
+        if profile["level"] is not None:
+            encoding["complevel"] = profile["level"]
+        if profile["shuffle"] is not None:
+            encoding["shuffle"] = profile["shuffle"]
+
+    chunksizes = ChunkSizes(profile, shape)
+    if chunksizes is not None:
+        encoding["chunksizes"] = chunksizes
+
+    return encoding
+
+
+def NetCDF4VariableArgs(profile, shape, default_chunks=None):
+    """Returns the createVariable() keyword arguments and the variable attributes of
+    sea_level_change for this profile, for writing with netCDF4 directly."""
+    kwargs = {"datatype": profile["dtype"]}
+    attrs = {}
+    if profile["dtype"] == "i2":
+        kwargs["fill_value"] = INT16_FILL
+        attrs["scale_factor"] = profile["precision"]
+        attrs["add_offset"] = profile["offset"]
+    else:
+        kwargs["fill_value"] = np.nan
+
+    if profile["compression"] != "none":
+        kwargs["compression"] = profile["compression"]
+        if profile["level"] is not None:
+            kwargs["complevel"] = profile["level"]
+        if profile["shuffle"] is not None:
+            kwargs["shuffle"] = profile["shuffle"]
+
+    chunksizes = ChunkSizes(profile, shape) or default_chunks
+    if chunksizes is not None:
+        kwargs["chunksizes"] = chunksizes
+
+    return (kwargs, attrs)
+
+
+def CheckPackedRange(profile, vmin, vmax):
+    """Raises a ValueError if values between vmin and vmax cannot be packed with this
+    profile."""
+    if profile["dtype"] != "i2":
+        return
+    lo = profile["offset"] + (INT16_FILL + 1) * profile["precision"]
+    hi = profile["offset"] + np.iinfo(np.int16).max * profile["precision"]
+    if vmin < lo or vmax > hi:
+        raise ValueError(
+            f"Values between {vmin:g} and {vmax:g} mm do not fit in int16 at a precision of {profile['precision']:g} mm. Use a coarser precision, an offset or a float dtype."
+        )
@@ -1,5 +1,6 @@
 import numpy as np
 from fittedismip_gris.import_temp_data import import_temp_data
+from fittedismip_gris.metadata_table import MetadataTable
 
 """
 filter_data
@@ -7,74 +8,47 @@ filter_data
 Filters Tamsin's climate forcing based on metadata fields
 
 Parameters:
-data_dict		Data dictionary that contains all the metadata and normal data
+data_dict		Data dictionary that contains all the metadata and normal data, or a
+				MetadataTable of it to reuse its index across calls
 METADATA		Parameters named after the metadata fields (i.e. 'scenario', 'years', 
 				'model', etc) that contain numpy arrays of said metadata field that you
 				want to keep in the output
 
 Return:
-filtered_data_dict	Data dictionary filtered to user's request
+filtered_data_dict	Data dictionary filtered to user's request. The data of contiguous
+					rows and years are views of data_dict.
 
 """
 
 
 def filter_temp_data(data_dict, years=None, ensemble=None, GCM=None, scenario=None):
-    # Initialize the filtered data dictionary
-    filtered_data_dict = {}
-
-    # Temporary variables to hold year-related data
-    temp_years = data_dict["years"]
-    temp_data = data_dict["data"]
-
-    # Initialize the index variables
-    keep_idx = True
-    year_idx = None
+    # Index the metadata, unless we were handed an indexed table
+    table = (
+        data_dict if isinstance(data_dict, MetadataTable) else MetadataTable(data_dict)
+    )
 
     # Filter the data------------------------------------------------
     # This section tests each input parameter to see if anything is there. If so, the
-    # appropriate metadata is tested to see if it contains any of the items in the list.
-    # If so, keep_idx are the indices to keep based on the filtered results.
-
-    if years is not None:
-        year_idx = np.flatnonzero(np.isin(data_dict["years"], years))
-        temp_years = temp_years[year_idx]
-        temp_data = temp_data[:, year_idx]
-
-    if scenario is not None:
-        keep_idx *= np.isin(data_dict["scenario"], scenario)
-
-    if GCM is not None:
-        keep_idx *= np.isin(data_dict["GCM"], GCM)
-
-    if ensemble is not None:
-        keep_idx *= np.isin(data_dict["ensemble"], ensemble)
-
-    # Get the index positions of the rows to keep
-    keep_idx = np.flatnonzero(keep_idx)
+    # rows holding any of the items in the list are looked up in the metadata index.
+    # keep_idx are the indices to keep based on the filtered results.
+    if scenario is None and GCM is None and ensemble is None:
+        # Nothing to filter on keeps the first row only
+        keep_idx = np.flatnonzero(True)
+    else:
+        keep_idx = table.Rows(scenario=scenario, GCM=GCM, ensemble=ensemble)
 
     # If there are no matches, produce an error
     if not list(keep_idx):
         raise Exception("No matches for provided filter parameters")
 
     # If the user didn't pass anything to filter in the first place, return the original
-    # data dictionary, but let the user know.
-    if len(keep_idx) <= 1 and year_idx is None:
+    # data, but let the user know.
+    if len(keep_idx) <= 1 and years is None:
         print("Nothing to filter. Returning original data dictionary")
-        return data_dict
-
-    # Loop through the keys of the dictionary
-    for this_key in data_dict.keys():
-        # Skip the 'years' and 'data' since they are different shapes than the rest of
-        # the dictionary entries and are handled separately
-        if this_key == "years" or this_key == "data":
-            continue
-
-        # Filter the metadata
-        filtered_data_dict[this_key] = data_dict[this_key][keep_idx]
+        return table.Filter(np.arange(table.nrows))
 
-    # Filter the 'years' and 'data' entries
-    filtered_data_dict["years"] = temp_years
-    filtered_data_dict["data"] = temp_data[keep_idx, :]
+    # Filter the metadata, 'years' and 'data' entries
+    filtered_data_dict = table.Filter(keep_idx, years=years)
 
     # Done, return the filtered dictionary
     return filtered_data_dict
@@ -0,0 +1,172 @@
+import os
+
+import numpy as np
+from scipy import sparse
+
+from fittedismip_gris.cache import AtomicOutput, CachePath, HashArrays, HashValues
+
+""" fp_weights.py
+
+Sparse bilinear interpolation weights from a fingerprint grid to sites.
+
+The weights of each site are the bilinear stencil of the four grid cells around it, as
+in a RectBivariateSpline with kx = ky = 1: sites outside the grid take the values at its
+edge. They are stored as a sparse [unique sites, grid cells] matrix over the cells of the
+fingerprint array in file order, so applying them to any fingerprint on the same grid is
+a sparse matrix-vector product. Sites with the same coordinates share one row.
+
+Only the cells that the weights use need to be read from the fingerprint file (see
+WeightCells() and ReadFingerprintCells()).
+
+With a cache directory, the weights are kept there, keyed by hashes of the grid and of
+the site coordinates.
+
+"""
+
+# Version of the cache layout
+CACHE_VERSION = 1
+
+
+def BilinearStencil(grid, points):
+    """Returns the lower grid index of the interval around each point, and the weights
+    of the lower and upper grid points. grid must be increasing. Points outside the grid
+    are moved to its edge."""
+    points = np.clip(points, grid[0], grid[-1])
+    lower = np.clip(np.searchsorted(grid, points, side="right") - 1, 0, grid.size - 2)
+    f = 1.0 / (grid[lower + 1] - grid[lower])
+    return (lower, f * (grid[lower + 1] - points), f * (points - grid[lower]))
+
+
+def BilinearCells(sorted_lats, lat_sort, grid_lons, qlats, qlons):
+    """Returns the four grid cells around each site, as indices into the flattened grid
+    in file order, and their weights, both [sites, 4]. The cells of each site are in
+    increasing order. sorted_lats are the grid latitudes in increasing order and
+    lat_sort the indices that sort them. qlons must be in [0, 360)."""
+    (ilat, wlat0, wlat1) = BilinearStencil(sorted_lats, qlats)
+    (ilon, wlon0, wlon1) = BilinearStencil(grid_lons, qlons)
+
+    # The grid rows below and above each site, in file order
+    (row0, row1) = (lat_sort[ilat], lat_sort[ilat + 1])
+    swap = row0 > row1
+    (row0, row1) = (np.where(swap, row1, row0), np.where(swap, row0, row1))
+    (wlat0, wlat1) = (np.where(swap, wlat1, wlat0), np.where(swap, wlat0, wlat1))
+
+    nlons = grid_lons.size
+    cells = np.column_stack(
+        (
+            row0 * nlons + ilon,
+            row0 * nlons + ilon + 1,
+            row1 * nlons + ilon,
+            row1 * nlons + ilon + 1,
+        )
+    )
+    weights = np.column_stack(
+        (wlat0 * wlon0, wlat0 * wlon1, wlat1 * wlon0, wlat1 * wlon1)
+    )
+    return (cells, weights)
+
+
+def UniqueInverse(values):
+    """Returns the sorted unique values and the index of each value among them, as
+    np.unique(values, return_inverse=True) does, with an unstable sort."""
+    values = np.ravel(values)
+    order = np.argsort(values)
+    sorted_values = values[order]
+    first = np.empty(values.size, dtype=bool)
+    first[:1] = True
+    np.not_equal(sorted_values[1:], sorted_values[:-1], out=first[1:])
+    inverse = np.empty(values.size, dtype=np.intp)
+    inverse[order] = np.cumsum(first) - 1
+    return (sorted_values[first], inverse)
+
+
+def BilinearWeights(grid_lats, grid_lons, qlats, qlons):
+    """Returns the sparse weight matrix of the unique site coordinates, and the row of
+    the matrix for each site. grid_lats may be in any order, grid_lons must be
+    increasing. qlons are wrapped to [0, 360)."""
+    grid_lats = np.asarray(grid_lats, dtype=np.float64)
+    grid_lons = np.asarray(grid_lons, dtype=np.float64)
+    qlats = np.asarray(qlats, dtype=np.float64)
+    qlons = np.mod(np.asarray(qlons, dtype=np.float64), 360)
+
+    # Collapse duplicate sites, sorted by latitude and then longitude. Each site is
+    # keyed by the ranks of its coordinates, which sorts much faster than the rows of
+    # a [sites, 2] array.
+    (unique_lats, lat_rank) = UniqueInverse(qlats)
+    (unique_lons, lon_rank) = UniqueInverse(qlons)
+    (unique_keys, site_rows) = UniqueInverse(lat_rank * unique_lons.size + lon_rank)
+    (site_lats, site_lons) = (
+        unique_lats[unique_keys // unique_lons.size],
+        unique_lons[unique_keys % unique_lons.size],
+    )
+
+    # The four cells around each site, from stencils along sorted latitudes and
+    # longitudes
+    lat_sort = np.argsort(grid_lats)
+    (cells, weights) = BilinearCells(
+        grid_lats[lat_sort], lat_sort, grid_lons, site_lats, site_lons
+    )
+
+    # Build the matrix from the stencils directly, without the zero weights
+    nonzero = weights != 0
+    indptr = np.zeros(unique_keys.size + 1, dtype=np.int64)
+    np.cumsum(np.count_nonzero(nonzero, axis=1), out=indptr[1:])
+
+    matrix = sparse.csr_matrix(
+        (weights[nonzero], cells[nonzero], indptr),
+        shape=(unique_keys.size, grid_lats.size * grid_lons.size),
+    )
+    return (matrix, site_rows.ravel())
+
+
+def LoadBilinearWeights(grid_lats, grid_lons, qlats, qlons, cache_dir=None):
+    """Returns BilinearWeights(), from the cache directory if possible."""
+    if cache_dir is None:
+        return BilinearWeights(grid_lats, grid_lons, qlats, qlons)
+
+    key = HashValues(
+        CACHE_VERSION,
+        HashArrays(np.asarray(grid_lats), np.asarray(grid_lons)),
+        HashArrays(np.asarray(qlats), np.asarray(qlons)),
+    )
+    weights_file = CachePath(cache_dir, "fpweights", key, ".npz")
+    if os.path.exists(weights_file):
+        with np.load(weights_file) as npz:
+            matrix = sparse.csr_matrix(
+                (npz["data"], npz["indices"], npz["indptr"]), shape=tuple(npz["shape"])
+            )
+            return (matrix, npz["site_rows"])
+
+    (matrix, site_rows) = BilinearWeights(grid_lats, grid_lons, qlats, qlons)
+    with AtomicOutput(weights_file) as tmp_weights_file:
+        np.savez(
+            tmp_weights_file,
+            data=matrix.data,
+            indices=matrix.indices,
+            indptr=matrix.indptr,
+            shape=np.array(matrix.shape),
+            site_rows=site_rows,
+        )
+    return (matrix, site_rows)
+
+
+def WeightCells(weights):
+    """Returns the sorted grid cells, as indices into the flattened grid, that the
+    weights use."""
+    used = np.zeros(weights[0].shape[1], dtype=bool)
+    used[weights[0].indices] = True
+    return np.flatnonzero(used)
+
+
+def ApplyWeights(weights, fp, cells=None):
+    """Returns the values of the [lat, lon] fingerprint fp at the sites. With cells, fp
+    holds the values of these cells of the flattened grid only (see WeightCells())."""
+    (matrix, site_rows) = weights
+    fp = np.asarray(fp, dtype=np.float64).ravel()
+
+    # Place the cells in the flattened grid, which is much cheaper than dropping the
+    # other columns of the matrix
+    if cells is not None:
+        (fp, cells_fp) = (np.zeros(matrix.shape[1]), fp)
+        fp[cells] = cells_fp
+    return (matrix @ fp)[site_rows]
@@ -1,23 +1,46 @@
+import os
+import re
+
 import numpy as np
 
+from fittedismip_gris.cache import AtomicOutput, CachedFileHash, CachePath, HashValues
+
 """
 import_temp_data.py
 
 Imports the climate forcing temperature provided by Tamsin.
 
+The numeric block is parsed in one call and the metadata columns are stored as
+categorical codes. With a cache directory, the parsed file is kept there as a binary
+file keyed by the sha256 of the file contents, so later runs skip the parsing.
+
 Parameters:
 filename		Name of the file to import
+cache_dir		Directory of the parsed file cache [default = no cache]
 
 Return:
-data_dict		Dictionary of data using the header line as keys. The key for the data 
-				is 'data'.
+data_dict		Dictionary of data using the header line as keys. The key for the data
+				is 'data'. The metadata columns hold categorical codes into the
+				categories of the column, which are under 'categories' (see
+				MetadataTable to filter and decode them).
 
 """
 
+# Version of the cache layout
+CACHE_VERSION = 1
+
+# Missing values in the data block
+NA_PATTERN = re.compile(r"(?<![^,\n])NA(?![^,\n])")
 
-def import_temp_data(filename):
-    # Initialize the data dictionary structure
-    data_dict = {}
+
+def import_temp_data(filename, cache_dir=None):
+    # Use the parsed file from the cache if we have it
+    cache_file = None
+    if cache_dir is not None:
+        key = HashValues(CACHE_VERSION, CachedFileHash(cache_dir, filename))
+        cache_file = CachePath(cache_dir, "forcing", key, ".npz")
+        if os.path.exists(cache_file):
+            return ReadForcingCache(cache_file)
 
     # Load the emulated data file
     with open(filename, "r") as f:
@@ -26,43 +49,70 @@ def import_temp_data(filename):
         header = np.array(header_line.split(","))
 
         # Up to what index is meta data?
-        first_year_idx = np.flatnonzero(header == "2015")
-
-        # Define the data indices
-        data_idx = np.arange(first_year_idx, len(header))
-
-        # Define the meta data indices
-        meta_idx = np.arange(first_year_idx)
-
-        # Extract the years from the header line
-        data_dict["years"] = np.array([int(x) for x in header[data_idx]])
+        first_year_idx = int(np.flatnonzero(header == "2015")[0])
+
+        # Split the meta data from the data on every line
+        lines = f.read().splitlines()
+
+    rows = [x.rstrip().split(",", first_year_idx) for x in lines if x.strip()]
+    ncols = len(header) - first_year_idx
+    if any(len(x) <= first_year_idx or x[-1].count(",") != ncols - 1 for x in rows):
+        raise ValueError(f"Expected {len(header)} columns on every row of {filename}")
+
+    # Parse the data block in one call, with NA as numpy nan
+    data = np.empty((0, ncols), dtype=float)
+    if rows:
+        text = NA_PATTERN.sub("nan", "\n".join(x[-1] for x in rows))
+        try:
+            data = np.loadtxt(text.splitlines(), delimiter=",", dtype=float, ndmin=2)
+        except ValueError:
+            raise ValueError(f"Cannot parse the numeric values in {filename}") from None
+
+    # Extract the years from the header line and the meta data as categorical codes
+    data_dict = {
+        "years": np.array([int(x) for x in header[first_year_idx:]]),
+        "categories": {},
+    }
+    for i in range(first_year_idx):
+        column = np.array([x[i] for x in rows])
+        if np.any(column == "NA"):
+            column = np.where(column == "NA", "nan", column)
+        (categories, codes) = np.unique(column, return_inverse=True)
+        data_dict["categories"][str(header[i])] = categories
+        data_dict[str(header[i])] = codes.astype(np.int32)
+    data_dict["data"] = data
+
+    # Keep the parsed file for later runs
+    if cache_file is not None:
+        WriteForcingCache(cache_file, data_dict)
 
-        # Initialize the data dictionary
-        for i in meta_idx:
-            data_dict[header[i]] = []
-        data_dict["data"] = []
-
-        # Loop through the lines in the file
-        for line in f:
-            # Get the line pieces
-            line = line.rstrip()
-            line_pieces = np.array(line.split(","))
-
-            # Replace NA with numpy nan
-            line_pieces[np.where(line_pieces == "NA")] = np.nan
-
-            # Extract the data from the line
-            data_dict["data"].append([float(x) for x in line_pieces[data_idx]])
-
-            # Extract the meta data
-            for i in meta_idx:
-                data_dict[header[i]].append(line_pieces[i])
+    # Return the data dictionary
+    return data_dict
 
-    # Convert everything into numpy arrays
-    for this_key in data_dict.keys():
-        data_dict[this_key] = np.array(data_dict[this_key])
 
-    # Return the data dictionary
+def WriteForcingCache(cache_file, data_dict):
+    """Writes a parsed forcing file to the cache."""
+    meta_keys = list(data_dict["categories"])
+    arrays = {
+        "meta_keys": np.array(meta_keys, dtype=str),
+        "years": data_dict["years"],
+        "data": data_dict["data"],
+    }
+    for i, key in enumerate(meta_keys):
+        arrays[f"categories_{i}"] = data_dict["categories"][key]
+        arrays[f"codes_{i}"] = data_dict[key]
+    with AtomicOutput(cache_file) as tmp_cache_file:
+        np.savez(tmp_cache_file, **arrays)
+
+
+def ReadForcingCache(cache_file):
+    """Reads a parsed forcing file from the cache."""
+    with np.load(cache_file) as npz:
+        data_dict = {"years": npz["years"], "categories": {}}
+        for i, key in enumerate(npz["meta_keys"]):
+            data_dict["categories"][str(key)] = npz[f"categories_{i}"]
+            data_dict[str(key)] = npz[f"codes_{i}"]
+        data_dict["data"] = npz["data"]
     return data_dict
 
 
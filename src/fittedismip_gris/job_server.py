@@ -0,0 +1,278 @@
+import json
+import logging
+import os
+import queue
+import signal
+import socketserver
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+""" job_server.py
+
+Long-running server of pipeline jobs (the serve command).
+
+The server listens on a local TCP port or Unix socket and speaks HTTP with JSON bodies:
+
+POST /jobs         Submit a job. The body is a job specification: an object mapping the
+                   options of the run command (without the leading dashes) to values,
+                   for example {"scenario": "ssp585", "nsamps": 500, "rngseed": 1,
+                   "location-file": "sites.lst", "gris-local-out-file": "out.nc"}.
+                   Lists repeat an option and true/false set or unset a flag. Returns
+                   202 with the job, or the finished job with ?wait=1. A full queue
+                   returns 503, and an invalid specification 400.
+GET /jobs/ID       Returns the job: its id, status (queued, running, done or failed),
+                   error message and timings.
+GET /status        Returns the number of queued and running jobs, and the number and
+                   size of the resident inputs of this process (null when jobs run in
+                   worker processes).
+
+Jobs are checked when they are submitted, queued in a queue of at most queue_size jobs,
+and run by concurrency worker threads of this process. The runs share the parsed inputs
+held in memory (see resident_inputs.py), so jobs after the first skip the imports and
+most of the input reading. The HDF5 and netCDF libraries are not thread-safe, so the
+serve command runs concurrent jobs in as many worker processes, each with its own
+resident inputs, and the worker threads wait for them. The last MAX_FINISHED_JOBS
+finished jobs are kept for status requests. Relative paths in job specifications are
+relative to the directory of the server.
+
+"""
+
+logger = logging.getLogger(__name__)
+
+# Number of finished jobs kept for status requests
+MAX_FINISHED_JOBS = 1000
+
+
+def JobArguments(spec):
+    """Returns the run command arguments of a job specification."""
+    if not isinstance(spec, dict):
+        raise TypeError("A job specification must be a JSON object of run options")
+    args = []
+    for name, value in spec.items():
+        option = "--" + name.lstrip("-").replace("_", "-")
+        values = value if isinstance(value, list) else [value]
+        for this_value in values:
+            if this_value is True:
+                args.append(option)
+            elif this_value is False:
+                args.append("--no-" + option[2:])
+            elif this_value is not None:
+                args.extend([option, str(this_value)])
+    return args
+
+
+class JobServer:
+    def __init__(self, prepare_job, concurrency=1, queue_size=100):
+        """prepare_job(spec) checks a job specification and returns a function that
+        runs the job. It raises a ValueError for an invalid specification. concurrency
+        is the number of jobs run at a time and queue_size the number of jobs waiting
+        at most."""
+        self.prepare_job = prepare_job
+        self.concurrency = concurrency
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._workers = []
+
+    def Start(self):
+        """Starts the worker threads."""
+        for _ in range(self.concurrency):
+            worker = threading.Thread(target=self._Work, daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def Stop(self):
+        """Runs the queued jobs and stops the worker threads."""
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def Submit(self, spec):
+        """Queues a job and returns its record. Raises a TypeError or ValueError for an
+        invalid specification and queue.Full when the queue is full."""
+        run_job = self.prepare_job(spec)
+        job = {
+            "id": uuid.uuid4().hex,
+            "status": "queued",
+            "error": None,
+            "submitted": time.time(),
+            "started": None,
+            "finished": None,
+        }
+        with self._lock:
+            self._jobs[job["id"]] = (job, threading.Event())
+        try:
+            self._queue.put_nowait((job["id"], run_job))
+        except queue.Full:
+            with self._lock:
+                del self._jobs[job["id"]]
+            raise
+        return dict(job)
+
+    def Job(self, job_id, wait=False):
+        """Returns a copy of the record of a job, or None if there is no such job. With
+        wait, returns once the job has finished."""
+        with self._lock:
+            if job_id not in self._jobs:
+                return None
+            (job, finished) = self._jobs[job_id]
+        if wait:
+            finished.wait()
+        with self._lock:
+            return dict(job)
+
+    def Status(self):
+        """Returns the number of queued and running jobs."""
+        with self._lock:
+            statuses = [job["status"] for job, _ in self._jobs.values()]
+        return {
+            "queued": statuses.count("queued"),
+            "running": statuses.count("running"),
+            "concurrency": self.concurrency,
+        }
+
+    def _Work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            (job_id, run_job) = item
+            with self._lock:
+                (job, finished) = self._jobs[job_id]
+                job["status"] = "running"
+                job["started"] = time.time()
+            logger.info(f"Starting job {job_id}")
+            try:
+                run_job()
+                (status, error) = ("done", None)
+            except ValueError as e:
+                logger.error(f"Job {job_id} failed: {e}")
+                (status, error) = ("failed", str(e))
+            except Exception as e:
+                logger.exception(f"Job {job_id} failed")
+                (status, error) = ("failed", str(e))
+            except SystemExit as e:
+                # click commands exit on errors outside standalone mode
+                (status, error) = ("failed", f"Exited with status {e.code}")
+            with self._lock:
+                job["status"] = status
+                job["error"] = error
+                job["finished"] = time.time()
+                self._ForgetFinished()
+            finished.set()
+            logger.info(f"Finished job {job_id}: {status}")
+
+    def _ForgetFinished(self):
+        # Keep the most recent finished jobs only
+        done = [
+            job_id
+            for job_id, (job, _) in self._jobs.items()
+            if job["finished"] is not None
+        ]
+        for job_id in done[: max(0, len(done) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job_id]
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path.rstrip("/") != "/jobs":
+            self.SendJSON(HTTPStatus.NOT_FOUND, {"error": f"No such path: {url.path}"})
+            return
+
+        # Parse and queue the job
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            spec = json.loads(self.rfile.read(length) or b"{}")
+            job = self.server.jobs.Submit(spec)
+        except (TypeError, ValueError) as e:
+            self.SendJSON(HTTPStatus.BAD_REQUEST, {"error": str(e)})
+            return
+        except queue.Full:
+            self.SendJSON(
+                HTTPStatus.SERVICE_UNAVAILABLE, {"error": "The job queue is full"}
+            )
+            return
+
+        if parse_qs(url.query).get("wait", ["0"])[0] not in ("0", "false", ""):
+            self.SendJSON(HTTPStatus.OK, self.server.jobs.Job(job["id"], wait=True))
+        else:
+            self.SendJSON(HTTPStatus.ACCEPTED, job)
+
+    def do_GET(self):
+        path = urlsplit(self.path).path.rstrip("/")
+        if path == "/status":
+            status = self.server.jobs.Status()
+            resident = self.server.resident
+            status["resident_entries"] = None if resident is None else len(resident)
+            status["resident_bytes"] = None if resident is None else resident.Size()
+            self.SendJSON(HTTPStatus.OK, status)
+            return
+        if path.startswith("/jobs/"):
+            job = self.server.jobs.Job(path[len("/jobs/") :])
+            if job is not None:
+                self.SendJSON(HTTPStatus.OK, job)
+                return
+        self.SendJSON(HTTPStatus.NOT_FOUND, {"error": f"No such path: {path}"})
+
+    def SendJSON(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+def RaiseInterrupt(signum, frame):
+    """Signal handler that stops the server like an interrupt."""
+    raise KeyboardInterrupt
+
+
+class UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def Serve(jobs, resident, host="127.0.0.1", port=8765, socket_path=None):
+    """Serves jobs on host:port, or on the Unix socket socket_path if given, until
+    interrupted. The queued jobs are run before returning. resident holds the resident
+    inputs of the jobs, or is None when they are held by worker processes."""
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, JobRequestHandler)
+        address = socket_path
+    else:
+        server = ThreadingHTTPServer((host, port), JobRequestHandler)
+        address = f"http://{host}:{server.server_address[1]}"
+    server.jobs = jobs
+    server.resident = resident
+
+    # Stop on SIGTERM as on an interrupt
+    signal.signal(signal.SIGTERM, RaiseInterrupt)
+
+    jobs.Start()
+    logger.info(f"Serving jobs on {address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Stopping the job server")
+    finally:
+        server.server_close()
+        jobs.Stop()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
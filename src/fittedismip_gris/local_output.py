@@ -0,0 +1,306 @@
+import functools
+import json
+import os
+
+import numpy as np
+import xarray as xr
+
+from fittedismip_gris.encoding import (
+    INT16_FILL,
+    ParseEncodingProfile,
+    ProfileString,
+)
+from fittedismip_gris.local_quantiles import LocalQuantiles
+from fittedismip_gris.location_shards import SHARD_ATTRIBUTES
+from fittedismip_gris.output_store import WriteDataset
+
+""" local_output.py
+
+Factorized local output files.
+
+Local samples are the global samples scaled by the fingerprint of each site, so a local
+file can hold the [samples, years] global samples and the [locations] fingerprints
+instead of the full [samples, years, locations] product. Factorized files have the
+attribute local_format = "factorized" and record in encoding_profile the encoding the
+product would have in a dense file.
+
+OpenLocalOutput() opens dense and factorized files alike as a Dataset with the variable
+sea_level_change(samples, years, locations). For factorized files the product is a lazy
+dask array, computed on access with the values a dense file would hold.
+ExportLocalOutput() writes a dense file. Any of these may be a netCDF file or a Zarr
+store (see output_store.py).
+
+Quantile files (WriteLocalQuantiles()) hold sea_level_change(quantiles, years, locations),
+the quantiles over the samples of the local samples a dense file would hold.
+
+The local output files of location shards (see location_shards.py) are combined by a
+JSON manifest (WriteShardManifest()) that lists the shard files in location order.
+OpenLocalOutput() opens a manifest as the lazy concatenation of its shards along the
+locations dimension, without copying data, and ExportLocalOutput() writes it to a
+single file.
+
+"""
+
+LOCAL_FORMATS = ("dense", "factorized")
+
+# Manifests of location shards
+MANIFEST_EXTENSION = ".json"
+MANIFEST_FORMAT = "fittedismip-gris-location-shards"
+MANIFEST_VERSION = 1
+
+
+def WriteFactorizedLocal(
+    filename, gissamps, gisfp, targyears, site_ids, site_lats, site_lons, attrs, profile
+):
+    """Writes the global samples and the site fingerprints to a factorized local file.
+    The factors are stored as float64 with the compression of profile, which applies
+    to the product on read."""
+    out = xr.Dataset(
+        {
+            "global_sea_level_change": (
+                ("samples", "years"),
+                gissamps,
+                {"units": "mm"},
+            ),
+            "fingerprint": (("locations"), np.asarray(gisfp, dtype=np.float64)),
+            "lat": (("locations"), site_lats),
+            "lon": (("locations"), site_lons),
+        },
+        coords={
+            "years": targyears,
+            "locations": site_ids,
+            "samples": np.arange(gissamps.shape[0]),
+        },
+        attrs=dict(attrs, local_format="factorized"),
+    )
+
+    # Compress the factors like the product, but keep them at full precision
+    factor_profile = dict(profile, dtype="f8", precision=None, offset=None)
+    WriteDataset(
+        out,
+        filename,
+        {
+            "global_sea_level_change": factor_profile,
+            "fingerprint": dict(factor_profile, chunks=None),
+        },
+    )
+
+
+def WriteLocalQuantiles(
+    filename,
+    gissamps,
+    gisfp,
+    quantiles,
+    targyears,
+    site_ids,
+    site_lats,
+    site_lons,
+    attrs,
+    profile,
+):
+    """Writes the quantiles of the local samples, computed from the global samples and
+    the site fingerprints (see local_quantiles.py). The quantiles are those of the
+    values a dense file with the encoding profile would hold. They are stored at full
+    precision with the compression of profile."""
+    gissl_q = LocalQuantiles(
+        gissamps,
+        gisfp,
+        quantiles,
+        values=functools.partial(ApplyProfileValues, profile=profile),
+    )
+
+    out = xr.Dataset(
+        {
+            "sea_level_change": (
+                ("quantiles", "years", "locations"),
+                gissl_q,
+                {"units": "mm", "missing_value": np.nan},
+            ),
+            "lat": (("locations"), site_lats),
+            "lon": (("locations"), site_lons),
+        },
+        coords={
+            "quantiles": np.asarray(quantiles, dtype=np.float64),
+            "years": targyears,
+            "locations": site_ids,
+        },
+        attrs=dict(attrs, local_format="quantiles", nsamps=gissamps.shape[0]),
+    )
+
+    WriteDataset(
+        out, filename, {"sea_level_change": QuantileProfile(profile, gissl_q.dtype)}
+    )
+
+
+def QuantileProfile(profile, dtype):
+    """Returns the encoding profile of quantiles of this dtype: the compression of
+    profile, keeping the dtype of the quantiles."""
+    return dict(
+        profile,
+        dtype="f4" if dtype == np.float32 else "f8",
+        precision=None,
+        offset=None,
+        chunks=None,
+    )
+
+
+def OpenLocalOutput(filename, chunks=None):
+    """Opens a dense or factorized local output file, or a manifest of location shards.
+    chunks are the dask chunks of the samples and years dimensions of factorized files
+    [default = one chunk]."""
+    if str(filename).lower().endswith(MANIFEST_EXTENSION):
+        return OpenShardManifest(filename, chunks)
+
+    ds = xr.open_dataset(filename, chunks=chunks or {})
+    if ds.attrs.get("local_format") != "factorized":
+        return ds
+
+    profile = ParseEncodingProfile(ds.attrs["encoding_profile"])
+
+    # Scale the global samples by the fingerprints on access
+    gissl = (
+        ds["global_sea_level_change"].data[:, :, np.newaxis]
+        * ds["fingerprint"].data[np.newaxis, np.newaxis, :]
+    )
+    gissl = ApplyProfileValues(gissl, profile)
+
+    out = ds.drop_vars(["global_sea_level_change", "fingerprint"])
+    out["sea_level_change"] = (
+        ("samples", "years", "locations"),
+        gissl,
+        {"units": "mm"},
+    )
+    out.attrs = {x: y for x, y in ds.attrs.items() if x != "local_format"}
+    return out[["sea_level_change", "lat", "lon"]]
+
+
+def ApplyProfileValues(values, profile):
+    """Returns the values a file with this encoding profile returns on read: rounded to
+    the packing precision for i2 and cast to float32 for f4."""
+    if profile["dtype"] == "f4":
+        return values.astype(np.float32)
+    if profile["dtype"] == "i2":
+        packed = np.round((values - profile["offset"]) / profile["precision"])
+        return packed * profile["precision"] + profile["offset"]
+    return values
+
+
+def ExportLocalOutput(in_file, out_file, local_encoding=None):
+    """Writes a local output file as a dense file, with local_encoding or the encoding
+    profile recorded in in_file."""
+    ds = OpenLocalOutput(in_file)
+    profile = ParseEncodingProfile(
+        local_encoding or ds.attrs.get("encoding_profile", "f4-zlib")
+    )
+    ds.attrs["encoding_profile"] = ProfileString(profile)
+    ds["sea_level_change"].encoding = {}
+    ds["sea_level_change"].attrs["missing_value"] = (
+        INT16_FILL if profile["dtype"] == "i2" else np.nan
+    )
+
+    # Quantiles keep their dtype
+    if ds.attrs.get("local_format") == "quantiles":
+        profile = QuantileProfile(profile, ds["sea_level_change"].dtype)
+        ds["sea_level_change"].attrs["missing_value"] = np.nan
+    WriteDataset(ds, out_file, {"sea_level_change": profile})
+    ds.close()
+
+
+def WriteShardManifest(manifest_file, shard_files):
+    """Writes a manifest of the local output files of location shards. The shards must
+    cover every location once and have the same scenario and dimensions."""
+    if not str(manifest_file).lower().endswith(MANIFEST_EXTENSION):
+        raise ValueError(f"Manifest file names must end in {MANIFEST_EXTENSION}")
+    shards = []
+    for shard_file in shard_files:
+        with xr.open_dataset(shard_file) as ds:
+            if "location_shard" not in ds.attrs:
+                raise ValueError(f"{shard_file} is not the output of a location shard")
+            sizes = {x: y for x, y in ds.sizes.items() if x != "locations"}
+            shards.append(
+                {
+                    "path": os.path.abspath(shard_file),
+                    "location_shard": ds.attrs["location_shard"],
+                    "location_start": int(ds.attrs["location_start"]),
+                    "location_stop": int(ds.attrs["location_stop"]),
+                    "nlocations": int(ds.attrs["nlocations"]),
+                    "scenario": str(ds.attrs.get("scenario")),
+                    "sizes": sizes,
+                    "years": ds["years"].values.tolist(),
+                }
+            )
+    if not shards:
+        raise ValueError("No location shards to merge")
+
+    # The shards must follow each other and cover every location
+    shards.sort(key=lambda x: x["location_start"])
+    location_start = 0
+    for shard in shards:
+        if shard["location_start"] != location_start:
+            raise ValueError(
+                f"Missing or overlapping locations at location {location_start} before shard {shard['location_shard']}"
+            )
+        for key in ("nlocations", "scenario", "sizes", "years"):
+            if shard[key] != shards[0][key]:
+                raise ValueError(
+                    f"Location shard {shard['location_shard']} has a different {key} than shard {shards[0]['location_shard']}"
+                )
+        location_start = shard["location_stop"]
+    if location_start != shards[0]["nlocations"]:
+        raise ValueError(
+            f"Missing locations {location_start} to {shards[0]['nlocations']} after the last shard"
+        )
+
+    # Shard paths are relative to the manifest
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_file))
+    manifest = {
+        "format": MANIFEST_FORMAT,
+        "version": MANIFEST_VERSION,
+        "concat_dim": "locations",
+        "nlocations": shards[0]["nlocations"],
+        "shards": [
+            {
+                "path": os.path.relpath(x["path"], manifest_dir),
+                "location_shard": x["location_shard"],
+                "location_start": x["location_start"],
+                "location_stop": x["location_stop"],
+            }
+            for x in shards
+        ],
+    }
+    with open(manifest_file, "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def OpenShardManifest(manifest_file, chunks=None):
+    """Opens the local output files of a manifest of location shards as one lazy
+    dataset, concatenated along the locations dimension."""
+    with open(manifest_file, "r") as f:
+        manifest = json.load(f)
+    if manifest.get("format") != MANIFEST_FORMAT:
+        raise ValueError(f"{manifest_file} is not a manifest of location shards")
+
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_file))
+    shards = [
+        OpenLocalOutput(os.path.join(manifest_dir, x["path"]), chunks)
+        for x in manifest["shards"]
+    ]
+    out = xr.concat(
+        shards,
+        dim=manifest["concat_dim"],
+        data_vars="minimal",
+        coords="minimal",
+        compat="override",
+        join="exact",
+        combine_attrs="override",
+    )
+    out.attrs = {x: y for x, y in out.attrs.items() if x not in SHARD_ATTRIBUTES}
+    return out
+
+
+def MergeLocalShards(manifest_file, shard_files, out_file=None, local_encoding=None):
+    """Writes a manifest of the local output files of location shards, and with
+    out_file, writes the shards to a single local output file."""
+    WriteShardManifest(manifest_file, shard_files)
+    if out_file is not None:
+        ExportLocalOutput(manifest_file, out_file, local_encoding=local_encoding)
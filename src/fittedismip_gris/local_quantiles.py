@@ -0,0 +1,105 @@
+import numpy as np
+
+""" local_quantiles.py
+
+Quantiles of the local samples without building the [samples, years, locations] cube.
+
+Local samples are the global samples times a fingerprint per site, and scaling by a
+scalar preserves the order of the samples (and reverses it where the fingerprint is
+negative). The sorted local samples at a site are therefore the sorted global samples
+scaled by its fingerprint. LocalQuantiles() finds the order statistics of the global
+samples that the quantiles need once per year, scales them for every site and
+interpolates between them like np.quantile(..., method="linear"), so the results are
+exactly those of np.quantile over the samples of the local output.
+
+"""
+
+
+def QuantileIndexes(nsamps, quantiles):
+    """Returns the virtual indexes, the neighbouring indexes and the interpolation
+    weights np.quantile uses for the linear method."""
+    quantiles = np.asanyarray(quantiles)
+    virtual_indexes = np.asanyarray((nsamps - 1) * quantiles)
+
+    previous_indexes = np.floor(virtual_indexes)
+    next_indexes = previous_indexes + 1
+
+    # Beyond the last sample, take the last sample
+    above = virtual_indexes >= nsamps - 1
+    previous_indexes[above] = nsamps - 1
+    next_indexes[above] = nsamps - 1
+
+    # Below the first sample, take the first sample
+    below = virtual_indexes < 0
+    previous_indexes[below] = 0
+    next_indexes[below] = 0
+
+    gamma = np.asanyarray(
+        virtual_indexes - previous_indexes, dtype=virtual_indexes.dtype
+    )
+    return (previous_indexes.astype(np.intp), next_indexes.astype(np.intp), gamma)
+
+
+def Lerp(a, b, t):
+    """Linear interpolation from a to b with weight t, computed like np.quantile."""
+    diff_b_a = b - a
+    lerp_interpolation = np.add(a, diff_b_a * t)
+    np.subtract(
+        b,
+        diff_b_a * (1 - t),
+        out=lerp_interpolation,
+        where=t >= 0.5,
+        casting="unsafe",
+        dtype=type(lerp_interpolation.dtype),
+    )
+    return lerp_interpolation
+
+
+def LocalQuantiles(gissamps, fingerprints, quantiles, values=None, presorted=False):
+    """Returns the [quantiles, years, locations] quantiles over the samples of the local
+    samples gissamps[:, :, None] * fingerprints[None, None, :].
+
+    values is an optional function applied to the local samples before the quantiles
+    are taken, such as the rounding of the output encoding. It must not change the order
+    of the samples. With presorted, gissamps are already sorted along the samples, as
+    by np.sort(gissamps, axis=0), and are not partitioned again.
+    """
+    gissamps = np.asarray(gissamps)
+    fingerprints = np.asarray(fingerprints)
+    nsamps = gissamps.shape[0]
+    quantiles = np.asanyarray(quantiles)
+    if quantiles.ndim != 1:
+        raise ValueError("Quantiles must be a list of values")
+    if np.any((quantiles < 0) | (quantiles > 1)) or np.any(np.isnan(quantiles)):
+        raise ValueError("Quantiles must be in the range [0, 1]")
+
+    (previous_indexes, next_indexes, gamma) = QuantileIndexes(nsamps, quantiles)
+
+    # Order statistics of the global samples used by the quantiles, in ascending order for
+    # sites with positive fingerprints and descending order for negative fingerprints
+    needed = np.concatenate(
+        (previous_indexes, next_indexes, nsamps - 1 - previous_indexes)
+    )
+    needed = np.unique(np.concatenate((needed, nsamps - 1 - next_indexes)))
+    sorted_samps = gissamps if presorted else np.partition(gissamps, needed, axis=0)
+
+    # Scale the order statistics by the fingerprints [quantiles, years, locations]
+    flip = (fingerprints < 0)[np.newaxis, np.newaxis, :]
+
+    def ScaledOrderStatistics(indexes):
+        ascending = sorted_samps[indexes][:, :, np.newaxis]
+        descending = sorted_samps[nsamps - 1 - indexes][:, :, np.newaxis]
+        local = np.where(flip, descending, ascending) * fingerprints
+        return local if values is None else values(local)
+
+    previous = ScaledOrderStatistics(previous_indexes)
+    following = ScaledOrderStatistics(next_indexes)
+
+    # Interpolate between the order statistics
+    result = Lerp(previous, following, gamma.reshape(-1, 1, 1))
+
+    # Years with missing samples have missing quantiles, as in np.quantile
+    missing = np.any(np.isnan(gissamps), axis=0)
+    result[:, missing, :] = np.nan
+
+    return result
@@ -0,0 +1,44 @@
+"""location_shards.py
+
+Splits the locations of a run into shards, so that several runs (on several nodes) can
+each localize a slice of the same location file.
+
+A shard is given as "i/N": the i-th of N shards, counting from 0. Shard i holds the
+locations [i * n // N, (i + 1) * n // N) of the n locations, so the shards of a location
+file are contiguous and in the order of the file. Local output files of a shard record
+the shard in their attributes (see ShardAttributes()), and the merge command combines
+the shard files (see local_output.py).
+
+"""
+
+# Attributes of the local output files of a shard
+SHARD_ATTRIBUTES = ("location_shard", "location_start", "location_stop", "nlocations")
+
+
+def ParseLocationShard(spec):
+    """Returns (i, N) for the shard specification "i/N"."""
+    (index, _, count) = spec.partition("/")
+    try:
+        (index, count) = (int(index), int(count))
+    except ValueError:
+        raise ValueError(f"Expected a location shard i/N, got '{spec}'") from None
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Location shard {spec} must have 0 <= i < N")
+    return (index, count)
+
+
+def ShardSlice(nlocations, shard):
+    """Returns the slice of the nlocations locations in the shard (i, N)."""
+    (index, count) = shard
+    return slice(index * nlocations // count, (index + 1) * nlocations // count)
+
+
+def ShardAttributes(nlocations, shard):
+    """Returns the output file attributes of the shard (i, N)."""
+    locations = ShardSlice(nlocations, shard)
+    return {
+        "location_shard": f"{shard[0]}/{shard[1]}",
+        "location_start": locations.start,
+        "location_stop": locations.stop,
+        "nlocations": nlocations,
+    }
@@ -0,0 +1,121 @@
+import numpy as np
+
+""" metadata_table.py
+
+Indexed metadata of the climate forcing data from import_temp_data().
+
+Each metadata column is held as categorical codes, with a group index mapping every
+value to the rows that hold it. The codes of import_temp_data() are used as they are,
+and columns of strings are encoded. Filtering looks up the requested values in the index
+instead of scanning the columns, and only the filtered rows are decoded to strings. When
+the selected rows (and years) are contiguous, the filtered data are views of the
+original arrays.
+
+"""
+
+
+class MetadataTable:
+    def __init__(self, data_dict):
+        """data_dict is the dictionary returned by import_temp_data(), or one like it with
+        the metadata columns as strings."""
+        self.data_dict = data_dict
+        self.years = data_dict["years"]
+        self.data = data_dict["data"]
+        self.nrows = self.data.shape[0]
+
+        # Categorical codes and group index of each metadata column
+        given_categories = data_dict.get("categories", {})
+        self.categories = {}
+        self.codes = {}
+        self.group_rows = {}
+        self.group_starts = {}
+        for key, column in data_dict.items():
+            if key in ("years", "data", "categories"):
+                continue
+            if key in given_categories:
+                (categories, codes) = (given_categories[key], column)
+            else:
+                (categories, codes) = np.unique(column, return_inverse=True)
+            self.categories[key] = categories
+            self.codes[key] = codes
+
+            # Rows of each value, in row order
+            self.group_rows[key] = np.argsort(codes, kind="stable")
+            self.group_starts[key] = np.searchsorted(
+                codes[self.group_rows[key]], np.arange(categories.size + 1)
+            )
+
+    @property
+    def nbytes(self):
+        """Size in bytes of the arrays of the table."""
+        arrays = [self.years, self.data]
+        for these_arrays in (
+            self.categories,
+            self.codes,
+            self.group_rows,
+            self.group_starts,
+        ):
+            arrays.extend(these_arrays.values())
+        return sum(np.asarray(x).nbytes for x in arrays)
+
+    def ValueRows(self, key, values):
+        """Returns the sorted rows whose key column holds any of values."""
+        categories = self.categories[key]
+        values = np.unique(np.asarray(values, dtype=categories.dtype.kind))
+
+        # Codes of the values that occur in the column
+        idx = np.searchsorted(categories, values)
+        found = idx < categories.size
+        found[found] = categories[idx[found]] == values[found]
+        idx = idx[found]
+
+        # A single value is one group, already in row order
+        starts = self.group_starts[key]
+        rows = [self.group_rows[key][starts[i] : starts[i + 1]] for i in idx]
+        if len(rows) == 1:
+            return rows[0]
+        return np.sort(np.concatenate(rows)) if rows else np.array([], dtype=int)
+
+    def Rows(self, **filters):
+        """Returns the sorted rows that match every filter. filters map a metadata column
+        to a value or a list of values to keep. None filters are ignored."""
+        rows = None
+        for key, values in filters.items():
+            if values is None:
+                continue
+            these_rows = self.ValueRows(key, values)
+            rows = (
+                these_rows
+                if rows is None
+                else np.intersect1d(rows, these_rows, assume_unique=True)
+            )
+        return np.arange(self.nrows) if rows is None else rows
+
+    def Filter(self, rows, years=None):
+        """Returns a data dictionary like import_temp_data() for the rows and the years,
+        using views of the original arrays where they are contiguous."""
+        row_idx = ContiguousIndex(rows)
+
+        # Subset the data for the years requested
+        if years is None:
+            year_idx = slice(None)
+        else:
+            year_idx = ContiguousIndex(np.flatnonzero(np.isin(self.years, years)))
+
+        filtered_data_dict = {}
+        for key, codes in self.codes.items():
+            filtered_data_dict[key] = self.categories[key][codes[row_idx]]
+        filtered_data_dict["years"] = self.years[year_idx]
+        if isinstance(row_idx, slice) or isinstance(year_idx, slice):
+            filtered_data_dict["data"] = self.data[row_idx][:, year_idx]
+        else:
+            filtered_data_dict["data"] = self.data[np.ix_(row_idx, year_idx)]
+
+        return filtered_data_dict
+
+
+def ContiguousIndex(idx):
+    """Returns a slice for sorted indices without gaps, or the indices otherwise."""
+    if idx.size > 0 and idx[-1] - idx[0] + 1 == idx.size:
+        return slice(int(idx[0]), int(idx[-1]) + 1)
+    return idx
@@ -0,0 +1,147 @@
+from fittedismip_gris.encoding import INT16_FILL, ChunkSizes, NetCDFEncoding
+
+""" output_store.py
+
+Writes the output datasets as netCDF files or Zarr stores.
+
+Output file names ending in .zarr are written as Zarr (format 2) directory stores with
+consolidated metadata, so readers open them with a single metadata read. The chunk shape
+of the encoding profile is the Zarr chunk shape, and dask-backed variables are
+rechunked to it so that every dask task writes and compresses whole chunks in
+parallel. Without chunks in the profile, the Zarr chunks follow the dask chunks.
+
+netCDF files cannot be written from a pool of processes, so with the processes dask
+scheduler the data are computed in the pool and then written by this process. Zarr
+stores are written by the processes directly.
+
+Zarr is an optional dependency: pip install "fittedismip-gris[zarr]".
+
+"""
+
+ZARR_EXTENSION = ".zarr"
+
+
+def IsZarrPath(filename):
+    """Returns whether an output file name is a Zarr store."""
+    return filename is not None and str(filename).rstrip("/").lower().endswith(
+        ZARR_EXTENSION
+    )
+
+
+def ImportZarr():
+    """Imports zarr, with a hint to install it when it is missing."""
+    try:
+        import zarr
+    except ImportError:
+        raise ImportError(
+            'Zarr output requires the zarr package. Install it with pip install "fittedismip-gris[zarr]"'
+        ) from None
+    return zarr
+
+
+def ZarrCodecs(profile, itemsize):
+    """Returns the compressors and filters of the profile as numcodecs codecs."""
+    import numcodecs
+
+    if profile["compression"] == "none":
+        return ((), ())
+    level = profile["level"]
+    if profile["compression"] == "zlib":
+        compressor = numcodecs.Zlib(level=4 if level is None else level)
+    elif profile["compression"] == "zstd":
+        compressor = numcodecs.Zstd(level=0 if level is None else level)
+    else:
+        compressor = numcodecs.BZ2(level=1 if level is None else level)
+    filters = (numcodecs.Shuffle(elementsize=itemsize),) if profile["shuffle"] else ()
+    return ((compressor,), filters)
+
+
+def ZarrEncoding(profile, shape):
+    """Returns the xarray Zarr encoding of a variable for this profile."""
+    encoding = {"dtype": profile["dtype"]}
+    if profile["dtype"] == "i2":
+        encoding["scale_factor"] = profile["precision"]
+        encoding["add_offset"] = profile["offset"]
+        encoding["_FillValue"] = INT16_FILL
+    else:
+        encoding["_FillValue"] = float("nan")
+
+    itemsize = int(profile["dtype"][1])
+    (encoding["compressors"], encoding["filters"]) = ZarrCodecs(profile, itemsize)
+
+    chunks = ChunkSizes(profile, shape)
+    if chunks is not None:
+        encoding["chunks"] = chunks
+
+    return encoding
+
+
+def ZarrChunks(ds, encoding):
+    """Rechunks the dask-backed variables of ds to the Zarr chunks of their encoding,
+    and sets the Zarr chunks of dask-backed variables without them to their dask
+    chunks. Variables with Zarr chunks but in memory are chunked with dask so that they
+    are written in parallel."""
+    for name, var_encoding in encoding.items():
+        var = ds[name]
+        if "chunks" in var_encoding:
+            ds[name] = var.chunk(dict(zip(var.dims, var_encoding["chunks"])))
+        elif var.chunks is not None:
+            var_encoding["chunks"] = tuple(x[0] for x in var.chunks)
+    return ds
+
+
+def ProcessesScheduler():
+    """Returns whether dask computes with the processes scheduler."""
+    import dask.multiprocessing
+    from dask.base import get_scheduler
+
+    return get_scheduler() is dask.multiprocessing.get
+
+
+def WriteDataset(ds, filename, profiles):
+    """Writes ds to filename, as a Zarr store if the name ends in .zarr and as a netCDF
+    file otherwise. profiles maps variable names to their encoding profiles."""
+    if not IsZarrPath(filename):
+        if ds.chunks and ProcessesScheduler():
+            ds = ds.compute()
+        ds.to_netcdf(
+            filename,
+            encoding={
+                name: NetCDFEncoding(profile, ds[name].shape)
+                for name, profile in profiles.items()
+            },
+        )
+        return
+
+    ImportZarr()
+    encoding = {
+        name: ZarrEncoding(profile, ds[name].shape)
+        for name, profile in profiles.items()
+    }
+    ds = ZarrChunks(ds.copy(), encoding)
+    ds.to_zarr(filename, mode="w", encoding=encoding, consolidated=True, zarr_format=2)
+
+
+def AppendZarr(ds, filename, profiles, append_dim):
+    """Writes ds to the Zarr store filename, creating it if profiles is given and
+    appending along append_dim otherwise. Metadata is consolidated by
+    ConsolidateZarr()."""
+    ImportZarr()
+    if profiles is None:
+        ds.to_zarr(filename, append_dim=append_dim, consolidated=False)
+        return
+    encoding = {
+        name: ZarrEncoding(profile, ds[name].shape)
+        for name, profile in profiles.items()
+    }
+    ds.to_zarr(filename, mode="w", encoding=encoding, consolidated=False, zarr_format=2)
+
+
+def ConsolidateZarr(filename, attrs=None):
+    """Adds attrs to the root of the Zarr store filename and consolidates its
+    metadata."""
+    zarr = ImportZarr()
+    if attrs:
+        group = zarr.open_group(filename, mode="r+")
+        group.attrs.update(attrs)
+    zarr.consolidate_metadata(filename)
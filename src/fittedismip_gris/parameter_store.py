@@ -0,0 +1,230 @@
+import functools
+import os
+from collections.abc import Mapping
+
+import h5py
+import numpy as np
+
+from fittedismip_gris.cache import (
+    AtomicOutput,
+    CachedFileHash,
+    CachePath,
+    HashFiles,
+    HashValues,
+)
+
+""" parameter_store.py
+
+Lazily loads the fitted ice sheet model parameters.
+
+The parameters of each ice source are read on first access only. They come either from the
+parameter CSV files (see ReadParameterFile()) or from a parameter bundle: a single HDF5 file
+holding the betas, sigmas, group and model codes, and trend mean and sd of every source.
+Numeric arrays in the bundle are stored contiguously and memory-mapped when read.
+
+Bundles record the sha256 of the CSV files they were compiled from. When a cache directory
+is given, bundles are stored there under that hash, so later runs with the same CSV files
+skip parsing them. The hashes of the CSV files are cached too, so unchanged files are not
+read at all. A bundle given explicitly is read as it is if it exists, whatever the CSV
+files, and only compiled if it does not.
+
+"""
+
+# Ice sources and the order of their parameter files
+ICE_SOURCES = ("GIS", "WAIS", "EAIS", "PEN")
+
+# Version of the bundle layout
+BUNDLE_VERSION = 1
+
+
+class ParameterStore:
+    def __init__(
+        self,
+        parm_files=None,
+        trend_mean=None,
+        trend_sd=None,
+        bundle=None,
+        cache_dir=None,
+    ):
+        """parm_files maps ice source to parameter CSV file. trend_mean and trend_sd map
+        ice source to the linear trend terms. bundle is a parameter bundle to read, or to
+        compile from parm_files if it does not exist. An existing bundle is never
+        compiled again. cache_dir is a directory in which to keep bundles compiled from
+        parm_files."""
+        self.parm_files = dict(parm_files) if parm_files else None
+        self._trend_mean = dict(trend_mean) if trend_mean else None
+        self._trend_sd = dict(trend_sd) if trend_sd else None
+        self.bundle = bundle
+        self._sources = {}
+
+        if self.parm_files is None and (bundle is None or not os.path.exists(bundle)):
+            raise ValueError(
+                "Parameter files are required unless an existing parameter bundle is given"
+            )
+
+        if bundle is not None and os.path.exists(bundle):
+            # Read an existing bundle as it is
+            if BundleSourceHash(bundle) is None:
+                raise ValueError(
+                    f"{bundle} is not a parameter bundle of version {BUNDLE_VERSION}. Remove it to compile it from the parameter files."
+                )
+        elif self.parm_files is not None and (
+            bundle is not None or cache_dir is not None
+        ):
+            # Find or compile the bundle for these parameter files
+            source_hash = self.SourceHash(cache_dir)
+            if bundle is None:
+                self.bundle = CachePath(cache_dir, "parameters", source_hash, ".h5")
+            if BundleSourceHash(self.bundle) != source_hash:
+                CompileParameterBundle(
+                    self.bundle,
+                    self.parm_files,
+                    self._trend_mean,
+                    self._trend_sd,
+                    source_hash,
+                )
+
+    def __getstate__(self):
+        # Memory-mapped arrays are reloaded rather than pickled
+        state = self.__dict__.copy()
+        state["_sources"] = {}
+        return state
+
+    def SourceHash(self, cache_dir=None):
+        """Hash of the parameter file contents and trend terms. With cache_dir, the hashes
+        of files with the same size and modification time as in an earlier run are
+        reused (see CachedFileHash())."""
+        file_hash = (
+            HashFiles
+            if cache_dir is None
+            else functools.partial(CachedFileHash, cache_dir)
+        )
+        return HashValues(
+            [file_hash(self.parm_files[x]) for x in ICE_SOURCES],
+            self._trend_mean,
+            self._trend_sd,
+        )
+
+    def Source(self, icesource):
+        """Returns a dictionary with the groups, models, betas and sigmas of icesource,
+        loading them on first access."""
+        if icesource not in self._sources:
+            if self.bundle is not None:
+                self._sources[icesource] = ReadBundleSource(self.bundle, icesource)
+            else:
+                # Imported here to avoid a circular import with the fit stage
+                from fittedismip_gris.FittedISMIP_GrIS_fit import ReadParameterFile
+
+                (groups, models, betas, sigmas) = ReadParameterFile(
+                    self.parm_files[icesource]
+                )
+                self._sources[icesource] = {
+                    "groups": groups,
+                    "models": models,
+                    "betas": betas,
+                    "sigmas": sigmas,
+                }
+        return self._sources[icesource]
+
+    def Field(self, field):
+        """Returns a mapping from ice source to one field of its parameters."""
+        return SourceFieldMapping(self, field)
+
+    @property
+    def trend_mean(self):
+        if self.bundle is not None:
+            return ReadBundleTrends(self.bundle)[0]
+        return self._trend_mean
+
+    @property
+    def trend_sd(self):
+        if self.bundle is not None:
+            return ReadBundleTrends(self.bundle)[1]
+        return self._trend_sd
+
+
+class SourceFieldMapping(Mapping):
+    """Read-only mapping from ice source to one field of its parameters. The parameters
+    of a source are loaded the first time it is looked up."""
+
+    def __init__(self, store, field):
+        self.store = store
+        self.field = field
+
+    def __getitem__(self, icesource):
+        if icesource not in ICE_SOURCES:
+            raise KeyError(icesource)
+        return self.store.Source(icesource)[self.field]
+
+    def __iter__(self):
+        return iter(ICE_SOURCES)
+
+    def __len__(self):
+        return len(ICE_SOURCES)
+
+
+def CompileParameterBundle(bundle, parm_files, trend_mean, trend_sd, source_hash):
+    """Parses the parameter files and writes them to a parameter bundle."""
+    from fittedismip_gris.FittedISMIP_GrIS_fit import ReadParameterFile
+
+    with AtomicOutput(bundle) as tmp_bundle, h5py.File(tmp_bundle, "w") as hf:
+        hf.attrs["version"] = BUNDLE_VERSION
+        hf.attrs["source_hash"] = source_hash
+        for icesource in ICE_SOURCES:
+            (groups, models, betas, sigmas) = ReadParameterFile(parm_files[icesource])
+            (group_names, group_codes) = np.unique(groups, return_inverse=True)
+            (model_names, model_codes) = np.unique(models, return_inverse=True)
+
+            g = hf.create_group(icesource)
+            g["betas"] = betas.astype(np.float64)
+            g["sigmas"] = sigmas.astype(np.float64)
+            g["group_codes"] = group_codes.astype(np.int32)
+            g["model_codes"] = model_codes.astype(np.int32)
+            g["group_names"] = group_names.astype(h5py.string_dtype())
+            g["model_names"] = model_names.astype(h5py.string_dtype())
+            g.attrs["trend_mean"] = trend_mean[icesource]
+            g.attrs["trend_sd"] = trend_sd[icesource]
+
+
+def BundleSourceHash(bundle):
+    """Returns the source hash recorded in a parameter bundle, or None if there is no
+    usable bundle."""
+    if bundle is None or not os.path.exists(bundle):
+        return None
+    try:
+        with h5py.File(bundle, "r") as hf:
+            if hf.attrs.get("version") != BUNDLE_VERSION:
+                return None
+            return hf.attrs.get("source_hash")
+    except OSError:
+        return None
+
+
+def ReadBundleSource(bundle, icesource):
+    with h5py.File(bundle, "r") as hf:
+        g = hf[icesource]
+        group_names = np.array(g["group_names"].asstr()[()], dtype=str)
+        model_names = np.array(g["model_names"].asstr()[()], dtype=str)
+        return {
+            "groups": group_names[MapDataset(bundle, g["group_codes"])],
+            "models": model_names[MapDataset(bundle, g["model_codes"])],
+            "betas": MapDataset(bundle, g["betas"]),
+            "sigmas": MapDataset(bundle, g["sigmas"]),
+        }
+
+
+def ReadBundleTrends(bundle):
+    with h5py.File(bundle, "r") as hf:
+        trend_mean = {x: float(hf[x].attrs["trend_mean"]) for x in ICE_SOURCES}
+        trend_sd = {x: float(hf[x].attrs["trend_sd"]) for x in ICE_SOURCES}
+    return (trend_mean, trend_sd)
+
+
+def MapDataset(filename, dataset):
+    """Memory-maps a contiguous HDF5 dataset, or reads it if it cannot be mapped."""
+    offset = dataset.id.get_offset()
+    if dataset.chunks is not None or offset is None:
+        return dataset[()]
+    return np.memmap(
+        filename, mode="r", dtype=dataset.dtype, shape=dataset.shape, offset=offset
+    )
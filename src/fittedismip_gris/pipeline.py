@@ -0,0 +1,548 @@
+import functools
+import logging
+from contextlib import ExitStack
+
+import h5py
+import numpy as np
+
+from fittedismip_gris.cache import AtomicOutput
+from fittedismip_gris.dask_scheduler import CheckDaskScheduler, DaskScheduler
+from fittedismip_gris.encoding import ParseEncodingProfile
+from fittedismip_gris.FittedISMIP_GrIS_fit import (
+    TREND_MEAN,
+    TREND_SD,
+    FittedISMIP_fit_icesheet,
+)
+from fittedismip_gris.FittedISMIP_GrIS_postprocess import (
+    FittedISMIP_postprocess_icesheet,
+    LoadSiteFingerprints,
+)
+from fittedismip_gris.FittedISMIP_GrIS_preprocess import (
+    FittedISMIP_preprocess_icesheet,
+)
+from fittedismip_gris.FittedISMIP_GrIS_project import (
+    PROJECTED_ICE_SOURCES,
+    FittedISMIP_project_icesheet,
+    LoadProjection,
+    WriteProjection,
+)
+from fittedismip_gris.import_temp_data import import_temp_data
+from fittedismip_gris.metadata_table import MetadataTable
+from fittedismip_gris.resident_inputs import FileStamp, Resident
+from fittedismip_gris.sampling import ShardSize
+from fittedismip_gris.stage_checkpoints import (
+    DEFAULT_CHECKPOINT_SIZE,
+    STAGES,
+    CheckpointPath,
+    EvictCheckpoints,
+    FitCheckpoint,
+    FitKey,
+    LoadCheckpoint,
+    LoadPreprocessCheckpoint,
+    LoadStage,
+    PreprocessKey,
+    ProjectKey,
+    ResumeStage,
+    SaveCheckpoint,
+    SavePreprocessCheckpoint,
+    StageRange,
+)
+from fittedismip_gris.tlim_index import LoadTlimIndex
+
+""" pipeline.py
+
+Runs the preprocess, fit, project and postprocess stages for one or more scenarios.
+
+Inputs that do not depend on the scenario (the model parameters, the site fingerprints
+and the climate file handle) are loaded once and shared by all scenarios.
+
+Output file names may contain a "{scenario}" placeholder, or one file name may be given
+per scenario.
+
+With a cache directory, the preprocessed temperature ensembles are cached there and
+memory-mapped (see temperature_cache.py). The index of temperature target samples is
+built once per climate file (see tlim_index.py).
+
+With a location shard, only the locations of the shard are localized, and local output
+file names may contain a "{shard}" placeholder (see location_shards.py). With global
+input files, the global projections of an earlier run are localized instead, and the
+preprocess, fit and project stages are skipped.
+
+The dask computations of the postprocess stage run on the selected dask scheduler (see
+dask_scheduler.py).
+
+With a cache directory, the outputs of the preprocess, fit and project stages are
+checkpointed there and reused by later runs with the same inputs, and a run can start or
+stop at any stage (see stage_checkpoints.py). The checkpoints of each stage take at most
+checkpoint_size MB.
+
+With resident inputs, the parsed inputs (the open climate file, parameters, site
+fingerprints and preprocessed temperatures) are kept in memory across runs (see
+resident_inputs.py).
+
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def ExpandOutputPaths(paths, scenarios, name="output file"):
+    """Returns one output path per scenario from a template or a list of paths."""
+    # Nothing requested
+    if not paths:
+        return [None] * len(scenarios)
+
+    # A single path or template for all scenarios
+    if isinstance(paths, str):
+        paths = [paths]
+    if len(paths) == 1:
+        if "{scenario}" in paths[0]:
+            return [paths[0].replace("{scenario}", s) for s in scenarios]
+        if len(scenarios) == 1:
+            return list(paths)
+        raise ValueError(
+            f"Multiple scenarios need a {name} template containing '{{scenario}}' or one {name} per scenario"
+        )
+
+    # One path per scenario
+    if len(paths) != len(scenarios):
+        raise ValueError(
+            f"Got {len(paths)} values for {name} but {len(scenarios)} scenarios"
+        )
+    return list(paths)
+
+
+def RunFit(
+    fit_key=None, from_stage=None, checkpoint_size=DEFAULT_CHECKPOINT_SIZE, **fit_args
+):
+    """Returns the output of the fit stage for fit_args, from its checkpoint if there is
+    one with fit_key and storing it otherwise (see stage_checkpoints.py). The checkpoint
+    holds the parameters of the projected ice sources only."""
+    cache_dir = fit_args.get("cache_dir")
+    if fit_key is not None:
+        fit_file = ResumeStage(cache_dir, "fit", fit_key, from_stage)
+        if fit_file is not None:
+            fit_dict = LoadStage(cache_dir, "fit", fit_file, LoadCheckpoint, from_stage)
+            if fit_dict is not None:
+                logger.info(f"Reusing the fitted parameters: {fit_file}")
+                return fit_dict
+
+    logger.info("Starting fitting step...")
+    fit_dict = FittedISMIP_fit_icesheet(**fit_args)
+    if fit_key is not None:
+        SaveCheckpoint(
+            CheckpointPath(cache_dir, "fit", fit_key),
+            FitCheckpoint(fit_dict, PROJECTED_ICE_SOURCES),
+        )
+        EvictCheckpoints(cache_dir, "fit", fit_key, checkpoint_size)
+    logger.info("Finished fitting step")
+    return fit_dict
+
+
+def run_pipeline(
+    scenarios,
+    tlm_flag,
+    climate_data_file,
+    climate_forcing_file,
+    pipeline_id,
+    gris_parm_file,
+    wais_parm_file,
+    eais_parm_file,
+    pen_parm_file,
+    parm_bundle,
+    cache_dir,
+    temp_cache_size,
+    nsamps,
+    pyear_start,
+    pyear_end,
+    pyear_step,
+    cyear_start,
+    cyear_end,
+    baseyear,
+    rngseed,
+    engine,
+    sampling,
+    workers,
+    shard_size,
+    block_size,
+    adaptive,
+    adaptive_batch,
+    adaptive_quantiles,
+    adaptive_years,
+    adaptive_tol,
+    location_file,
+    chunksize,
+    fingerprint_dir,
+    gris_global_out_file,
+    gris_local_out_file,
+    global_encoding,
+    local_encoding,
+    local_format,
+    quantiles,
+    location_shard=None,
+    global_in_file=None,
+    dask_scheduler=None,
+    dask_workers=None,
+    dask_memory_limit=None,
+    dask_performance_report=None,
+    from_stage=None,
+    until_stage=None,
+    resident=None,
+    checkpoint_size=DEFAULT_CHECKPOINT_SIZE,
+):
+    if isinstance(scenarios, str):
+        scenarios = [scenarios]
+
+    # Check the encoding profiles and scheduler options before doing any work
+    ParseEncodingProfile(global_encoding)
+    ParseEncodingProfile(local_encoding)
+    CheckDaskScheduler(
+        dask_scheduler, dask_workers, dask_memory_limit, dask_performance_report
+    )
+
+    global_out_files = ExpandOutputPaths(
+        gris_global_out_file, scenarios, "global output file"
+    )
+    local_out_files = ExpandOutputPaths(
+        gris_local_out_file, scenarios, "local output file"
+    )
+    global_in_files = ExpandOutputPaths(global_in_file, scenarios, "global input file")
+
+    # Each location shard writes its own local output file
+    if location_shard is not None:
+        local_out_files = [
+            None if x is None else x.replace("{shard}", str(location_shard[0]))
+            for x in local_out_files
+        ]
+
+    # Reuse the global projections of an earlier run instead of projecting again
+    reuse_projection = global_in_files[0] is not None
+    if reuse_projection and global_out_files[0] is not None:
+        raise ValueError(
+            "A global input file cannot be combined with a global output file"
+        )
+    if not reuse_projection and climate_data_file is None:
+        raise ValueError("A climate data file is needed to run the projection stage")
+
+    # Stages to run, and the checkpoints of the stages before them
+    last_stage = StageRange(from_stage, until_stage)[1]
+    if (from_stage is not None or until_stage is not None) and cache_dir is None:
+        raise ValueError("Starting or stopping at a stage needs a cache directory")
+    if reuse_projection and (from_stage is not None or until_stage is not None):
+        raise ValueError(
+            "A global input file cannot be combined with starting or stopping at a stage"
+        )
+    checkpoint = cache_dir is not None and not reuse_projection
+    run_project = last_stage >= STAGES.index("project")
+    run_postprocess = last_stage >= STAGES.index("postprocess")
+    fit_key = None
+    if checkpoint:
+        fit_key = FitKey(
+            cache_dir,
+            [gris_parm_file, wais_parm_file, eais_parm_file, pen_parm_file],
+            parm_bundle,
+            TREND_MEAN,
+            TREND_SD,
+        )
+
+    # Projection options, in the key of the project checkpoints
+    project_options = {
+        "nsamps": nsamps,
+        "pyear_start": pyear_start,
+        "pyear_end": pyear_end,
+        "pyear_step": pyear_step,
+        "cyear_start": cyear_start,
+        "cyear_end": cyear_end,
+        "baseyear": baseyear,
+        "rngseed": rngseed,
+        "engine": engine,
+        "sampling": sampling,
+        "sharded": workers is not None,
+        "shard_size": ShardSize(shard_size, sampling),
+        "block_size": block_size,
+        "adaptive": adaptive,
+        "adaptive_batch": adaptive_batch,
+        "adaptive_quantiles": adaptive_quantiles,
+        "adaptive_years": adaptive_years,
+        "adaptive_tol": adaptive_tol,
+        "global_encoding": global_encoding if block_size is not None else None,
+    }
+
+    # Fit (does not depend on the scenario), run on first use
+    fit_dict = None
+
+    # Site locations and fingerprints (do not depend on the scenario)
+    site_dict = None
+
+    # Only the projection years and the base year are read from the climate file
+    climate_years = np.append(
+        np.arange(pyear_start, pyear_end + 1, pyear_step), baseyear
+    )
+
+    # Keep the climate file open across scenarios (and across runs, with resident
+    # inputs)
+    climate_file = climate_data_file
+    close_climate_file = False
+    if tlm_flag != 0 and not reuse_projection:
+        if resident is None:
+            climate_file = h5py.File(climate_data_file, "r")
+            close_climate_file = True
+        else:
+            climate_file = resident.Get(
+                "climate",
+                FileStamp(climate_data_file),
+                functools.partial(h5py.File, climate_data_file, "r"),
+            )
+
+    # Index of the temperature target samples, shared by all tlim scenarios
+    tlim_index = None
+
+    # Indexed climate forcing, shared by all scenarios
+    forcing_table = None
+    if tlm_flag == 0 and not reuse_projection:
+        forcing_table = Resident(
+            resident,
+            "forcing",
+            FileStamp(climate_forcing_file),
+            lambda: MetadataTable(
+                import_temp_data(climate_forcing_file, cache_dir=cache_dir)
+            ),
+        )
+
+    # Dask scheduler of the postprocess stage, shared by all scenarios
+    dask_context = ExitStack()
+
+    try:
+        dask_context.enter_context(
+            DaskScheduler(
+                dask_scheduler,
+                workers=dask_workers,
+                memory_limit=dask_memory_limit,
+                performance_report=dask_performance_report,
+            )
+        )
+        for scenario, global_out_file, local_out_file, this_global_in_file in zip(
+            scenarios, global_out_files, local_out_files, global_in_files
+        ):
+            # Read the global samples of an earlier run lazily
+            if reuse_projection:
+                project_dict = LoadProjection(this_global_in_file, block_size)
+                if project_dict["scenario"] != scenario:
+                    raise ValueError(
+                        f"Global input file {this_global_in_file} holds scenario {project_dict['scenario']}, not {scenario}"
+                    )
+            else:
+                # Checkpoint keys of the stages for this scenario
+                preprocess_key = project_key = None
+                if checkpoint:
+                    preprocess_key = PreprocessKey(
+                        cache_dir,
+                        scenario,
+                        tlm_flag,
+                        climate_data_file,
+                        climate_forcing_file,
+                        climate_years,
+                        nsamps,
+                        baseyear,
+                    )
+                    project_key = ProjectKey(preprocess_key, fit_key, project_options)
+
+                # Reuse the projection of an earlier run with the same inputs
+                project_file = None
+                if checkpoint and run_project:
+                    project_file = ResumeStage(
+                        cache_dir, "project", project_key, from_stage
+                    )
+                project_dict = None
+                if project_file is not None:
+                    project_dict = LoadStage(
+                        cache_dir,
+                        "project",
+                        project_file,
+                        functools.partial(LoadProjection, block_size=block_size),
+                        from_stage,
+                    )
+                if project_dict is not None:
+                    logger.info(f"Reusing the projection of {scenario}: {project_file}")
+                    if global_out_file is not None:
+                        WriteProjection(
+                            project_dict, global_out_file, pipeline_id, global_encoding
+                        )
+                else:
+                    # Preprocess
+                    preprocess_file = None
+                    if checkpoint:
+                        preprocess_file = ResumeStage(
+                            cache_dir, "preprocess", preprocess_key, from_stage
+                        )
+                    preprocess_dict = None
+                    if preprocess_file is not None:
+                        preprocess_dict = LoadStage(
+                            cache_dir,
+                            "preprocess",
+                            preprocess_file,
+                            LoadPreprocessCheckpoint,
+                            from_stage,
+                        )
+                    if preprocess_dict is not None:
+                        logger.info(
+                            f"Reusing the preprocessed data of {scenario}: {preprocess_file}"
+                        )
+                    else:
+                        logger.info(f"Starting preprocessing step for {scenario}...")
+                        if (
+                            tlm_flag != 0
+                            and tlim_index is None
+                            and scenario.startswith("tlim")
+                        ):
+                            tlim_index = Resident(
+                                resident,
+                                "tlim",
+                                FileStamp(climate_data_file),
+                                functools.partial(
+                                    LoadTlimIndex, climate_file, cache_dir=cache_dir
+                                ),
+                            )
+                        preprocess_dict = Resident(
+                            resident,
+                            "preprocess",
+                            (
+                                FileStamp(climate_data_file),
+                                FileStamp(climate_forcing_file),
+                                scenario,
+                                tlm_flag,
+                                climate_years.tolist(),
+                                nsamps,
+                                baseyear,
+                            ),
+                            functools.partial(
+                                FittedISMIP_preprocess_icesheet,
+                                scenario=scenario,
+                                tlm_flag=tlm_flag,
+                                pipeline_id=pipeline_id,
+                                climate_file=climate_file,
+                                years=climate_years,
+                                nsamps=nsamps,
+                                baseyear=baseyear,
+                                cache_dir=cache_dir,
+                                cache_size=temp_cache_size,
+                                tlim_index=tlim_index,
+                                forcing_file=climate_forcing_file,
+                                forcing_table=forcing_table,
+                            ),
+                        )
+                        if checkpoint:
+                            SavePreprocessCheckpoint(
+                                CheckpointPath(cache_dir, "preprocess", preprocess_key),
+                                preprocess_dict,
+                            )
+                            EvictCheckpoints(
+                                cache_dir, "preprocess", preprocess_key, checkpoint_size
+                            )
+                        logger.info("Finished preprocessing step")
+                    if last_stage < STAGES.index("fit"):
+                        continue
+
+                    # Fit (does not depend on the scenario)
+                    if fit_dict is None:
+                        fit_dict = Resident(
+                            resident,
+                            "fit",
+                            [
+                                FileStamp(x)
+                                for x in (
+                                    gris_parm_file,
+                                    wais_parm_file,
+                                    eais_parm_file,
+                                    pen_parm_file,
+                                    parm_bundle,
+                                )
+                            ],
+                            functools.partial(
+                                RunFit,
+                                fit_key if checkpoint else None,
+                                from_stage,
+                                checkpoint_size,
+                                pipeline_id=pipeline_id,
+                                gris_parm_file=gris_parm_file,
+                                wais_parm_file=wais_parm_file,
+                                eais_parm_file=eais_parm_file,
+                                pen_parm_file=pen_parm_file,
+                                parm_bundle=parm_bundle,
+                                cache_dir=cache_dir,
+                            ),
+                        )
+                    if not run_project:
+                        continue
+
+                    # Project
+                    logger.info(f"Starting projection step for {scenario}...")
+                    project_dict = FittedISMIP_project_icesheet(
+                        preprocess_dict=preprocess_dict,
+                        fit_dict=fit_dict,
+                        nsamps=nsamps,
+                        pyear_start=pyear_start,
+                        pyear_end=pyear_end,
+                        pyear_step=pyear_step,
+                        cyear_start=cyear_start,
+                        cyear_end=cyear_end,
+                        baseyear=baseyear,
+                        rngseed=rngseed,
+                        pipeline_id=pipeline_id,
+                        gris_global_out_file=global_out_file,
+                        engine=engine,
+                        sampling=sampling,
+                        workers=workers,
+                        shard_size=shard_size,
+                        block_size=block_size,
+                        adaptive=adaptive,
+                        adaptive_batch=adaptive_batch,
+                        adaptive_quantiles=adaptive_quantiles,
+                        adaptive_years=adaptive_years,
+                        adaptive_tol=adaptive_tol,
+                        global_encoding=global_encoding,
+                    )
+                    if checkpoint:
+                        project_file = CheckpointPath(cache_dir, "project", project_key)
+                        with AtomicOutput(project_file) as tmp_project_file:
+                            WriteProjection(project_dict, tmp_project_file, pipeline_id)
+                        EvictCheckpoints(
+                            cache_dir, "project", project_key, checkpoint_size
+                        )
+                    logger.info("Finished projection step")
+
+            if not run_postprocess:
+                continue
+
+            # Postprocess
+            logger.info(f"Starting postprocessing step for {scenario}...")
+            if site_dict is None:
+                site_dict = Resident(
+                    resident,
+                    "sites",
+                    (FileStamp(location_file), fingerprint_dir, location_shard),
+                    functools.partial(
+                        LoadSiteFingerprints,
+                        location_file,
+                        fingerprint_dir,
+                        cache_dir=cache_dir,
+                        location_shard=location_shard,
+                    ),
+                )
+            FittedISMIP_postprocess_icesheet(
+                projection_dict=project_dict,
+                locationfile=location_file,
+                chunksize=chunksize,
+                pipeline_id=pipeline_id,
+                fpdir=fingerprint_dir,
+                gris_local_out_file=local_out_file,
+                site_dict=site_dict,
+                local_encoding=local_encoding,
+                local_format=local_format,
+                quantiles=quantiles,
+            )
+            logger.info("Finished postprocessing step")
+
+    finally:
+        dask_context.close()
+        if close_climate_file:
+            climate_file.close()
@@ -0,0 +1,86 @@
+import os
+
+import numpy as np
+
+from fittedismip_gris.FittedISMIP_GrIS_project import LoadProjection
+from fittedismip_gris.fp_weights import BilinearCells
+from fittedismip_gris.local_quantiles import LocalQuantiles
+from fittedismip_gris.ReadFingerprint import ReadFingerprint
+
+""" point_query.py
+
+Local projections at arbitrary points, without location files or output files.
+
+A PointQuery holds the global samples of a projection (a global output file, or the
+project checkpoint of a run) and the fingerprint grid in memory, with the latitude order
+of the grid precomputed. Each query interpolates the fingerprint to the points with the
+bilinear stencils of fp_weights.py and scales the global samples by it, for any number
+of points at once. The fingerprints, samples and quantiles equal those of the
+postprocess stage for the same points (see AssignFP() and local_quantiles.py).
+
+Example:
+query = PointQuery("global.nc", "fingerprints/fprint_gis.nc")
+query.Quantiles([40.7, 51.5], [-74.01, 0.1], [0.05, 0.5, 0.95])  # [quantiles, years, points]
+
+"""
+
+# Fingerprint file of the Greenland ice sheet in a fingerprint directory
+GIS_FINGERPRINT = "fprint_gis.nc"
+
+
+class PointQuery:
+    def __init__(self, global_file, fingerprint_file):
+        """global_file is a global output file and fingerprint_file the fingerprint to
+        localize it with."""
+        projection = LoadProjection(global_file)
+        self.scenario = projection["scenario"]
+        self.baseyear = projection["baseyear"]
+        self.years = np.asarray(projection["targyears"])
+        self.samples = np.asarray(projection["samps_dict"]["GIS"], dtype=np.float64)
+        self.sorted_samples = np.sort(self.samples, axis=0)
+
+        # Fingerprint grid, with the order of its latitudes
+        (fp, fp_lats, fp_lons) = ReadFingerprint(fingerprint_file)
+        self.fp = np.asarray(fp, dtype=np.float64).ravel()
+        self.lats = np.asarray(fp_lats, dtype=np.float64)
+        self.lons = np.asarray(fp_lons, dtype=np.float64)
+        self.lat_sort = np.argsort(self.lats)
+        self.sorted_lats = self.lats[self.lat_sort]
+
+    @classmethod
+    def FromFingerprintDir(cls, global_file, fpdir):
+        """Returns a PointQuery with the Greenland fingerprint of a fingerprint
+        directory, as used by the postprocess stage."""
+        return cls(global_file, os.path.join(fpdir, GIS_FINGERPRINT))
+
+    def Fingerprints(self, lats, lons):
+        """Returns the fingerprint at each point. lons may be in [-180, 180] or
+        [0, 360)."""
+        lats = np.atleast_1d(np.asarray(lats, dtype=np.float64))
+        lons = np.mod(np.atleast_1d(np.asarray(lons, dtype=np.float64)), 360)
+        if lats.shape != lons.shape or lats.ndim != 1:
+            raise ValueError("Expected one latitude and longitude per point")
+        (cells, weights) = BilinearCells(
+            self.sorted_lats, self.lat_sort, self.lons, lats, lons
+        )
+
+        # Add the weighted cells in increasing cell order, as the sparse product of
+        # ApplyWeights() does, so the values are the same to the last bit
+        terms = np.where(weights != 0, weights * self.fp[cells], 0.0)
+        fp_points = terms[:, 0] + terms[:, 1] + terms[:, 2] + terms[:, 3]
+
+        return fp_points * 1000
+
+    def Samples(self, lats, lons):
+        """Returns the [samples, years, points] local samples at the points."""
+        return np.multiply.outer(self.samples, self.Fingerprints(lats, lons))
+
+    def Quantiles(self, lats, lons, quantiles):
+        """Returns the [quantiles, years, points] quantiles of the local samples at the
+        points."""
+        return LocalQuantiles(
+            self.sorted_samples,
+            self.Fingerprints(lats, lons),
+            quantiles,
+            presorted=True,
+        )
@@ -1,5 +1,9 @@
+import os
+
 import numpy as np
-import re
+from netCDF4 import Dataset
+
+from fittedismip_gris.cache import AtomicOutput, CachedFileHash, CachePath, HashValues
 
 """ read_locationfile.py
 
@@ -7,47 +11,189 @@ Reads in the location file in order to get site names, site ids, lats, and lons
 
 Parameters:
 location_file = Background Rate file
+cache_dir = Directory in which to keep the parsed location file [default = no cache]
+
+location_file is one of:
+- A tab-separated file of name, id, lat and lon, with comment lines starting with #
+- A CSV file (.csv) with a header line naming the columns lat, lon and optionally id
+  and name
+- A NetCDF file (.nc) with lat and lon variables and optionally id (or a locations
+  coordinate) and name variables, such as a local output file
+- A regular lat/lon grid "grid:STEP[:SOUTH,NORTH,WEST,EAST]", where STEP is the grid
+  spacing in degrees or "DLAT,DLON". The bounding box includes its edges and defaults
+  to the globe. Sites are numbered from 0 along longitudes first.
+
+Files are parsed in bulk into typed arrays. With a cache directory, the parsed file is
+kept there as a binary file keyed by the sha256 of the file contents.
 
 """
 
+# Version of the cache layout
+CACHE_VERSION = 1
 
-def ReadLocationFile(location_file):
-    # Initialize variables to hold data and site information
-    names = []
-    ids = []
-    lats = []
-    lons = []
+# Prefix of grid specifications
+GRID_PREFIX = "grid:"
 
-    # Compile the regex for finding commented lines
-    comment_regex = re.compile(r"^#")
 
-    # Open the rate file
-    with open(location_file, "r") as f:
-        # Loop over the lines of the file
-        for line in f:
-            # Skip commented lines
-            if re.search(comment_regex, line):
-                continue
-
-            # Split the line into components
-            (this_name, this_id, this_lat, this_lon) = line.split("\t")
-
-            # Store the information
-            names.append(this_name)
-            ids.append(int(this_id))
-            lats.append(float(this_lat))
-            lons.append(float(this_lon))
-
-    # Cast everything as numpy arrays
-    names = np.array(names)
-    ids = np.array(ids)
-    lats = np.array(lats)
-    lons = np.array(lons)
+def ReadLocationFile(location_file, cache_dir=None):
+    # Generate grids instead of reading a file
+    if location_file.startswith(GRID_PREFIX):
+        return GridLocations(location_file[len(GRID_PREFIX) :])
+
+    # Use the parsed file from the cache if we have it
+    cache_file = None
+    if cache_dir is not None:
+        key = HashValues(
+            CACHE_VERSION,
+            os.path.splitext(location_file)[1].lower(),
+            CachedFileHash(cache_dir, location_file),
+        )
+        cache_file = CachePath(cache_dir, "locations", key, ".npz")
+        if os.path.exists(cache_file):
+            with np.load(cache_file) as npz:
+                return (npz["names"], npz["ids"], npz["lats"], npz["lons"])
+
+    # Parse the file according to its format
+    extension = os.path.splitext(location_file)[1].lower()
+    if extension == ".csv":
+        locations = ReadLocationCSV(location_file)
+    elif extension == ".nc":
+        locations = ReadLocationNetCDF(location_file)
+    else:
+        locations = ReadLocationText(location_file)
+
+    # Keep the parsed file for later runs
+    if cache_file is not None:
+        (names, ids, lats, lons) = locations
+        with AtomicOutput(cache_file) as tmp_cache_file:
+            np.savez(tmp_cache_file, names=names, ids=ids, lats=lats, lons=lons)
 
     # Return variables
+    return locations
+
+
+def ReadLines(location_file, skip_comments=True):
+    """Returns the lines of a file without blank lines and, with skip_comments, lines
+    starting with #."""
+    with open(location_file, "r") as f:
+        lines = f.read().splitlines()
+    return [x for x in lines if x.strip() and not (skip_comments and x.startswith("#"))]
+
+
+def LoadColumns(lines, delimiter, id_col, lat_col, lon_col, location_file):
+    """Returns the id, lat and lon columns of lines parsed in bulk. Without id_col, the
+    ids count the lines from 0."""
+    usecols = [x for x in (id_col, lat_col, lon_col) if x is not None]
+    names = ["id", "lat", "lon"] if id_col is not None else ["lat", "lon"]
+    dtype = [(x, np.int64 if x == "id" else np.float64) for x in names]
+    try:
+        columns = np.loadtxt(
+            lines,
+            delimiter=delimiter,
+            usecols=usecols,
+            comments=None,
+            dtype=dtype,
+            ndmin=1,
+        )
+    except ValueError as e:
+        raise ValueError(f"Cannot parse the locations in {location_file}: {e}") from e
+    ids = columns["id"] if id_col is not None else np.arange(len(lines))
+    return (
+        np.ascontiguousarray(ids),
+        np.ascontiguousarray(columns["lat"]),
+        np.ascontiguousarray(columns["lon"]),
+    )
+
+
+def ReadLocationText(location_file):
+    # Read the whole file and drop commented and blank lines
+    lines = ReadLines(location_file)
+
+    # Parse the id, lat and lon columns in bulk and take the names up to the first tab
+    (ids, lats, lons) = LoadColumns(lines, "\t", 1, 2, 3, location_file)
+    names = np.array([x.partition("\t")[0] for x in lines], dtype=str)
     return (names, ids, lats, lons)
 
 
+def ReadLocationCSV(location_file):
+    # Read the header line and the data lines
+    lines = ReadLines(location_file, skip_comments=False)
+    header = [x.strip().lower() for x in lines[0].split(",")] if lines else []
+    if "lat" not in header or "lon" not in header:
+        raise ValueError(f"Expected lat and lon columns in {location_file}")
+    lines = lines[1:]
+
+    # Parse the id, lat and lon columns in bulk
+    (ids, lats, lons) = LoadColumns(
+        lines,
+        ",",
+        header.index("id") if "id" in header else None,
+        header.index("lat"),
+        header.index("lon"),
+        location_file,
+    )
+    if "name" in header:
+        name_col = header.index("name")
+        names = np.array([x.split(",")[name_col].strip() for x in lines], dtype=str)
+    else:
+        names = ids.astype(str)
+    return (names, ids, lats, lons)
+
+
+def ReadLocationNetCDF(location_file):
+    with Dataset(location_file, "r") as nc_fid:
+        variables = nc_fid.variables
+        lats = np.asarray(variables["lat"][:])
+        lons = np.asarray(variables["lon"][:])
+        if "id" in variables:
+            ids = np.asarray(variables["id"][:])
+        elif "locations" in variables:
+            ids = np.asarray(variables["locations"][:])
+        else:
+            ids = np.arange(lats.size)
+        if "name" in variables:
+            names = np.asarray(variables["name"][:]).astype(str)
+        else:
+            names = ids.astype(str)
+    return (
+        names,
+        ids.astype(np.int64),
+        lats.astype(np.float64),
+        lons.astype(np.float64),
+    )
+
+
+def GridLocations(spec):
+    """Returns the sites of a regular lat/lon grid "STEP[:SOUTH,NORTH,WEST,EAST]"."""
+    parts = spec.split(":")
+    try:
+        steps = [float(x) for x in parts[0].split(",")]
+        box = [float(x) for x in parts[1].split(",")] if len(parts) > 1 else None
+    except ValueError:
+        raise ValueError(f"Invalid grid specification: {spec}") from None
+    if len(parts) > 2 or len(steps) not in (1, 2) or (box and len(box) != 4):
+        raise ValueError(f"Invalid grid specification: {spec}")
+    (dlat, dlon) = steps * 2 if len(steps) == 1 else steps
+    (south, north, west, east) = box or (-90.0, 90.0, -180.0, 180.0)
+    if dlat <= 0 or dlon <= 0 or north < south or east < west:
+        raise ValueError(f"Invalid grid specification: {spec}")
+
+    # Grid points inside the box, with its edges
+    grid_lats = south + dlat * np.arange(
+        int(np.floor((north - south) / dlat + 1e-9)) + 1
+    )
+    grid_lons = west + dlon * np.arange(int(np.floor((east - west) / dlon + 1e-9)) + 1)
+
+    # Do not repeat the first longitude of a grid around the globe
+    if grid_lons[-1] - grid_lons[0] >= 360 - 1e-9:
+        grid_lons = grid_lons[:-1]
+
+    lats = np.repeat(grid_lats, grid_lons.size)
+    lons = np.tile(grid_lons, grid_lats.size)
+    ids = np.arange(lats.size, dtype=np.int64)
+    return (ids.astype(str), ids, lats, lons)
+
+
 if __name__ == "__main__":
     import argparse
 
@@ -0,0 +1,128 @@
+import os
+import threading
+from collections import OrderedDict
+
+""" resident_inputs.py
+
+In-memory cache of the parsed inputs of the pipeline, shared by the runs of a
+long-running process (see job_server.py).
+
+Entries are keyed by their kind and the settings they were loaded with. Input files are
+keyed by their path, size and modification time (see FileStamp()), so an entry is
+reloaded when its file changes. Loads of the same entry by concurrent runs happen once.
+
+The least recently used entries are dropped once there are more than max_entries, or
+once their arrays take more than max_bytes (see EntryBytes()). Dropped entries with a
+close() method, such as open files, are closed by CloseRetired(), which runs call once
+they are done, so that no run loses a file it is reading.
+
+Kinds of entries loaded by run_pipeline():
+climate      Open climate data file
+tlim         Index of the temperature target samples of a climate file
+forcing      Indexed climate forcing table
+fit          Output of the fit stage
+preprocess   Output of the preprocess stage for one scenario
+sites        Site locations and fingerprints
+
+"""
+
+# Default number of entries kept
+DEFAULT_MAX_ENTRIES = 64
+
+# Default size limit of the arrays of the entries kept, in MB
+DEFAULT_MAX_SIZE = 4096
+
+
+def FileStamp(filename):
+    """Returns the path, size and modification time of a file, or filename itself if it
+    is not an existing file (such as a grid: location specification)."""
+    if filename is None or not os.path.isfile(filename):
+        return filename
+    st = os.stat(filename)
+    return (os.path.abspath(filename), st.st_size, st.st_mtime_ns)
+
+
+def EntryBytes(value):
+    """Returns the size in bytes of the arrays of an entry, in dictionaries, lists and
+    tuples. Memory-mapped arrays are backed by their files and take no memory of their
+    own."""
+    if isinstance(value, dict):
+        return sum(EntryBytes(x) for x in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(EntryBytes(x) for x in value)
+    if getattr(value, "filename", None) is not None:
+        return 0
+    return getattr(value, "nbytes", 0)
+
+
+class ResidentInputs:
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_size=DEFAULT_MAX_SIZE):
+        """max_entries is the number of entries kept, across kinds, and max_size the size
+        limit of their arrays in MB."""
+        self.max_entries = max_entries
+        self.max_bytes = max_size * 1024 * 1024
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._retired = []
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def Get(self, kind, key, load):
+        """Returns the entry of this kind named key, calling load() to create it if it
+        is not resident."""
+        entry_key = (kind, repr(key))
+        with self._lock:
+            if entry_key in self._entries:
+                self._entries.move_to_end(entry_key)
+                return self._entries[entry_key]
+            entry_lock = self._loading.setdefault(entry_key, threading.Lock())
+
+        # Load outside the cache lock, once per entry
+        with entry_lock:
+            with self._lock:
+                if entry_key in self._entries:
+                    self._entries.move_to_end(entry_key)
+                    return self._entries[entry_key]
+            value = load()
+            size = EntryBytes(value)
+            with self._lock:
+                self._entries[entry_key] = value
+                self._sizes[entry_key] = size
+                self._loading.pop(entry_key, None)
+                self._Evict()
+        return value
+
+    def _Evict(self):
+        # Drop the least recently used entries, but never the newest one
+        while len(self._entries) > 1 and (
+            len(self._entries) > self.max_entries
+            or sum(self._sizes.values()) > self.max_bytes
+        ):
+            (entry_key, value) = self._entries.popitem(last=False)
+            del self._sizes[entry_key]
+            if callable(getattr(value, "close", None)):
+                self._retired.append(value)
+
+    def CloseRetired(self):
+        """Closes the dropped entries that have a close() method. Call it when no run is
+        using entries obtained before."""
+        with self._lock:
+            (retired, self._retired) = (self._retired, [])
+        for value in retired:
+            value.close()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def Size(self):
+        """Returns the size in bytes of the arrays of the entries."""
+        with self._lock:
+            return sum(self._sizes.values())
+
+
+def Resident(resident, kind, key, load):
+    """Returns resident.Get(kind, key, load), or load() without resident inputs."""
+    if resident is None:
+        return load()
+    return resident.Get(kind, key, load)
@@ -0,0 +1,226 @@
+import json
+import logging
+import warnings
+
+import numpy as np
+from scipy.stats import qmc
+
+""" sampling.py
+
+Draws the random parameters of the projection samples: the quantile of the linear trend,
+the row of the model parameters and the error from the fit.
+
+Sampling strategies:
+random      Plain Monte Carlo (the original behavior)
+lhs         Latin hypercube sampling of the trend quantiles
+sobol       Scrambled Sobol' sequence for the joint draw of the trend quantile, model row
+            and fit error
+stratified  Model rows allocated to each group/model stratum in proportion to its number
+            of rows, so every stratum is represented as evenly as nsamps allows
+
+Temperature trajectories are paired with the samples in order, as before.
+
+The lhs and sobol methods draw quasi-random sets whose balance holds for the set as a
+whole. With sharded sampling their parameters are drawn once for all samples and each
+shard gets its slice (see IterSampleBlocks()). Slices of a Sobol' sequence aligned on a
+power of 2 are balanced too, so the default shard size is a power of 2 with sobol.
+
+AdaptiveSampleBlocks() stops drawing blocks of samples once requested quantiles converge.
+
+"""
+
+logger = logging.getLogger(__name__)
+
+SAMPLING_METHODS = ("random", "lhs", "sobol", "stratified")
+
+# Quasi-random methods, whose parameters are drawn for all samples at once
+QMC_METHODS = ("lhs", "sobol")
+
+# Default number of samples per shard, and with Sobol' sampling
+DEFAULT_SHARD_SIZE = 10000
+SOBOL_SHARD_SIZE = 8192
+
+# Output file attributes written by AdaptiveAttributes()
+ADAPTIVE_ATTRIBUTES = ("adaptive_nsamps", "adaptive_trace")
+
+
+def DrawSampleParameters(nsamps, sigmas, rng, method="random", strata=None):
+    """Draws the random parameters of nsamps samples from rng.
+
+    With the random method, the draws happen in the same order as the scalar loop: trend
+    quantiles, model indices, then the fit error of each sample. strata holds the
+    stratum of each model row and is required by the stratified method.
+    """
+    nmodels = sigmas.shape[0]
+
+    if method == "random":
+        # Generate a list of quantiles for the trend samples
+        trend_q = rng.random(nsamps)
+
+        # Generate the indices for the model samples
+        model_sample_idx = rng.choice(np.arange(nmodels), nsamps)
+        u_error = None
+
+    elif method == "lhs":
+        trend_q = qmc.LatinHypercube(d=1, rng=rng).random(nsamps)[:, 0]
+        model_sample_idx = rng.choice(np.arange(nmodels), nsamps)
+        u_error = None
+
+    elif method == "sobol":
+        if nsamps & (nsamps - 1):
+            logger.warning(
+                "Sobol' sampling is best balanced when the number of samples is a power of 2"
+            )
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", UserWarning)
+            u = qmc.Sobol(d=3, scramble=True, rng=rng).random(nsamps)
+        trend_q = u[:, 0]
+        model_sample_idx = np.minimum((u[:, 1] * nmodels).astype(int), nmodels - 1)
+        u_error = u[:, 2]
+
+    elif method == "stratified":
+        if strata is None:
+            raise ValueError("Stratified sampling requires the model strata")
+        trend_q = rng.random(nsamps)
+        model_sample_idx = StratifiedModelSample(strata, nsamps, rng)
+        u_error = None
+
+    else:
+        raise ValueError(f"Unknown sampling method: {method}")
+
+    # Generate the error from the fit for each sample (see my_model()), from the QMC
+    # sequence if it has a dimension for it
+    spread = (sigmas[model_sample_idx] * 0.0) / 100.0
+    if u_error is None:
+        pct_error = rng.uniform(-spread, spread)
+    else:
+        pct_error = -spread + 2.0 * spread * u_error
+
+    return (trend_q, model_sample_idx, pct_error)
+
+
+def ShardSize(shard_size=None, method="random"):
+    """Returns shard_size, or the default shard size of the sampling method if it is
+    None."""
+    if shard_size is not None:
+        return shard_size
+    return SOBOL_SHARD_SIZE if method == "sobol" else DEFAULT_SHARD_SIZE
+
+
+def ModelStrata(groups, models):
+    """Returns the stratum of each model row: one stratum per group/model pair."""
+    pairs = np.char.add(np.char.add(np.asarray(groups, dtype=str), "\t"), models)
+    return np.unique(pairs, return_inverse=True)[1]
+
+
+def StratifiedModelSample(strata, nsamps, rng):
+    """Draws nsamps model rows so that each stratum gets its expected share of the
+    samples under uniform sampling of the rows, up to rounding. The leftover samples go
+    to strata chosen by systematic sampling. The rows are shuffled before returning."""
+    (_, stratum_sizes) = np.unique(strata, return_counts=True)
+    expected = nsamps * stratum_sizes / strata.size
+
+    # Whole number of samples per stratum, and systematic allocation of the remainder
+    counts = np.floor(expected).astype(int)
+    leftover = nsamps - counts.sum()
+    if leftover > 0:
+        edges = np.cumsum(expected - counts)
+        points = rng.random() + np.arange(leftover)
+        extra = np.minimum(
+            np.searchsorted(edges, points, side="right"), counts.size - 1
+        )
+        counts += np.bincount(extra, minlength=counts.size)
+
+    # Draw the rows uniformly within each stratum
+    model_sample_idx = np.empty(nsamps, dtype=int)
+    start = 0
+    for stratum, count in enumerate(counts):
+        rows = np.flatnonzero(strata == stratum)
+        model_sample_idx[start : start + count] = rng.choice(rows, count)
+        start += count
+
+    return rng.permutation(model_sample_idx)
+
+
+def AdaptiveSampleBlocks(
+    sample_blocks, year_idx, quantiles, tol, trace, batch_size=None
+):
+    """Passes on blocks of samples until the requested quantiles converge.
+
+    The quantiles of all samples so far are computed at the columns year_idx after every
+    batch_size samples, or after each block if batch_size is None, and after the last
+    block. Blocks stop once the largest change of any quantile from the previous check is
+    below tol (in mm), or when sample_blocks runs out. A block that spans the converged
+    check is cut there, so the checks do not depend on the size of the blocks. Each check
+    is appended to trace as a dictionary with the number of samples, the quantiles and
+    the largest change.
+    """
+    tracked = []
+    previous = None
+
+    def Converged(nsamps):
+        nonlocal previous
+
+        # Track the quantiles of the first nsamps samples
+        current = np.quantile(
+            np.concatenate(tracked, axis=0)[:nsamps], quantiles, axis=0
+        )
+        change = None if previous is None else float(np.max(np.abs(current - previous)))
+        trace.append(
+            {"nsamps": int(nsamps), "quantiles": current.tolist(), "max_change": change}
+        )
+        logger.debug(f"Adaptive sampling: {nsamps} samples, change {change}")
+        previous = current
+        return change is not None and change < tol
+
+    try:
+        (start, checked) = (0, 0)
+        for block in sample_blocks:
+            tracked.append(block[:, year_idx])
+            end = start + block.shape[0]
+
+            # Check at each batch boundary within the block, or at its end
+            if batch_size is None:
+                checks = [end]
+            else:
+                checks = range(
+                    (start // batch_size + 1) * batch_size, end + 1, batch_size
+                )
+            for nsamps in checks:
+                checked = nsamps
+                if Converged(nsamps):
+                    yield block[: nsamps - start]
+                    return
+            yield block
+            start = end
+
+        # Check the samples after the last batch boundary
+        if checked < start:
+            Converged(start)
+    finally:
+        # Stop generating samples
+        if hasattr(sample_blocks, "close"):
+            sample_blocks.close()
+
+
+def AdaptiveYearIndices(targyears, adaptive_years=None):
+    """Returns the indices of the years tracked by adaptive sampling in targyears. By
+    default this is 2100, or the last target year if 2100 is not projected."""
+    if not adaptive_years:
+        adaptive_years = [2100] if 2100 in targyears else [targyears[-1]]
+    year_idx = np.flatnonzero(np.isin(targyears, adaptive_years))
+    if year_idx.size != len(set(adaptive_years)):
+        raise ValueError(
+            f"Adaptive sampling years {list(adaptive_years)} are not all target years"
+        )
+    return year_idx
+
+
+def AdaptiveAttributes(trace):
+    """Returns the output file attributes recording the adaptive sample count."""
+    if not trace:
+        return {}
+    return {
+        "adaptive_nsamps": trace[-1]["nsamps"],
+        "adaptive_trace": json.dumps(trace),
+    }
@@ -0,0 +1,272 @@
+import json
+import os
+from collections.abc import Mapping
+
+import numpy as np
+
+from fittedismip_gris.cache import (
+    AtomicOutput,
+    CachedFileHash,
+    CachePath,
+    EvictCache,
+    HashValues,
+    TouchEntry,
+)
+
+""" stage_checkpoints.py
+
+Content-addressed checkpoints of the stages of the pipeline.
+
+With a cache directory, the output dictionaries of the preprocess, fit and project
+stages are kept in the "stages" sub-directory, keyed by a hash of everything they
+depend on:
+
+preprocess  Contents of the climate data file (or of the climate forcing file when
+            tlm_flag is 0), scenario, years, number of samples and base year
+fit         Contents of the parameter files (or of the parameter bundle) and the trend
+            terms
+project     Keys of the preprocess and fit checkpoints and every projection option,
+            including the random seed
+
+Reruns reuse the checkpoint of any stage whose key is unchanged. The preprocess output
+is stored as .npy files, and its temperature samples are memory-mapped when read, as in
+the temperature cache, so concurrent runs share one page-cached copy. Samples read from
+the temperature cache are hard-linked rather than copied, so they take no extra space,
+and the checkpoint stays readable when the temperature cache entry is evicted. The
+checkpoints and the cache entry then count the file against both their size limits.
+The fit output is stored as an .npz file holding the parameters of the projected ice
+sources only, so the parameters of the other sources are never loaded. The project
+output is stored as a global output file in float64, which is read back lazily (see
+LoadProjection()). The postprocess stage writes the requested local output and is
+always run.
+
+The checkpoints of each stage are kept within a size limit: the least recently used are
+removed first (see EvictCheckpoints()). A checkpoint evicted by a concurrent run before
+it is read counts as missing (see LoadStage()).
+
+A run can start or stop at a stage (see StageRange()). The stages before the first are
+loaded from their checkpoints, and the stages from the first on are run again.
+
+"""
+
+# Stages in the order they run
+STAGES = ("preprocess", "fit", "project", "postprocess")
+
+# Version of the checkpoint layout
+CHECKPOINT_VERSION = 2
+
+# File name suffix of the checkpoints of each stage
+CHECKPOINT_SUFFIXES = {"preprocess": ".npy", "fit": ".npz", "project": ".nc"}
+
+# Default size limit of the checkpoints of each stage, in MB
+DEFAULT_CHECKPOINT_SIZE = 4096
+
+
+def StageRange(from_stage=None, until_stage=None):
+    """Returns the indices in STAGES of the first and last stage to run."""
+    first = STAGES.index(from_stage) if from_stage is not None else 0
+    last = STAGES.index(until_stage) if until_stage is not None else len(STAGES) - 1
+    if first > last:
+        raise ValueError(f"The {from_stage} stage comes after the {until_stage} stage")
+    return (first, last)
+
+
+def PreprocessKey(
+    cache_dir,
+    scenario,
+    tlm_flag,
+    climate_data_file,
+    climate_forcing_file,
+    years,
+    nsamps,
+    baseyear,
+):
+    """Returns the checkpoint key of the preprocess stage."""
+    climate_input = climate_forcing_file if tlm_flag == 0 else climate_data_file
+    return HashValues(
+        CHECKPOINT_VERSION,
+        "preprocess",
+        CachedFileHash(cache_dir, climate_input),
+        scenario,
+        tlm_flag,
+        sorted(int(x) for x in np.unique(years)),
+        nsamps,
+        baseyear,
+    )
+
+
+def FitKey(cache_dir, parm_files, parm_bundle, trend_mean, trend_sd):
+    """Returns the checkpoint key of the fit stage. parm_files lists the parameter files,
+    which may be None when the parameters come from parm_bundle. An existing parm_bundle
+    is read whatever the parameter files (see parameter_store.py), so it keys the fit."""
+    if parm_bundle is not None and os.path.exists(parm_bundle):
+        sources = CachedFileHash(cache_dir, parm_bundle)
+    else:
+        sources = [x and CachedFileHash(cache_dir, x) for x in parm_files]
+    return HashValues(CHECKPOINT_VERSION, "fit", sources, trend_mean, trend_sd)
+
+
+def ProjectKey(preprocess_key, fit_key, options):
+    """Returns the checkpoint key of the project stage. options maps the names of the
+    projection options to their values."""
+    return HashValues(CHECKPOINT_VERSION, "project", preprocess_key, fit_key, options)
+
+
+def CheckpointPath(cache_dir, stage, key):
+    """Returns the path of the checkpoint of the stage named key."""
+    return CachePath(
+        cache_dir, os.path.join("stages", stage), key, CHECKPOINT_SUFFIXES[stage]
+    )
+
+
+def FindCheckpoint(cache_dir, stage, key, required=False):
+    """Returns the path of the checkpoint of the stage named key, or None if there is
+    none. A missing checkpoint is a ValueError when it is required."""
+    checkpoint_file = CheckpointPath(cache_dir, stage, key)
+    try:
+        TouchEntry(checkpoint_file)
+        return checkpoint_file
+    except FileNotFoundError:
+        # Missing, or evicted by a concurrent run
+        if required:
+            raise MissingCheckpoint(cache_dir, stage) from None
+    return None
+
+
+def MissingCheckpoint(cache_dir, stage):
+    """Returns the error for a required checkpoint of the stage that is missing."""
+    return ValueError(
+        f"There is no {stage} checkpoint for these inputs in {cache_dir}. Run the {stage} stage first."
+    )
+
+
+def ResumeStage(cache_dir, stage, key, from_stage=None):
+    """Returns the checkpoint to load instead of running the stage, or None to run it.
+    Without from_stage, any checkpoint with the key is reused. With from_stage, the
+    stages before it must have a checkpoint and the others are run again."""
+    if from_stage is None:
+        return FindCheckpoint(cache_dir, stage, key)
+    if STAGES.index(stage) >= STAGES.index(from_stage):
+        return None
+    return FindCheckpoint(cache_dir, stage, key, required=True)
+
+
+def LoadStage(cache_dir, stage, checkpoint_file, load, from_stage=None):
+    """Returns load(checkpoint_file) for the checkpoint ResumeStage() returned, or None
+    to run the stage if a concurrent run evicted it in the meantime. It is a ValueError
+    when the checkpoint is required by from_stage."""
+    try:
+        return load(checkpoint_file)
+    except FileNotFoundError:
+        if from_stage is not None:
+            raise MissingCheckpoint(cache_dir, stage) from None
+    return None
+
+
+def EvictCheckpoints(cache_dir, stage, key, max_size=DEFAULT_CHECKPOINT_SIZE):
+    """Removes the least recently used checkpoints of the stage until they take at most
+    max_size MB. The checkpoint named key is kept."""
+    EvictCache(
+        cache_dir, os.path.join("stages", stage), max_size * 1024 * 1024, keep=key
+    )
+
+
+def FlattenArrays(output, prefix=""):
+    """Returns the arrays of a nested dictionary of arrays and scalars, keyed by their
+    "/"-separated paths."""
+    arrays = {}
+    for name, value in output.items():
+        if isinstance(value, Mapping):
+            arrays.update(FlattenArrays(value, f"{prefix}{name}/"))
+        else:
+            arrays[f"{prefix}{name}"] = np.asarray(value)
+    return arrays
+
+
+def NestArrays(arrays):
+    """Inverse of FlattenArrays(). Scalars are returned as Python scalars."""
+    output = {}
+    for path, value in arrays.items():
+        names = path.split("/")
+        node = output
+        for name in names[:-1]:
+            node = node.setdefault(name, {})
+        node[names[-1]] = value.item() if value.ndim == 0 else value
+    return output
+
+
+def FitCheckpoint(fit_dict, icesources):
+    """Returns the fit output for the ice sources icesources only. The parameters of the
+    other sources are not loaded."""
+    return {
+        name: {x: value[x] for x in icesources} if isinstance(value, Mapping) else value
+        for name, value in fit_dict.items()
+    }
+
+
+def SaveCheckpoint(checkpoint_file, output):
+    """Writes a nested dictionary of arrays and scalars to an .npz checkpoint."""
+    with AtomicOutput(checkpoint_file) as tmp_checkpoint_file:
+        np.savez(tmp_checkpoint_file, **FlattenArrays(output))
+
+
+def LoadCheckpoint(checkpoint_file):
+    """Reads a dictionary written by SaveCheckpoint()."""
+    with np.load(checkpoint_file) as npz:
+        return NestArrays({x: npz[x] for x in npz.files})
+
+
+def SavePreprocessCheckpoint(checkpoint_file, preprocess_dict):
+    """Writes the output of the preprocess stage to a checkpoint: the temperature samples
+    to checkpoint_file, and the years and scalars next to it."""
+    stem = os.path.splitext(checkpoint_file)[0]
+    scalars = {
+        x: preprocess_dict[x] for x in ("scenario", "baseyear") if x in preprocess_dict
+    }
+
+    # Write the samples last, so a checkpoint is complete once they exist
+    with (
+        AtomicOutput(f"{stem}.json") as tmp_scalars_file,
+        open(tmp_scalars_file, "w") as f,
+    ):
+        json.dump(scalars, f)
+    with AtomicOutput(f"{stem}.years.npy") as tmp_years_file:
+        np.save(tmp_years_file, np.asarray(preprocess_dict["years"]))
+    temp_data = preprocess_dict["temp_data"]
+    with AtomicOutput(checkpoint_file) as tmp_samples_file:
+        if not LinkMappedFile(temp_data, tmp_samples_file):
+            np.save(tmp_samples_file, np.ascontiguousarray(temp_data))
+
+
+def LinkMappedFile(array, filename):
+    """Replaces filename with a hard link to the .npy file that array memory-maps in
+    full, such as a temperature cache entry. Returns False if array does not map a
+    whole .npy file or the link cannot be made."""
+    mapped_file = getattr(array, "filename", None)
+    if mapped_file is None or not array.flags.c_contiguous:
+        return False
+    try:
+        mapped = np.load(mapped_file, mmap_mode="r")
+        if (mapped.shape, mapped.dtype, mapped.offset) != (
+            array.shape,
+            array.dtype,
+            array.offset,
+        ):
+            return False
+        os.remove(filename)
+        os.link(mapped_file, filename)
+    except (OSError, ValueError):
+        # The file was evicted, or is on another file system
+        return False
+    return True
+
+
+def LoadPreprocessCheckpoint(checkpoint_file):
+    """Reads the output of the preprocess stage written by SavePreprocessCheckpoint().
+    The temperature samples are memory-mapped read-only."""
+    stem = os.path.splitext(checkpoint_file)[0]
+    with open(f"{stem}.json") as f:
+        preprocess_dict = json.load(f)
+    preprocess_dict["years"] = np.load(f"{stem}.years.npy")
+    preprocess_dict["temp_data"] = np.load(checkpoint_file, mmap_mode="r")
+    return preprocess_dict
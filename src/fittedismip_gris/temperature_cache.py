@@ -0,0 +1,148 @@
+import logging
+import os
+
+import h5py
+import numpy as np
+
+from fittedismip_gris.cache import (
+    AtomicOutput,
+    CachedFileHash,
+    CachePath,
+    EvictCache,
+    HashValues,
+    TouchEntry,
+)
+from fittedismip_gris.Import2lmData import Import2lmData
+
+""" temperature_cache.py
+
+On-disk cache of preprocessed two-layer model temperature ensembles.
+
+Entries hold the [samples, years] temperature anomalies returned by Import2lmData(),
+optionally re-zeroed to a base year, as .npy files that are memory-mapped when read.
+Concurrent runs on the same node then share one page-cached copy of the ensemble.
+
+Entries are keyed by the sha256 of the climate file contents and every setting that
+changes the result: scenario, variable, reference and window years, requested years,
+number of samples and base year. The least recently used entries are removed when the
+entries take more than the size limit.
+
+"""
+
+logger = logging.getLogger(__name__)
+
+# Version of the entry layout
+CACHE_VERSION = 1
+
+# Default size limit of the cache entries, in MB
+DEFAULT_CACHE_SIZE = 4096
+
+
+def CachedImport2lmData(
+    cache_dir,
+    climate_file,
+    variable="surface_temperature",
+    scenario="ssp585",
+    refyear_start=1995,
+    refyear_end=2014,
+    twinyear_start=2020,
+    twinyear_end=2100,
+    years=None,
+    nsamps=None,
+    baseyear=None,
+    max_size=DEFAULT_CACHE_SIZE,
+    tlim_index=None,
+):
+    """Returns Import2lmData() for these settings from the cache, computing and storing
+    it on a miss. The samples are memory-mapped read-only. When baseyear is given, the
+    samples are re-zeroed to it and the dictionary records the base year."""
+    filename = (
+        climate_file.filename
+        if isinstance(climate_file, h5py.File)
+        else os.fspath(climate_file)
+    )
+    key = HashValues(
+        CACHE_VERSION,
+        CachedFileHash(cache_dir, filename),
+        scenario,
+        variable,
+        refyear_start,
+        refyear_end,
+        twinyear_start,
+        twinyear_end,
+        None if years is None else sorted(int(x) for x in np.unique(years)),
+        nsamps,
+        baseyear,
+    )
+    samples_file = CachePath(cache_dir, "temperatures", key, ".npy")
+    years_file = CachePath(cache_dir, "temperatures", key, ".years.npy")
+
+    # Cache hit. Concurrent runs may evict the entry at any time, so a missing file is a
+    # cache miss.
+    try:
+        TouchEntry(samples_file, years_file)
+        out_dict = LoadTemperatureEntry(samples_file, years_file)
+        logger.debug(f"Temperature cache hit for {scenario}: {samples_file}")
+    except FileNotFoundError:
+        out_dict = WriteTemperatureEntry(
+            samples_file,
+            years_file,
+            Import2lmData(
+                variable=variable,
+                scenario=scenario,
+                refyear_start=refyear_start,
+                refyear_end=refyear_end,
+                twinyear_start=twinyear_start,
+                twinyear_end=twinyear_end,
+                climate_file=climate_file,
+                years=years,
+                nsamps=nsamps,
+                tlim_index=tlim_index,
+            ),
+            baseyear,
+        )
+
+        # Memory-map the new entry, unless it was evicted already
+        try:
+            out_dict = LoadTemperatureEntry(samples_file, years_file)
+        except FileNotFoundError:
+            pass
+
+    # Keep the cache within its size limit. The loaded entry stays readable if another
+    # run removes it.
+    EvictCache(cache_dir, "temperatures", max_size * 1024 * 1024, keep=key)
+
+    if baseyear is not None:
+        out_dict["baseyear"] = baseyear
+    return out_dict
+
+
+def LoadTemperatureEntry(samples_file, years_file):
+    """Reads a cache entry, with the samples memory-mapped read-only."""
+    return {
+        "samples": np.load(samples_file, mmap_mode="r"),
+        "years": np.load(years_file),
+    }
+
+
+def WriteTemperatureEntry(samples_file, years_file, tlm_dict, baseyear=None):
+    """Writes the output of Import2lmData() to a cache entry, re-zeroed to baseyear if
+    given, and returns the samples and years written."""
+    samps = tlm_dict["samples"]
+
+    # Zero out the temperature data to the base year
+    if baseyear is not None:
+        baseyear_idx = np.flatnonzero(tlm_dict["years"] == baseyear)
+        if baseyear_idx.size == 0:
+            raise ValueError(
+                f"baseyear is not found in temperature data. baseyear = {baseyear}"
+            )
+        samps = samps - samps[:, baseyear_idx]
+
+    # Write the years first, so an entry is complete once its samples exist
+    with AtomicOutput(years_file) as tmp_years_file:
+        np.save(tmp_years_file, tlm_dict["years"])
+    samps = np.ascontiguousarray(samps)
+    with AtomicOutput(samples_file) as tmp_samples_file:
+        np.save(tmp_samples_file, samps)
+    return {"samples": samps, "years": tlm_dict["years"]}
@@ -0,0 +1,62 @@
+import logging
+import os
+
+import h5py
+import numpy as np
+
+from fittedismip_gris.cache import AtomicOutput, CachedFileHash, CachePath, HashValues
+from fittedismip_gris.Import2lmData import BuildTlimIndex
+
+""" tlim_index.py
+
+Sidecar index of the temperature target (tlim) samples of a two-layer model file.
+
+The index holds the source scenario, column and window-maximum temperature of every
+sample (see BuildTlimIndex()). It is built once per climate file and temperature window
+and stored in the cache directory under a hash of the file contents, so tlim scenarios
+are a range lookup followed by a read of only the matching columns.
+
+"""
+
+logger = logging.getLogger(__name__)
+
+# Version of the index layout
+INDEX_VERSION = 1
+
+
+def LoadTlimIndex(climate_file, twinyear_start=2020, twinyear_end=2100, cache_dir=None):
+    """Returns the tlim index of climate_file (a file name or an open h5py.File), from
+    the cache directory if possible. Without a cache directory the index is built in
+    memory."""
+    close_file = not isinstance(climate_file, h5py.File)
+    hf = h5py.File(climate_file, "r") if close_file else climate_file
+
+    try:
+        if cache_dir is None:
+            return BuildTlimIndex(hf, twinyear_start, twinyear_end)
+
+        key = HashValues(
+            INDEX_VERSION,
+            CachedFileHash(cache_dir, hf.filename),
+            twinyear_start,
+            twinyear_end,
+        )
+        index_file = CachePath(cache_dir, "tlim", key, ".npz")
+
+        # Build the index once
+        if not os.path.exists(index_file):
+            logger.info(f"Building the tlim index of {hf.filename}")
+            tlim_index = BuildTlimIndex(hf, twinyear_start, twinyear_end)
+            with AtomicOutput(index_file) as tmp_index_file:
+                np.savez(tmp_index_file, **tlim_index)
+            return tlim_index
+
+    finally:
+        if close_file:
+            hf.close()
+
+    with np.load(index_file) as npz:
+        tlim_index = {x: npz[x] for x in npz.files}
+    tlim_index["twinyear_start"] = int(tlim_index["twinyear_start"])
+    tlim_index["twinyear_end"] = int(tlim_index["twinyear_end"])
+    return tlim_index